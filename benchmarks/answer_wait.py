@@ -0,0 +1,123 @@
+"""
+AnswerIntent の待機モードのベンチマーク
+
+質問の直後に「回答!」と言ったユーザーが回答を聞けるまでの
+ユーザー側のやり取りの回数と Firestore の読み取り数を、待機モードごとに比べます。
+回答の作成は generation_delay 秒後に終わるものとし、インメモリ Firestore
+(firestore_fake) を直接書き換えて再現します。
+
+    python benchmarks/answer_wait.py [--users 5] [--delay 1.5] [--retry-interval 2.0]
+
+    retry  : 待たない (従来どおり、ユーザーが retry_interval 秒ごとに言い直す)
+    listen : on_snapshot のリスナーで待つ
+    poll   : 指数バックオフのポーリングで待つ
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "lambda"))
+
+from alexa_handler import AlexaHandler  # noqa: E402
+from firestore_fake import FakeClient  # noqa: E402
+from handlers import seed_news  # noqa: E402
+from question import Question, ANSWER_STATUS  # noqa: E402
+
+MODES = ["retry", "listen", "poll"]
+# lambda_function と同じく、Alexa の応答待ち時間から余裕を引いた分だけ待つ
+WAIT_BUDGET_SECONDS = 8.0 - 1.5
+
+
+def finish_generation(db, user_id: str):
+    Question.collection(db).document(user_id).update(
+        {"answer_text": "(bench) 回答です。", "answer_status": ANSWER_STATUS["READY"]}
+    )
+
+
+def run_user(db, mode: str, user_id: str, delay: float, retry_interval: float):
+    session = {}
+    AlexaHandler.play_news(user_id, "ja", db, session=session)
+    AlexaHandler.receive_question(
+        user_id, "ja", "AIエージェント関連のニュースは？", db, session=session
+    )
+    timer = threading.Timer(delay, finish_generation, args=(db, user_id))
+    timer.start()
+
+    db.stats.reset()
+    started = time.monotonic()
+    turns = 0
+    progressive = []
+    while True:
+        turns += 1
+        kwargs = {}
+        if mode != "retry":
+            kwargs = {
+                "wait_until": time.monotonic() + WAIT_BUDGET_SECONDS,
+                "wait_mode": mode,
+                "progressive": progressive.append,
+            }
+        AlexaHandler.answer(user_id, "ja", db, session=session, **kwargs)
+        status = session["user_state"]["question"]["answer_status"]
+        if status == ANSWER_STATUS["ANSWERED"]:
+            break
+        time.sleep(retry_interval)
+    timer.join()
+    return {
+        "turns": turns,
+        "reads": db.stats.reads,
+        "round_trips": db.stats.round_trips,
+        "seconds": time.monotonic() - started,
+        "progressive": len(progressive),
+    }
+
+
+def run(users: int, delay: float, retry_interval: float, latency: float) -> dict:
+    report = {}
+    for mode in MODES:
+        db = FakeClient(latency=latency)
+        seed_news(db)
+        rows = [
+            run_user(db, mode, f"bench-{mode}-{i}", delay, retry_interval)
+            for i in range(users)
+        ]
+        report[mode] = {
+            key: statistics.mean(row[key] for row in rows) for key in rows[0]
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=5)
+    parser.add_argument(
+        "--delay", type=float, default=1.5, help="回答の作成にかかる秒数"
+    )
+    parser.add_argument(
+        "--retry-interval",
+        type=float,
+        default=2.0,
+        help="待たない場合にユーザーが言い直すまでの秒数",
+    )
+    parser.add_argument(
+        "--latency", type=float, default=0.01, help="往復ごとに挟む遅延秒数"
+    )
+    args = parser.parse_args()
+
+    report = run(args.users, args.delay, args.retry_interval, args.latency)
+    print(
+        f"{'mode':<8}{'turns':>8}{'reads':>8}{'RTT':>8}{'seconds':>10}{'progressive':>13}"
+    )
+    for mode, row in report.items():
+        print(
+            f"{mode:<8}{row['turns']:>8.2f}{row['reads']:>8.2f}{row['round_trips']:>8.2f}"
+            f"{row['seconds']:>10.2f}{row['progressive']:>13.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,821 @@
+"""
+ローカル実行用のインメモリ Firestore
+
+このプロジェクトが使う firestore.Client の範囲 (collection / document /
+get / set / update / delete / where(FieldFilter) / order_by / limit /
+start_after / select / stream / count / get_all / batch / transaction /
+bulk_writer) を置き換えます。読み取り・書き込み・往復回数を数え、
+往復ごとに遅延を挟むことができます。
+
+    db = FakeClient(latency=0.01)
+    ...
+    print(db.stats.snapshot())
+
+非同期版 (firestore.AsyncClient) の代わりには、同じデータを共有する
+AsyncFakeClient(db) を使います。遅延は asyncio.sleep で挟むため、
+並行に発行した読み取りの待ち時間は重なります。
+"""
+
+import asyncio
+import copy
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import (
+    AlreadyExists,
+    Aborted,
+    FailedPrecondition,
+    NotFound,
+)
+from google.cloud.firestore_v1 import transforms
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+_MISSING = object()
+
+
+class FirestoreStats:
+    """
+    RPC 単位の往復回数と、課金単位のドキュメント読み取り・書き込み数
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.round_trips = 0
+            self.reads = 0
+            self.writes = 0
+            self.deletes = 0
+
+    def add(self, round_trips=0, reads=0, writes=0, deletes=0):
+        with self._lock:
+            self.round_trips += round_trips
+            self.reads += reads
+            self.writes += writes
+            self.deletes += deletes
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {
+                "round_trips": self.round_trips,
+                "reads": self.reads,
+                "writes": self.writes,
+                "deletes": self.deletes,
+            }
+
+
+def _normalize(value):
+    """
+    Firestore と同様に、naive な datetime は UTC として扱う
+    """
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    if isinstance(value, dict):
+        return {k: _normalize(v) for k, v in value.items()}
+    if isinstance(value, list):
+        return [_normalize(v) for v in value]
+    return value
+
+
+def _get_field(data: dict, field_path: str):
+    current = data
+    for part in field_path.split("."):
+        if not isinstance(current, dict) or part not in current:
+            return _MISSING
+        current = current[part]
+    return current
+
+
+def _apply_value(data: dict, field_path: str, value):
+    parts = field_path.split(".")
+    current = data
+    for part in parts[:-1]:
+        current = current.setdefault(part, {})
+    key = parts[-1]
+    existing = current.get(key, _MISSING)
+
+    if value is transforms.DELETE_FIELD:
+        current.pop(key, None)
+    elif value is transforms.SERVER_TIMESTAMP:
+        current[key] = datetime.now(timezone.utc)
+    elif isinstance(value, transforms.Increment):
+        base = existing if isinstance(existing, (int, float)) else 0
+        current[key] = base + value.value
+    elif isinstance(value, transforms.Maximum):
+        base = existing if isinstance(existing, (int, float)) else value.value
+        current[key] = max(base, value.value)
+    elif isinstance(value, transforms.Minimum):
+        base = existing if isinstance(existing, (int, float)) else value.value
+        current[key] = min(base, value.value)
+    elif isinstance(value, transforms.ArrayUnion):
+        items = list(existing) if isinstance(existing, list) else []
+        items.extend(v for v in _normalize(list(value.values)) if v not in items)
+        current[key] = items
+    elif isinstance(value, transforms.ArrayRemove):
+        items = list(existing) if isinstance(existing, list) else []
+        removed = _normalize(list(value.values))
+        current[key] = [v for v in items if v not in removed]
+    elif isinstance(value, dict):
+        current[key] = {}
+        for k, v in value.items():
+            _apply_value(current[key], k, v)
+    else:
+        current[key] = copy.deepcopy(_normalize(value))
+
+
+def _merge(data: dict, updates: dict):
+    for key, value in updates.items():
+        if isinstance(value, dict) and isinstance(data.get(key), dict):
+            _merge(data[key], value)
+        else:
+            _apply_value(data, key, value)
+
+
+def _compare(left, op: str, right) -> bool:
+    try:
+        if op == "==":
+            return left == right
+        if op == "!=":
+            return left != right
+        if op == "<":
+            return left < right
+        if op == "<=":
+            return left <= right
+        if op == ">":
+            return left > right
+        if op == ">=":
+            return left >= right
+        if op == "in":
+            return left in right
+        if op == "not-in":
+            return left not in right
+        if op == "array_contains":
+            return isinstance(left, list) and right in left
+        if op == "array_contains_any":
+            return isinstance(left, list) and any(v in left for v in right)
+    except TypeError:
+        return False
+    raise ValueError(f"unsupported operator: {op}")
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data, update_time=None):
+        self.reference = reference
+        self._data = data
+        self.update_time = update_time
+
+    @property
+    def id(self):
+        return self.reference.id
+
+    @property
+    def exists(self) -> bool:
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data) if self._data is not None else None
+
+    def get(self, field_path: str):
+        value = _get_field(self._data or {}, field_path)
+        if value is _MISSING:
+            raise KeyError(field_path)
+        return copy.deepcopy(value)
+
+
+class DocumentReference:
+    def __init__(self, client, path: str):
+        self._client = client
+        self._path = path
+
+    @property
+    def id(self) -> str:
+        return self._path.rsplit("/", 1)[-1]
+
+    @property
+    def path(self) -> str:
+        return self._path
+
+    @property
+    def parent(self):
+        return CollectionReference(self._client, self._path.rsplit("/", 1)[0])
+
+    def __eq__(self, other):
+        return isinstance(other, DocumentReference) and other._path == self._path
+
+    def __hash__(self):
+        return hash(self._path)
+
+    def collection(self, collection_id: str):
+        return CollectionReference(self._client, f"{self._path}/{collection_id}")
+
+    def get(self, field_paths=None, transaction=None):
+        if transaction is not None:
+            return transaction.get(self, field_paths=field_paths)
+        self._client._rpc(reads=1)
+        return self._client._snapshot(self, field_paths)
+
+    def set(self, document_data: dict, merge=False):
+        self._client._rpc()
+        self._client._write([("set", self, document_data, merge)])
+
+    def create(self, document_data: dict):
+        self._client._rpc()
+        self._client._write([("create", self, document_data, False)])
+
+    def update(self, field_updates: dict, option=None):
+        self._client._rpc()
+        self._client._write([("update", self, field_updates, False, option)])
+
+    def delete(self):
+        self._client._rpc()
+        self._client._write([("delete", self, None, False)])
+
+    def on_snapshot(self, callback):
+        return self._client._watch(self, callback)
+
+
+class Query:
+    def __init__(
+        self,
+        client,
+        collection_path: str,
+        filters=(),
+        orders=(),
+        limit=None,
+        start_after=None,
+        projection=None,
+        all_descendants=False,
+    ):
+        self._client = client
+        self._collection_path = collection_path
+        self._all_descendants = all_descendants
+        self._filters = tuple(filters)
+        self._orders = tuple(orders)
+        self._limit = limit
+        self._start_after = start_after
+        self._projection = projection
+
+    def _copy(self, **changes):
+        kwargs = {
+            "filters": self._filters,
+            "orders": self._orders,
+            "limit": self._limit,
+            "start_after": self._start_after,
+            "projection": self._projection,
+            "all_descendants": self._all_descendants,
+        }
+        kwargs.update(changes)
+        return Query(self._client, self._collection_path, **kwargs)
+
+    def where(self, field_path=None, op_string=None, value=None, *, filter=None):
+        if filter is None:
+            filter = FieldFilter(field_path, op_string, value)
+        return self._copy(filters=self._filters + (filter,))
+
+    def order_by(self, field_path: str, direction="ASCENDING"):
+        return self._copy(orders=self._orders + ((field_path, direction),))
+
+    def limit(self, count: int):
+        return self._copy(limit=count)
+
+    def start_after(self, document_fields_or_snapshot):
+        return self._copy(start_after=document_fields_or_snapshot)
+
+    def select(self, field_paths):
+        return self._copy(projection=list(field_paths))
+
+    def _sort_key(self, snapshot, field_path):
+        if field_path == "__name__":
+            return snapshot.reference.path
+        return _get_field(snapshot._data, field_path)
+
+    @staticmethod
+    def _matches_filter(data: dict, field_filter) -> bool:
+        # フィルター対象のフィールドを持たないドキュメントは一致しない
+        value = _get_field(data, field_filter.field_path)
+        if value is _MISSING:
+            return False
+        return _compare(value, field_filter.op_string, field_filter.value)
+
+    def _matches(self):
+        docs = []
+        documents = (
+            self._client._documents_in_group(self._collection_path)
+            if self._all_descendants
+            else self._client._documents_in(self._collection_path)
+        )
+        for ref, data in documents:
+            if all(self._matches_filter(data, f) for f in self._filters):
+                docs.append(DocumentSnapshot(ref, data))
+
+        # order_by の対象フィールドを持たないドキュメントは結果に含まれない
+        for field_path, _ in self._orders:
+            if field_path != "__name__":
+                docs = [
+                    d for d in docs if _get_field(d._data, field_path) is not _MISSING
+                ]
+
+        orders = self._orders or (("__name__", "ASCENDING"),)
+        for field_path, direction in reversed(orders):
+            docs.sort(
+                key=lambda d: self._sort_key(d, field_path),
+                reverse=direction == "DESCENDING",
+            )
+
+        if self._start_after is not None:
+            cursor = self._start_after
+            cursor_path = getattr(getattr(cursor, "reference", None), "path", None)
+            paths = [d.reference.path for d in docs]
+            if cursor_path in paths:
+                docs = docs[paths.index(cursor_path) + 1 :]
+            else:
+                docs = [d for d in docs if self._after_cursor(d, cursor, orders)]
+
+        if self._limit is not None:
+            docs = docs[: self._limit]
+        return docs
+
+    def _after_cursor(self, snapshot, cursor, orders) -> bool:
+        values = cursor.to_dict() if hasattr(cursor, "to_dict") else cursor
+        for field_path, direction in orders:
+            if field_path == "__name__":
+                left = snapshot.reference.path
+                right = getattr(getattr(cursor, "reference", None), "path", None)
+            else:
+                left = self._sort_key(snapshot, field_path)
+                right = _get_field(values, field_path)
+            if right is _MISSING or right is None or left == right:
+                continue
+            return left > right if direction == "ASCENDING" else left < right
+        return False
+
+    def _results(self) -> list:
+        with self._client._lock:
+            docs = self._matches()
+        results = []
+        for snapshot in docs:
+            data = snapshot._data
+            # 本物と同じく、空の射影はすべてのフィールドを返す
+            if self._projection:
+                data = {
+                    f: _get_field(data, f)
+                    for f in self._projection
+                    if _get_field(data, f) is not _MISSING
+                }
+            results.append(DocumentSnapshot(snapshot.reference, copy.deepcopy(data)))
+        return results
+
+    def stream(self, transaction=None):
+        results = self._results()
+        self._client._rpc(reads=max(1, len(results)))
+        yield from results
+
+    def get(self, transaction=None):
+        return list(self.stream(transaction=transaction))
+
+    def count(self, alias=None):
+        return _CountQuery(self, alias)
+
+
+class _AggregationResult:
+    def __init__(self, alias, value):
+        self.alias = alias
+        self.value = value
+
+
+class _CountQuery:
+    def __init__(self, query: Query, alias):
+        self._query = query
+        self._alias = alias or "count"
+
+    def get(self, transaction=None):
+        with self._query._client._lock:
+            count = len(self._query._matches())
+        # count 集計は 1000 件ごとに1読み取りとして課金される
+        self._query._client._rpc(reads=max(1, (count + 999) // 1000))
+        return [[_AggregationResult(self._alias, count)]]
+
+
+class CollectionReference(Query):
+    def __init__(self, client, path: str):
+        super().__init__(client, path)
+        self._path = path
+
+    @property
+    def id(self) -> str:
+        return self._path.rsplit("/", 1)[-1]
+
+    def document(self, document_id: str = None):
+        document_id = document_id or uuid.uuid4().hex
+        return DocumentReference(self._client, f"{self._path}/{document_id}")
+
+    def add(self, document_data: dict, document_id: str = None):
+        doc_ref = self.document(document_id)
+        doc_ref.create(document_data)
+        return None, doc_ref
+
+    def list_documents(self):
+        with self._client._lock:
+            refs = [ref for ref, _ in self._client._documents_in(self._path)]
+        self._client._rpc(reads=max(1, len(refs)))
+        return refs
+
+
+class _WriteOption:
+    """
+    client.write_option(last_update_time=...) の前提条件
+    """
+
+    def __init__(self, last_update_time):
+        self.last_update_time = last_update_time
+
+
+class WriteBatch:
+    def __init__(self, client):
+        self._client = client
+        self._writes = []
+
+    def set(self, reference, document_data, merge=False):
+        self._writes.append(("set", reference, document_data, merge))
+
+    def create(self, reference, document_data):
+        self._writes.append(("create", reference, document_data, False))
+
+    def update(self, reference, field_updates, option=None):
+        self._writes.append(("update", reference, field_updates, False, option))
+
+    def delete(self, reference):
+        self._writes.append(("delete", reference, None, False))
+
+    def commit(self):
+        if self._writes:
+            self._client._rpc()
+            self._client._write(self._writes)
+        self._writes = []
+
+    def __len__(self):
+        return len(self._writes)
+
+
+class BulkWriter(WriteBatch):
+    """
+    書き込みを溜め、flush 時に最大 500 件ずつのバッチで確定させる
+    """
+
+    MAX_BATCH_SIZE = 500
+
+    def flush(self):
+        writes, self._writes = self._writes, []
+        for i in range(0, len(writes), self.MAX_BATCH_SIZE):
+            self._client._rpc()
+            self._client._write(writes[i : i + self.MAX_BATCH_SIZE])
+
+    def close(self):
+        self.flush()
+
+    commit = flush
+
+
+class Transaction(WriteBatch):
+    """
+    楽観的排他のトランザクション。読み取ったドキュメントがコミットまでに
+    更新されていれば Aborted を送出し、firestore.transactional により再試行される
+    """
+
+    def __init__(self, client, max_attempts=5, read_only=False):
+        super().__init__(client)
+        self._max_attempts = max_attempts
+        self._read_only = read_only
+        self._id = None
+        self._read_versions = {}
+
+    @property
+    def in_progress(self):
+        return self._id is not None
+
+    def _clean_up(self):
+        self._writes = []
+        self._read_versions = {}
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self._client._rpc()
+        self._id = uuid.uuid4().bytes
+
+    def _rollback(self):
+        if self._id is not None:
+            self._client._rpc()
+        self._clean_up()
+
+    def _commit(self):
+        self._client._rpc()
+        with self._client._lock:
+            for path, version in self._read_versions.items():
+                if self._client._versions.get(path, 0) != version:
+                    raise Aborted("document changed during transaction")
+            self._client._write(self._writes)
+        self._clean_up()
+        return []
+
+    def get(self, ref_or_query, field_paths=None):
+        if isinstance(ref_or_query, Query):
+            docs = list(ref_or_query.stream())
+            for doc in docs:
+                self._track(doc.reference)
+            return iter(docs)
+        self._client._rpc(reads=1)
+        self._track(ref_or_query)
+        return self._client._snapshot(ref_or_query, field_paths)
+
+    def get_all(self, references, field_paths=None):
+        references = list(references)
+        self._client._rpc(reads=len(references))
+        for ref in references:
+            self._track(ref)
+            yield self._client._snapshot(ref, field_paths)
+
+    def _track(self, ref):
+        with self._client._lock:
+            self._read_versions.setdefault(
+                ref.path, self._client._versions.get(ref.path, 0)
+            )
+
+
+class _Watch:
+    def __init__(self, client, ref, callback):
+        self._client = client
+        self._ref = ref
+        self._callback = callback
+
+    def unsubscribe(self):
+        self._client._unwatch(self)
+
+
+class FakeClient:
+    """
+    firestore.Client の代わりに使うインメモリクライアント
+
+    latency: 往復 (RPC) ごとに挟む遅延秒数
+    """
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.stats = FirestoreStats()
+        self._documents = {}
+        self._versions = {}
+        self._watches = []
+        self._lock = threading.RLock()
+
+    # --- firestore.Client 互換 API ---
+
+    def collection(self, collection_path: str):
+        return CollectionReference(self, collection_path)
+
+    def collection_group(self, collection_id: str):
+        return Query(self, collection_id, all_descendants=True)
+
+    def document(self, document_path: str):
+        return DocumentReference(self, document_path)
+
+    def get_all(self, references, field_paths=None, transaction=None):
+        if transaction is not None:
+            yield from transaction.get_all(references, field_paths=field_paths)
+            return
+        references = list(references)
+        self._rpc(reads=len(references))
+        for ref in references:
+            yield self._snapshot(ref, field_paths)
+
+    def batch(self):
+        return WriteBatch(self)
+
+    def write_option(self, last_update_time=None):
+        return _WriteOption(last_update_time)
+
+    def bulk_writer(self, options=None):
+        return BulkWriter(self)
+
+    def transaction(self, max_attempts=5, read_only=False):
+        return Transaction(self, max_attempts=max_attempts, read_only=read_only)
+
+    # --- テスト・ベンチマーク用のヘルパー ---
+
+    def dump(self) -> dict:
+        with self._lock:
+            return copy.deepcopy(self._documents)
+
+    # --- 内部実装 ---
+
+    def _rpc(self, reads=0, writes=0, deletes=0):
+        self.stats.add(round_trips=1, reads=reads, writes=writes, deletes=deletes)
+        if self.latency:
+            time.sleep(self.latency)
+
+    def _documents_in(self, collection_path: str):
+        prefix = collection_path + "/"
+        for path, data in list(self._documents.items()):
+            rest = path[len(prefix) :]
+            if path.startswith(prefix) and "/" not in rest:
+                yield DocumentReference(self, path), data
+
+    def _documents_in_group(self, collection_id: str):
+        """
+        階層に関係なく、ID が collection_id のコレクションのドキュメント
+        """
+        for path, data in list(self._documents.items()):
+            parts = path.split("/")
+            if parts[-2] == collection_id:
+                yield DocumentReference(self, path), data
+
+    def _snapshot(self, ref, field_paths=None):
+        with self._lock:
+            data = self._documents.get(ref.path)
+            if data is not None and field_paths is not None:
+                data = {
+                    f: _get_field(data, f)
+                    for f in field_paths
+                    if _get_field(data, f) is not _MISSING
+                }
+            return DocumentSnapshot(
+                ref, copy.deepcopy(data), self._versions.get(ref.path)
+            )
+
+    def _write(self, writes):
+        changed = []
+        with self._lock:
+            # 全件を検証してから適用し、バッチ全体をアトミックにする
+            staged = {}
+            for op, ref, data, merge, *option in writes:
+                current = staged.get(ref.path, self._documents.get(ref.path))
+                if option and option[0] is not None:
+                    if self._versions.get(ref.path) != option[0].last_update_time:
+                        raise FailedPrecondition(f"document was updated: {ref.path}")
+                if op == "create" and current is not None:
+                    raise AlreadyExists(f"document already exists: {ref.path}")
+                if op == "update" and current is None:
+                    raise NotFound(f"no document to update: {ref.path}")
+                if op == "delete":
+                    staged[ref.path] = None
+                    continue
+                document = (
+                    copy.deepcopy(current)
+                    if current is not None and (merge or op == "update")
+                    else {}
+                )
+                if op == "update":
+                    for field_path, value in data.items():
+                        _apply_value(document, field_path, value)
+                elif merge:
+                    _merge(document, data)
+                else:
+                    for key, value in data.items():
+                        _apply_value(document, key, value)
+                staged[ref.path] = document
+
+            for path, document in staged.items():
+                if document is None:
+                    self._documents.pop(path, None)
+                    self.stats.add(deletes=1)
+                else:
+                    self._documents[path] = document
+                    self.stats.add(writes=1)
+                self._versions[path] = self._versions.get(path, 0) + 1
+                changed.append(path)
+            watches = [w for w in self._watches if w._ref.path in changed]
+
+        for watch in watches:
+            self._notify(watch)
+
+    def _watch(self, ref, callback):
+        watch = _Watch(self, ref, callback)
+        with self._lock:
+            self._watches.append(watch)
+        self._notify(watch)
+        return watch
+
+    def _unwatch(self, watch):
+        with self._lock:
+            if watch in self._watches:
+                self._watches.remove(watch)
+
+    def _notify(self, watch):
+        snapshot = self._snapshot(watch._ref)
+        self.stats.add(reads=1)
+        watch._callback([snapshot], [], datetime.now(timezone.utc))
+
+
+# --- 非同期クライアント (firestore.AsyncClient 互換) ---
+
+
+class AsyncDocumentReference:
+    def __init__(self, client, path: str):
+        self._client = client
+        self._ref = DocumentReference(client._sync, path)
+
+    @property
+    def id(self) -> str:
+        return self._ref.id
+
+    @property
+    def path(self) -> str:
+        return self._ref.path
+
+    async def get(self, field_paths=None):
+        await self._client._rpc(reads=1)
+        return self._client._sync._snapshot(self._ref, field_paths)
+
+    async def set(self, document_data: dict, merge=False):
+        await self._client._rpc()
+        self._client._sync._write([("set", self._ref, document_data, merge)])
+
+    async def create(self, document_data: dict):
+        await self._client._rpc()
+        self._client._sync._write([("create", self._ref, document_data, False)])
+
+    async def update(self, field_updates: dict):
+        await self._client._rpc()
+        self._client._sync._write([("update", self._ref, field_updates, False)])
+
+    async def delete(self):
+        await self._client._rpc()
+        self._client._sync._write([("delete", self._ref, None, False)])
+
+
+class AsyncQuery:
+    def __init__(self, client, query: Query):
+        self._client = client
+        self._query = query
+
+    def where(self, *args, **kwargs):
+        return AsyncQuery(self._client, self._query.where(*args, **kwargs))
+
+    def order_by(self, *args, **kwargs):
+        return AsyncQuery(self._client, self._query.order_by(*args, **kwargs))
+
+    def limit(self, count: int):
+        return AsyncQuery(self._client, self._query.limit(count))
+
+    def start_after(self, document_fields_or_snapshot):
+        return AsyncQuery(
+            self._client, self._query.start_after(document_fields_or_snapshot)
+        )
+
+    def select(self, field_paths):
+        return AsyncQuery(self._client, self._query.select(field_paths))
+
+    async def stream(self, transaction=None):
+        results = self._query._results()
+        await self._client._rpc(reads=max(1, len(results)))
+        for snapshot in results:
+            yield snapshot
+
+    async def get(self, transaction=None):
+        return [snapshot async for snapshot in self.stream()]
+
+
+class AsyncCollectionReference(AsyncQuery):
+    def __init__(self, client, path: str):
+        super().__init__(client, CollectionReference(client._sync, path))
+        self._path = path
+
+    @property
+    def id(self) -> str:
+        return self._path.rsplit("/", 1)[-1]
+
+    def document(self, document_id: str = None):
+        document_id = document_id or uuid.uuid4().hex
+        return AsyncDocumentReference(self._client, f"{self._path}/{document_id}")
+
+
+class AsyncFakeClient:
+    """
+    firestore.AsyncClient の代わりに使うクライアント。FakeClient とデータ・統計を共有する
+    """
+
+    def __init__(self, client: FakeClient):
+        self._sync = client
+
+    @property
+    def stats(self) -> FirestoreStats:
+        return self._sync.stats
+
+    def collection(self, collection_path: str):
+        return AsyncCollectionReference(self, collection_path)
+
+    def document(self, document_path: str):
+        return AsyncDocumentReference(self, document_path)
+
+    async def get_all(self, references, field_paths=None, transaction=None):
+        references = list(references)
+        await self._rpc(reads=len(references))
+        for ref in references:
+            yield self._sync._snapshot(ref._ref, field_paths)
+
+    async def _rpc(self, reads=0):
+        self._sync.stats.add(round_trips=1, reads=reads)
+        if self._sync.latency:
+            await asyncio.sleep(self._sync.latency)
@@ -0,0 +1,157 @@
+"""
+ハンドラーごとのマイクロベンチマーク
+
+記録済みのリクエストエンベロープ (benchmarks/envelopes) を
+lambda_function.handler に流し、インメモリ Firestore (firestore_fake) に対する
+1リクエストあたりの実行時間と Firestore の往復・読み取り・書き込み数を出力します。
+
+    python benchmarks/handlers.py [--runs 50] [--latency 0.005] [--json out.json]
+
+--briefings では既存ユーザーとして登録し、ブリーフィングを作成してから流します。
+"""
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import statistics
+import sys
+import time
+from datetime import datetime, timedelta, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "lambda"))
+ENVELOPE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "envelopes")
+
+import clients  # noqa: E402
+from firestore_fake import AsyncFakeClient, FakeClient  # noqa: E402
+from news import News  # noqa: E402
+
+# Launch → Question → Answer → Answer → News の順に1ユーザーずつ、1つのセッションとして流す
+SCENARIO = ["launch", "next", "question", "answer", "answer", "news", "skip"]
+
+
+def load_envelope(name: str) -> dict:
+    with open(os.path.join(ENVELOPE_DIR, f"{name}.json"), encoding="utf-8") as f:
+        return json.load(f)
+
+
+def envelope_for(template: dict, user_id: str) -> dict:
+    event = copy.deepcopy(template)
+    event["session"]["user"]["userId"] = user_id
+    event["context"]["System"]["user"]["userId"] = user_id
+    return event
+
+
+def seed_news(db):
+    now = datetime.now(timezone.utc)
+    for language_code in ("ja", "en"):
+        for days in range(3):
+            News(
+                # 複数のセグメントに分かれる長さにする
+                content="".join(
+                    f"{language_code} news {days} part {part}: {'x' * 150}。"
+                    for part in range(4)
+                ),
+                sample_question="AIエージェント関連のニュースは？",
+                keyword="AI",
+                language_code=language_code,
+                published=now - timedelta(days=days),
+            ).save(db)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    index = min(len(values) - 1, int(round(q * (len(values) - 1))))
+    return values[index]
+
+
+def seed_briefings(db, runs: int):
+    from maintenance import build_briefings
+    from user import User
+
+    now = datetime.now(timezone.utc)
+    for i in range(runs):
+        User(f"amzn1.ask.account.BENCH_{i}", language_code="ja", last_active=now).save(
+            User.collection(db)
+        )
+    build_briefings(db)
+
+
+def run(runs: int, latency: float, briefings: bool = False) -> dict:
+    db = FakeClient(latency=latency)
+    clients.set_db(db)
+    clients.set_async_db(AsyncFakeClient(db))
+    seed_news(db)
+    if briefings:
+        seed_briefings(db, runs)
+
+    import lambda_function
+
+    templates = {name: load_envelope(name) for name in SCENARIO}
+    steps = [
+        f"{name}#{SCENARIO[:i].count(name) + 1}" for i, name in enumerate(SCENARIO)
+    ]
+    samples = {step: [] for step in steps}
+
+    for i in range(runs):
+        user_id = f"amzn1.ask.account.BENCH_{i}"
+        attributes = {}
+        for name, step in zip(SCENARIO, steps):
+            event = envelope_for(templates[name], user_id)
+            # Alexa と同じく、前のレスポンスのセッション属性を次のリクエストに載せる
+            if not event["session"]["new"]:
+                event["session"]["attributes"] = attributes
+            db.stats.reset()
+            start = time.perf_counter()
+            # EMF のメトリクス行は集計に不要なので捨てる
+            with contextlib.redirect_stdout(io.StringIO()):
+                response = lambda_function.handler(event, None)
+            elapsed_ms = (time.perf_counter() - start) * 1000
+            samples[step].append(dict(db.stats.snapshot(), ms=elapsed_ms))
+            attributes = response.get("sessionAttributes") or {}
+
+    report = {}
+    for name, rows in samples.items():
+        report[name] = {
+            "p50_ms": statistics.median(r["ms"] for r in rows),
+            "p95_ms": percentile([r["ms"] for r in rows], 0.95),
+            "round_trips": statistics.mean(r["round_trips"] for r in rows),
+            "reads": statistics.mean(r["reads"] for r in rows),
+            "writes": statistics.mean(r["writes"] + r["deletes"] for r in rows),
+        }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=50)
+    parser.add_argument(
+        "--latency", type=float, default=0.0, help="往復ごとに挟む遅延秒数"
+    )
+    parser.add_argument(
+        "--briefings", action="store_true", help="ブリーフィングを作成してから流す"
+    )
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    report = run(args.runs, args.latency, args.briefings)
+
+    print(
+        f"{'handler':<12}{'p50 ms':>10}{'p95 ms':>10}{'RTT/req':>10}{'reads/req':>11}{'writes/req':>12}"
+    )
+    for name, row in report.items():
+        print(
+            f"{name:<12}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+            f"{row['round_trips']:>10.2f}{row['reads']:>11.2f}{row['writes']:>12.2f}"
+        )
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
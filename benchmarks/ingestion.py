@@ -0,0 +1,111 @@
+"""
+ニュース収集パイプラインのベンチマーク
+
+合成したフィードを擬似的な通信遅延付きで取得し、取得・クラスタリング・
+ニュース作成の処理速度 (articles/sec) を出力します。
+
+    python benchmarks/ingestion.py [--sources 40] [--articles 50] [--latency 0.05]
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "lambda"))
+
+from ingestion import Article, build_news, cluster_articles, fetch_all  # noqa: E402
+
+STORIES = [
+    "OpenAIが新しいAIエージェント基盤を発表",
+    "IBMが量子コンピュータ向け新チップを公開",
+    "Rust 2024エディションが正式リリース",
+    "国内クラウド市場が前年比2割増",
+    "GoogleがGeminiの新モデルを公開",
+    "AppleがiPadの新モデルを発表",
+]
+
+
+class SyntheticFetcher:
+    """
+    既知のニュースの言い換えと、ソース固有の記事を混ぜたフィードを返す
+    """
+
+    def __init__(self, articles_per_source: int, latency: float, seed: int = 0):
+        self.articles_per_source = articles_per_source
+        self.latency = latency
+        self.random = random.Random(seed)
+
+    def _random_text(self, length: int) -> str:
+        return "".join(chr(self.random.randint(0x4E00, 0x9FFF)) for _ in range(length))
+
+    async def fetch(self, source: dict) -> list:
+        await asyncio.sleep(self.latency)
+        articles = []
+        for i in range(self.articles_per_source):
+            if self.random.random() < 0.3:
+                story = self.random.choice(STORIES)
+                title = story + self.random.choice(["", "した", "しました", "へ"])
+                summary = f"{story}と各社が報じた。"
+            else:
+                # ソース固有の記事は、ランダムな漢字列で互いに似ないようにする
+                title = self._random_text(16)
+                summary = self._random_text(40)
+            articles.append(
+                Article(
+                    source=source["name"],
+                    title=title,
+                    summary=summary,
+                    url=f"{source['url']}/{i}",
+                    language_code=source["language_code"],
+                )
+            )
+        return articles
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sources", type=int, default=40)
+    parser.add_argument("--articles", type=int, default=50, help="ソースごとの記事数")
+    parser.add_argument("--hosts", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.05)
+    args = parser.parse_args()
+
+    sources = [
+        {
+            "name": f"source{i}",
+            "url": f"https://host{i % args.hosts}.example.com/feed{i}",
+            "language_code": "ja",
+        }
+        for i in range(args.sources)
+    ]
+    fetcher = SyntheticFetcher(args.articles, args.latency)
+
+    start = time.perf_counter()
+    articles = asyncio.run(fetch_all(sources, fetcher))
+    fetched = time.perf_counter()
+    clusters = cluster_articles(articles)
+    clustered = time.perf_counter()
+    news = build_news("ja", clusters)
+    built = time.perf_counter()
+
+    total = len(articles)
+    print(f"articles:   {total}")
+    print(f"clusters:   {len(clusters)}")
+    print(
+        f"fetch:      {fetched - start:.3f}s ({total / (fetched - start):.0f} articles/sec)"
+    )
+    print(
+        f"cluster:    {clustered - fetched:.3f}s ({total / (clustered - fetched):.0f} articles/sec)"
+    )
+    print(f"build:      {built - clustered:.3f}s")
+    print(f"end-to-end: {total / (built - start):.0f} articles/sec")
+    print(f"keyword:    {news.keyword if news else '-'}")
+    print(f"sample:     {news.sample_question if news else '-'}")
+
+
+if __name__ == "__main__":
+    main()
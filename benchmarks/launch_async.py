@@ -0,0 +1,89 @@
+"""
+LaunchRequest の同期版と非同期版の比較
+
+往復ごとに遅延を挟んだインメモリ Firestore に対して、AlexaHandler.play_news
+(読み取りを順に行う) と play_news_async (並行に行う) の実行時間を比べます。
+ニュースのコンテナ内キャッシュが空の場合 (コールドスタート直後) と
+キャッシュ済みの場合をそれぞれ計測します。
+
+    python benchmarks/launch_async.py [--runs 30] [--latency 0.02]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "lambda"))
+
+from alexa_handler import AlexaHandler  # noqa: E402
+from firestore_fake import AsyncFakeClient, FakeClient  # noqa: E402
+from handlers import seed_news  # noqa: E402
+from news import News  # noqa: E402
+from user import User  # noqa: E402
+
+
+def seed_users(db, count: int):
+    for i in range(count):
+        user = User(f"bench-{i}", language_code="ja")
+        user.save(User.collection(db))
+        user.submit_question(db, "AIエージェント関連のニュースは？")
+
+
+def measure(db, variant: str, runs: int, cold: bool) -> dict:
+    loop = asyncio.new_event_loop()
+    rows = []
+    for i in range(runs):
+        if cold:
+            News.clear_cache()
+        db.stats.reset()
+        start = time.perf_counter()
+        if variant == "sync":
+            AlexaHandler.play_news(f"bench-{i}", "ja", db, session={})
+        else:
+            loop.run_until_complete(
+                AlexaHandler.play_news_async(
+                    f"bench-{i}", "ja", AsyncFakeClient(db), session={}
+                )
+            )
+        rows.append(
+            {
+                "ms": (time.perf_counter() - start) * 1000,
+                "round_trips": db.stats.round_trips,
+            }
+        )
+    loop.close()
+    return {
+        "p50_ms": statistics.median(r["ms"] for r in rows),
+        "round_trips": statistics.mean(r["round_trips"] for r in rows),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=30)
+    parser.add_argument(
+        "--latency", type=float, default=0.02, help="往復ごとに挟む遅延秒数"
+    )
+    args = parser.parse_args()
+
+    db = FakeClient()
+    seed_news(db)
+    seed_users(db, args.runs)
+    db.latency = args.latency
+
+    print(f"{'cache':<8}{'variant':<8}{'p50 ms':>10}{'RTT/req':>10}")
+    for cold in (True, False):
+        for variant in ("sync", "async"):
+            row = measure(db, variant, args.runs, cold)
+            print(
+                f"{'cold' if cold else 'warm':<8}{variant:<8}"
+                f"{row['p50_ms']:>10.2f}{row['round_trips']:>10.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""
+複数ユーザーの同時アクセスを再現する負荷試験
+
+多数の仮想ユーザーが、それぞれ2台のデバイスから Launch / Question / Answer の
+エンベロープを並行に lambda_function.handler へ流し、その間に回答作成ワーカーが
+質問の状態を進めます。すべてインプロセスのインメモリ Firestore (firestore_fake)
+に対して実行し、スループット・レイテンシ (p50/p95/p99)・1リクエストあたりの
+Firestore 操作数を出力します。
+
+あわせて、Firestore への書き込みをすべて検査し、次の不変条件を確認します。
+
+    quota             : daily_usage の各日のカウンターが DAILY_QUESTION_LIMIT を超えない
+    answered_regress  : 同じ質問が ANSWERED から IN_PROGRESS に戻らない
+    status_regress    : 同じ質問の状態が IN_PROGRESS → READY → ANSWERED の順に逆行しない
+    lost_question     : 回答作成中の質問が、別の質問で上書きされない
+
+違反があれば終了コード 1 で終わります。
+
+    python benchmarks/load.py [--users 2000] [--threads 64] [--latency 0.001]
+"""
+
+import argparse
+import contextlib
+import copy
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "lambda"))
+
+import clients  # noqa: E402
+from answer_worker import AnswerWorker  # noqa: E402
+from firestore_fake import AsyncFakeClient, FakeClient  # noqa: E402
+from handlers import load_envelope, percentile, seed_news  # noqa: E402
+from llm import StubLLM  # noqa: E402
+from question import ANSWER_STATUS  # noqa: E402
+from semantic_cache import SemanticCache  # noqa: E402
+from user import DAILY_QUESTION_LIMIT  # noqa: E402
+
+# 1台のデバイスが1セッションで送るリクエスト
+DEVICE_SCRIPT = [
+    "launch",
+    "question",
+    "answer",
+    "question",
+    "answer",
+    "answer",
+    "question",
+    "answer",
+]
+DEVICES_PER_USER = 2
+QUESTIONS = [
+    "AIエージェント関連のニュースはありますか",
+    "量子コンピュータの話題は？",
+    "半導体の最新動向を教えて",
+    "セキュリティのニュースは？",
+    "クラウドの値上げについて教えて",
+]
+STATUS_ORDER = {
+    ANSWER_STATUS["IN_PROGRESS"]: 0,
+    ANSWER_STATUS["READY"]: 1,
+    ANSWER_STATUS["ANSWERED"]: 2,
+}
+
+
+class Auditor:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.violations = Counter()
+        self.examples = {}
+
+    def violation(self, kind: str, detail: str):
+        with self._lock:
+            self.violations[kind] += 1
+            self.examples.setdefault(kind, detail)
+
+    @staticmethod
+    def _identity(question: dict):
+        return question.get("question_text"), str(question.get("created"))
+
+    def check(self, path: str, before: dict, after: dict):
+        collection, _, doc_id = path.partition("/")
+        if collection == "users" and after:
+            for key, count in (after.get("daily_usage") or {}).items():
+                if count > DAILY_QUESTION_LIMIT:
+                    self.violation("quota", f"{doc_id} {key}={count}")
+        if collection != "questions" or not before or not after:
+            return
+
+        old, new = before.get("answer_status"), after.get("answer_status")
+        if self._identity(before) == self._identity(after):
+            if old == ANSWER_STATUS["ANSWERED"] and new == ANSWER_STATUS["IN_PROGRESS"]:
+                self.violation("answered_regress", f"{doc_id} {old} -> {new}")
+            if (
+                old in STATUS_ORDER
+                and new in STATUS_ORDER
+                and STATUS_ORDER[new] < STATUS_ORDER[old]
+            ):
+                self.violation("status_regress", f"{doc_id} {old} -> {new}")
+        elif old == ANSWER_STATUS["IN_PROGRESS"]:
+            self.violation(
+                "lost_question",
+                f"{doc_id} {before.get('question_text')!r} -> "
+                f"{after.get('question_text')!r} ({new})",
+            )
+
+
+class AuditingClient(FakeClient):
+    """
+    書き込みの前後のドキュメントを Auditor に渡す FakeClient
+    """
+
+    def __init__(self, auditor: Auditor, latency: float = 0.0):
+        super().__init__(latency=latency)
+        self.auditor = auditor
+
+    def _write(self, writes):
+        with self._lock:
+            paths = {ref.path for _, ref, _, _ in writes}
+            before = {path: copy.deepcopy(self._documents.get(path)) for path in paths}
+            super()._write(writes)
+            for path in paths:
+                self.auditor.check(path, before[path], self._documents.get(path))
+
+
+class Device:
+    """
+    1台のデバイス。セッション属性を引き継ぎながらスクリプトを順に送る
+    """
+
+    def __init__(self, user_id: str, index: int, templates: dict, rng: random.Random):
+        self.user_id = user_id
+        self.session_id = f"amzn1.echo-api.session.{user_id}.{index}"
+        self.templates = templates
+        self.rng = rng
+        self.attributes = {}
+        self.sequence = 0
+
+    def envelope(self, name: str) -> dict:
+        event = copy.deepcopy(self.templates[name])
+        self.sequence += 1
+        event["session"]["sessionId"] = self.session_id
+        event["session"]["user"]["userId"] = self.user_id
+        event["context"]["System"]["user"]["userId"] = self.user_id
+        event["request"]["requestId"] = f"{self.session_id}.{self.sequence}"
+        if not event["session"]["new"]:
+            event["session"]["attributes"] = self.attributes
+        if name == "question":
+            slot = event["request"]["intent"]["slots"]["Query"]
+            slot["value"] = self.rng.choice(QUESTIONS)
+        return event
+
+
+def run_device(handler, device: Device, think_seconds: float) -> list:
+    rows = []
+    for name in DEVICE_SCRIPT:
+        event = device.envelope(name)
+        start = time.perf_counter()
+        response = handler(event, None)
+        rows.append(
+            {
+                "name": name,
+                "user_id": device.user_id,
+                "request_id": event["request"]["requestId"],
+                "ms": (time.perf_counter() - start) * 1000,
+                "speech": response["response"]["outputSpeech"]["ssml"],
+            }
+        )
+        device.attributes = response.get("sessionAttributes") or {}
+        if think_seconds:
+            time.sleep(device.rng.uniform(0, think_seconds))
+    return rows
+
+
+def run_worker(db, stop: threading.Event, stats: Counter):
+    worker = AnswerWorker(db, StubLLM(latency=0.005), answer_cache=SemanticCache())
+    while not stop.is_set():
+        result = worker.run()
+        stats.update(result)
+        if not result["questions"]:
+            stop.wait(0.01)
+    stats.update(worker.run())
+
+
+def run(users: int, threads: int, latency: float, think: float, seed: int) -> dict:
+    auditor = Auditor()
+    db = AuditingClient(auditor)
+    seed_news(db)
+    db.latency = latency
+    clients.set_db(db)
+    clients.set_async_db(AsyncFakeClient(db))
+
+    import lambda_function
+
+    templates = {name: load_envelope(name) for name in set(DEVICE_SCRIPT)}
+    rng = random.Random(seed)
+    order = list(range(users))
+    rng.shuffle(order)
+    # 同じユーザーのデバイスを並べて投入し、同時に処理されるようにする
+    devices = [
+        Device(f"amzn1.ask.account.LOAD_{u}", d, templates, random.Random(rng.random()))
+        for u in order
+        for d in range(DEVICES_PER_USER)
+    ]
+
+    stop = threading.Event()
+    worker_stats = Counter()
+    worker = threading.Thread(target=run_worker, args=(db, stop, worker_stats))
+    emf = io.StringIO()
+
+    started = time.perf_counter()
+    # EMF のメトリクス行はリクエストごとの Firestore 操作数の集計に使う
+    with contextlib.redirect_stdout(emf):
+        worker.start()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            results = list(
+                executor.map(
+                    lambda device: run_device(lambda_function.handler, device, think),
+                    devices,
+                )
+            )
+        elapsed = time.perf_counter() - started
+        stop.set()
+        worker.join()
+
+    rows = [row for device_rows in results for row in device_rows]
+    metrics = {}
+    for line in emf.getvalue().splitlines():
+        if line.startswith("{"):
+            record = json.loads(line)
+            metrics[record.get("RequestId")] = record
+
+    # 応答から見た受付件数も上限以内であること (同じ日の中で実行する前提)
+    accepted = Counter(
+        row["user_id"] for row in rows if "質問を受け付けました" in row["speech"]
+    )
+    for user_id, count in accepted.items():
+        if count > DAILY_QUESTION_LIMIT:
+            auditor.violation("quota", f"{user_id} accepted {count}")
+    for path, document in db.dump().items():
+        if path.startswith("users/"):
+            auditor.check(path, None, document)
+
+    latencies = [row["ms"] for row in rows]
+    by_name = {}
+    for row in rows:
+        record = metrics.get(row["request_id"], {})
+        entry = by_name.setdefault(row["name"], {"ms": [], "reads": [], "writes": []})
+        entry["ms"].append(row["ms"])
+        entry["reads"].append(record.get("FirestoreReads", 0))
+        entry["writes"].append(record.get("FirestoreWrites", 0))
+
+    return {
+        "requests": len(rows),
+        "seconds": elapsed,
+        "throughput": len(rows) / elapsed,
+        "p50_ms": percentile(latencies, 0.50),
+        "p95_ms": percentile(latencies, 0.95),
+        "p99_ms": percentile(latencies, 0.99),
+        "by_intent": {
+            name: {
+                "p50_ms": percentile(entry["ms"], 0.50),
+                "p99_ms": percentile(entry["ms"], 0.99),
+                "reads": statistics.mean(entry["reads"]),
+                "writes": statistics.mean(entry["writes"]),
+            }
+            for name, entry in by_name.items()
+        },
+        "accepted_questions": sum(accepted.values()),
+        "worker": dict(worker_stats),
+        "errors": sum(1 for r in metrics.values() if r.get("Error")),
+        "violations": dict(auditor.violations),
+        "examples": auditor.examples,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=2000)
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument(
+        "--latency", type=float, default=0.001, help="往復ごとに挟む遅延秒数"
+    )
+    parser.add_argument(
+        "--think", type=float, default=0.2, help="リクエスト間の最大待ち秒数"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="結果をJSONで保存するパス")
+    args = parser.parse_args()
+
+    report = run(args.users, args.threads, args.latency, args.think, args.seed)
+
+    print(
+        f"{report['requests']} requests in {report['seconds']:.1f}s "
+        f"({report['throughput']:.0f} req/s), errors: {report['errors']}"
+    )
+    print(
+        f"latency p50 {report['p50_ms']:.2f} ms, p95 {report['p95_ms']:.2f} ms, "
+        f"p99 {report['p99_ms']:.2f} ms"
+    )
+    print(f"{'intent':<10}{'p50 ms':>10}{'p99 ms':>10}{'reads':>8}{'writes':>8}")
+    for name, row in report["by_intent"].items():
+        print(
+            f"{name:<10}{row['p50_ms']:>10.2f}{row['p99_ms']:>10.2f}"
+            f"{row['reads']:>8.2f}{row['writes']:>8.2f}"
+        )
+    print(
+        f"accepted questions: {report['accepted_questions']}, worker: {report['worker']}"
+    )
+    if report["violations"]:
+        print("INVARIANT VIOLATIONS:")
+        for kind, count in report["violations"].items():
+            print(f"  {kind}: {count} (e.g. {report['examples'][kind]})")
+    else:
+        print("invariants: ok")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    sys.exit(1 if report["violations"] else 0)
+
+
+if __name__ == "__main__":
+    main()
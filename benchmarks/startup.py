@@ -0,0 +1,92 @@
+"""
+コールドスタートのベンチマーク
+
+ハンドラーごとに新しいPythonプロセスを起動し、lambda_function の import 時間と
+最初のレスポンスまでの時間を計測します。
+
+    python benchmarks/startup.py [--runs 5] [--handlers launch help ...] [--warmup]
+
+--warmup を付けると、ハンドラーの前にウォームアップの呼び出し (envelopes/warmup.json)
+を1回処理し、その後の最初のレスポンスまでの時間を計測します。
+
+Firestoreを使うハンドラー (launch / question / answer / news) は
+SERVICE_ACCOUNT_KEY が設定された環境で実行してください。
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAMBDA_DIR = os.path.join(ROOT, "lambda")
+ENVELOPE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "envelopes")
+
+HANDLERS = [
+    "launch",
+    "question",
+    "answer",
+    "news",
+    "next",
+    "skip",
+    "help",
+    "stop",
+    "session_ended",
+]
+
+# 子プロセスで実行する計測コード
+PROBE = """
+import json, sys, time
+t0 = time.perf_counter()
+import lambda_function
+t1 = time.perf_counter()
+with open(sys.argv[1], encoding="utf-8") as f:
+    event = json.load(f)
+if len(sys.argv) > 2:
+    with open(sys.argv[2], encoding="utf-8") as f:
+        lambda_function.handler(json.load(f), None)
+    t1 = time.perf_counter()
+lambda_function.handler(event, None)
+t2 = time.perf_counter()
+heavy = [m for m in ("google.generativeai", "firebase_admin", "google.cloud.firestore", "numpy") if m in sys.modules]
+print(json.dumps({"import_ms": (t1 - t0) * 1000, "first_response_ms": (t2 - t1) * 1000, "heavy_modules": heavy}))
+"""
+
+
+def run_once(name: str, warmup: bool = False) -> dict:
+    envelope = os.path.join(ENVELOPE_DIR, f"{name}.json")
+    args = [envelope]
+    if warmup:
+        args.append(os.path.join(ENVELOPE_DIR, "warmup.json"))
+    result = subprocess.run(
+        [sys.executable, "-c", PROBE, *args],
+        cwd=LAMBDA_DIR,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--handlers", nargs="+", default=HANDLERS, choices=HANDLERS)
+    parser.add_argument(
+        "--warmup", action="store_true", help="先にウォームアップの呼び出しを処理する"
+    )
+    args = parser.parse_args()
+
+    print(f"{'handler':<15}{'import ms':>12}{'first resp ms':>16}  heavy modules")
+    for name in args.handlers:
+        samples = [run_once(name, args.warmup) for _ in range(args.runs)]
+        import_ms = statistics.median(s["import_ms"] for s in samples)
+        response_ms = statistics.median(s["first_response_ms"] for s in samples)
+        heavy = ",".join(samples[-1]["heavy_modules"]) or "-"
+        print(f"{name:<15}{import_ms:>12.1f}{response_ms:>16.1f}  {heavy}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+"""
+トレースの集計
+
+tracing が書き出したスパン (JSON Lines) を読み、スパン名ごとの所要時間の分布と、
+質問を受け付けてから回答ができあがるまで (question.ready)・ユーザーが回答を
+聞くまで (question.delivered) の分布を出力します。
+
+    python benchmarks/traces.py --file /tmp/traces.jsonl   # 出力済みのスパンを集計
+    python benchmarks/traces.py [--users 20] [--latency 0.005] [--llm-latency 0.5]
+
+--file を省略した場合は、インメモリ Firestore とスタブ LLM で Launch → Question →
+(回答作成ワーカー) → Answer を流し、その間のスパンを集計します。
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import statistics
+import sys
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "lambda"))
+
+import clients  # noqa: E402
+import tracing  # noqa: E402
+from answer_worker import AnswerWorker  # noqa: E402
+from firestore_fake import AsyncFakeClient, FakeClient  # noqa: E402
+from handlers import envelope_for, load_envelope, percentile, seed_news  # noqa: E402
+from llm import StubLLM  # noqa: E402
+from semantic_cache import SemanticCache  # noqa: E402
+
+
+def load_records(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.startswith("{")]
+
+
+def simulate(users: int, latency: float, llm_latency: float) -> list:
+    exporter = tracing.MemoryExporter()
+    tracing.set_exporter(exporter)
+
+    db = FakeClient()
+    seed_news(db)
+    db.latency = latency
+    clients.set_db(db)
+    clients.set_async_db(AsyncFakeClient(db))
+
+    import lambda_function
+
+    def send(name: str, user_id: str, attributes: dict) -> dict:
+        event = envelope_for(load_envelope(name), user_id)
+        if not event["session"]["new"]:
+            event["session"]["attributes"] = attributes
+        # EMF のメトリクス行は集計に不要なので捨てる
+        with contextlib.redirect_stdout(io.StringIO()):
+            response = lambda_function.handler(event, None)
+        return response.get("sessionAttributes") or {}
+
+    sessions = {}
+    for i in range(users):
+        user_id = f"amzn1.ask.account.TRACE_{i}"
+        attributes = send("launch", user_id, {})
+        sessions[user_id] = send("question", user_id, attributes)
+
+    worker = AnswerWorker(
+        clients.get_db(), StubLLM(latency=llm_latency), answer_cache=SemanticCache()
+    )
+    worker.run()
+
+    for user_id, attributes in sessions.items():
+        send("answer", user_id, attributes)
+
+    tracing.set_exporter(None)
+    return exporter.records
+
+
+def summarize(records: list) -> dict:
+    durations = defaultdict(list)
+    for record in records:
+        durations[record["name"]].append(record["duration_ms"])
+    return {
+        name: {
+            "count": len(values),
+            "p50_ms": statistics.median(values),
+            "p95_ms": percentile(values, 0.95),
+            "p99_ms": percentile(values, 0.99),
+            "total_ms": sum(values),
+        }
+        for name, values in durations.items()
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--file", help="集計するスパンのファイル (JSON Lines)")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument(
+        "--latency", type=float, default=0.005, help="往復ごとに挟む遅延秒数"
+    )
+    parser.add_argument(
+        "--llm-latency", type=float, default=0.5, help="スタブ LLM の応答秒数"
+    )
+    args = parser.parse_args()
+
+    if args.file:
+        records = load_records(args.file)
+    else:
+        records = simulate(args.users, args.latency, args.llm_latency)
+
+    report = summarize(records)
+    traces = len({r["trace_id"] for r in records})
+    print(f"{len(records)} spans in {traces} traces")
+    print(
+        f"{'span':<32}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'total ms':>12}"
+    )
+    for name, row in sorted(report.items(), key=lambda item: -item[1]["total_ms"]):
+        print(
+            f"{name:<32}{row['count']:>7}{row['p50_ms']:>10.2f}{row['p95_ms']:>10.2f}"
+            f"{row['p99_ms']:>10.2f}{row['total_ms']:>12.2f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
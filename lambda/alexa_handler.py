@@ -1,22 +1,179 @@
+import asyncio
+import time
 from firebase_admin import firestore
+from briefing import Briefing
 from news import News
-from user import User, LANGUAGE_CODE
+from user import User, LANGUAGE_CODE, DAILY_QUESTION_LIMIT, SESSION_STATE_KEY
 from question import Question, ANSWER_STATUS
+import tracing
+
+# セッション属性に保存する、読み上げ中のニュースの位置
+NEWS_CURSOR_KEY = "news_cursor"
 
 
 class AlexaHandler:
     @staticmethod
-    def play_news(user_id: str, language_code: str, db: firestore.Client):
+    def play_news(
+        user_id: str, language_code: str, db: firestore.Client, session: dict = None
+    ):
+        """
+        ユーザーの言語設定に応じて最新ニュースを取得し、speakとaskを返す。
+        セッションの始まりは、最新のブリーフィングがあれば1回のポイントリードで返す
+        """
+        state = session.get(SESSION_STATE_KEY) if session is not None else None
+        if not state:
+            briefing = Briefing.get(db, user_id)
+            if briefing and AlexaHandler._is_current(
+                briefing, News.get_latest_news(db, briefing.language_code)
+            ):
+                return AlexaHandler._use_briefing(briefing, session)
+
+        user = User.load(db, user_id, language_code, session)
+        if not state:
+            # ブリーフィングがなかったユーザーは、次のバッチで作る対象にする
+            user.mark_active(db)
+        speak, ask = AlexaHandler._play_news(user, db, session)
+        user.save_session(session)
+        return speak, ask
+
+    @staticmethod
+    async def play_news_async(
+        user_id: str, language_code: str, db, session: dict = None
+    ):
         """
-        ユーザーの言語設定に応じて最新ニュースを取得し、speakとaskを返す
+        play_news の AsyncClient 版。ブリーフィングと最新ニュース (通常はコンテナ内
+        キャッシュ) を並行に読み、ブリーフィングが最新ならそのまま返す。
+        なければユーザー・質問・最新ニュースを並行に読む。
+        ニュースはロケールの言語で先に読み、保存済みの言語設定と違えば読み直す
         """
-        user_ref = User.collection(db)
-        user = User.get_or_create(
-            user_ref, user_id=user_id, language_code=language_code
+        briefing, latest_news = await asyncio.gather(
+            Briefing.get_async(db, user_id),
+            News.get_latest_news_async(db, language_code),
         )
-        language = user.language_code
+        if briefing:
+            if briefing.language_code != language_code:
+                latest_news = await News.get_latest_news_async(
+                    db, briefing.language_code
+                )
+            if AlexaHandler._is_current(briefing, latest_news):
+                return AlexaHandler._use_briefing(briefing, session)
 
+        user, latest_news = await asyncio.gather(
+            User.get_or_create_with_question_async(db, user_id, language_code),
+            News.get_latest_news_async(db, language_code),
+        )
+        if user.language_code != language_code:
+            latest_news = await News.get_latest_news_async(db, user.language_code)
+        await user.mark_active_async(db)
+        speak, ask, cursor = AlexaHandler._render_news(
+            user, latest_news, await user.get_question_async(db)
+        )
+        AlexaHandler._save_news_cursor(session, cursor)
+        user.save_session(session)
+        return speak, ask
+
+    @staticmethod
+    def render_briefing(user: User, latest_news: News, question: Question) -> Briefing:
+        """
+        LaunchRequest の応答とその後のセッションの状態を、ブリーフィングとして組み立てる
+        """
+        speak, ask, cursor = AlexaHandler._render_news(user, latest_news, question)
+        return Briefing(
+            user_id=user.id,
+            language_code=user.language_code,
+            news_id=latest_news.id if latest_news else None,
+            speak=speak,
+            ask=ask,
+            cursor=cursor,
+            user_state=user.to_session(),
+        )
+
+    @staticmethod
+    def _is_current(briefing: Briefing, latest_news: News) -> bool:
+        return latest_news is not None and briefing.news_id == latest_news.id
+
+    @staticmethod
+    def _use_briefing(briefing: Briefing, session: dict = None):
+        if session is not None:
+            session[SESSION_STATE_KEY] = briefing.user_state
+        AlexaHandler._save_news_cursor(session, briefing.cursor)
+        return briefing.speak, briefing.ask
+
+    @staticmethod
+    def _play_news(user: User, db: firestore.Client, session: dict = None):
+        latest_news = News.get_latest_news(db, user.language_code)
+        speak, ask, cursor = AlexaHandler._render_news(
+            user, latest_news, user.get_question(db)
+        )
+        AlexaHandler._save_news_cursor(session, cursor)
+        return speak, ask
+
+    @staticmethod
+    def next_news(
+        user_id: str, language_code: str, db: firestore.Client, session: dict = None
+    ):
+        """
+        読み上げ中のニュースの次のセグメントを返す
+        """
+        user = User.load(db, user_id, language_code, session)
+        language = user.language_code
         latest_news = News.get_latest_news(db, language)
+        question = user.get_question(db)
+        cursor = session.get(NEWS_CURSOR_KEY) if session is not None else None
+
+        if latest_news and cursor:
+            # 読み上げ中に新しいニュースが配信されていれば、その先頭から読む
+            index = cursor["index"] if cursor["news_id"] == latest_news.id else 0
+            speak, ask, cursor = AlexaHandler._render_news(
+                user, latest_news, question, index
+            )
+            AlexaHandler._save_news_cursor(session, cursor)
+        else:
+            ask = AlexaHandler._news_prompt(language, latest_news, question)
+            if language == LANGUAGE_CODE["JA"]:
+                speak = f"ニュースは以上です。{ask}"
+            else:
+                speak = f"That's all for today's news. {ask}"
+        user.save_session(session)
+        return speak, ask
+
+    @staticmethod
+    def skip_news(
+        user_id: str, language_code: str, db: firestore.Client, session: dict = None
+    ):
+        """
+        残りのセグメントを飛ばし、質問の案内に進む
+        """
+        user = User.load(db, user_id, language_code, session)
+        language = user.language_code
+        AlexaHandler._save_news_cursor(session, None)
+        ask = AlexaHandler._news_prompt(
+            language, News.get_latest_news(db, language), user.get_question(db)
+        )
+        if language == LANGUAGE_CODE["JA"]:
+            speak = f"ニュースを飛ばします。{ask}"
+        else:
+            speak = f"Skipping the news. {ask}"
+        user.save_session(session)
+        return speak, ask
+
+    @staticmethod
+    def _save_news_cursor(session: dict, cursor: dict):
+        if session is None:
+            return
+        if cursor:
+            session[NEWS_CURSOR_KEY] = cursor
+        else:
+            session.pop(NEWS_CURSOR_KEY, None)
+
+    @staticmethod
+    def _render_news(user: User, latest_news: News, question: Question, index=0):
+        """
+        index 番目のセグメントを読み上げる speak と ask を作る。
+        続きがあれば次に読むセグメントを指すカーソルも返す
+        """
+        language = user.language_code
+
         if not latest_news:
             if language == LANGUAGE_CODE["JA"]:
                 speak = "本日のニュースは見つかりませんでした。"
@@ -24,21 +181,41 @@ class AlexaHandler:
             else:
                 speak = "No news was found for today."
                 ask = None
-            return speak, ask
+            return speak, ask, None
+
+        segments = latest_news.segments or [latest_news.content]
+        index = min(index, len(segments) - 1)
 
         # speakの生成
-        if language == LANGUAGE_CODE["JA"]:
-            speak = f"本日のニュースです。{latest_news.content}"
+        if index > 0:
+            speak = segments[index]
+        elif language == LANGUAGE_CODE["JA"]:
+            speak = f"本日のニュースです。{segments[0]}"
         else:
-            speak = f"Here is today's news. {latest_news.content}"
+            speak = f"Here is today's news. {segments[0]}"
 
-        # askの生成
-        if user.get_answer_status(db) == ANSWER_STATUS["READY"]:
+        # 続きがあれば、次へ進むか飛ばすかを尋ねる
+        if index + 1 < len(segments):
+            if language == LANGUAGE_CODE["JA"]:
+                ask = "続きを聞く場合は「次」、ニュースを飛ばす場合は「スキップ」と言ってください。"
+            else:
+                ask = "Say 'Next' to continue, or 'Skip' to skip the news."
+            speak = f"{speak} {ask}"
+            return speak, ask, {"news_id": latest_news.id, "index": index + 1}
+
+        return speak, AlexaHandler._news_prompt(language, latest_news, question), None
+
+    @staticmethod
+    def _news_prompt(language: str, latest_news: News, question: Question) -> str:
+        """
+        ニュースを読み終えた後の案内 (回答の再生または質問の仕方)
+        """
+        if question and question.answer_status == ANSWER_STATUS["READY"]:
             if language == LANGUAGE_CODE["JA"]:
                 ask = "以前の質問の回答が保存されています。再生する場合は「回答!」と言ってみてください。"
             else:
                 ask = "An answer from your previous question is ready. Say 'Answer!' if you want to hear it."
-        else:
+        elif latest_news:
             # READY以外の場合
             if language == LANGUAGE_CODE["JA"]:
                 ask = (
@@ -50,23 +227,37 @@ class AlexaHandler:
                     "If you have any questions, say 'Question!' followed by your query. "
                     f"For example, you could ask: 'Question! {latest_news.sample_question}'"
                 )
-        return speak, ask
+        else:
+            if language == LANGUAGE_CODE["JA"]:
+                ask = "何か質問がある場合は、「質問!」と宣言した後に質問してみてください。"
+            else:
+                ask = (
+                    "If you have any questions, say 'Question!' followed by your query."
+                )
+        return ask
 
     @staticmethod
     def receive_question(
-        user_id: str, language_code: str, question: str, db: firestore.Client
+        user_id: str,
+        language_code: str,
+        question: str,
+        db: firestore.Client,
+        session: dict = None,
     ):
         """
         質問を受け取り、回答作成を非同期的に開始する（実際の処理は別途）
         """
-        user_ref = User.collection(db)
-        user = User.get_or_create(
-            user_ref, user_id=user_id, language_code=language_code
-        )
+        user = User.load(db, user_id, language_code, session)
+        speak, ask = AlexaHandler._receive_question(user, question, db)
+        user.save_session(session)
+        return speak, ask
+
+    @staticmethod
+    def _receive_question(user: User, question: str, db: firestore.Client):
         language = user.language_code
 
         # 1. 今日の質問回数が3回以上なら終了
-        if user.daily_usage_count >= 3:
+        if user.daily_usage_count >= DAILY_QUESTION_LIMIT:
             if language == LANGUAGE_CODE["JA"]:
                 speak = "本日の質問回数が上限に達しました。また明日ご利用ください。"
             else:
@@ -91,14 +282,54 @@ class AlexaHandler:
                 ask = "An answer to your previous question is ready. Say 'Answer!' to hear it."
             return speak, ask
 
-        # 4. 新規ドキュメントを作成し、questionフィールドに質問を保存
-        user.recreate_question(db=db, question_text=question)
+        # 4. 同じニュースに対する言い換えの質問が回答済みなら、その回答を再利用する
+        # numpy を読み込むため、質問を受け付けるときだけ import する
+        from semantic_cache import answer_cache
 
-        # ユーザーのステータスを IN_PROGRESS にして保存
-        user.daily_usage_count += 1
-        user.save(user_ref)
+        latest_news = News.get_latest_news(db, language)
+        edition = latest_news.id if latest_news else None
+        answer_cache.warm(db, edition)
+        hit = answer_cache.lookup(edition, question) if question else None
+        if hit:
+            answer_text, _ = hit
+            answer_status = ANSWER_STATUS["READY"]
+        else:
+            answer_text, answer_status = "", ANSWER_STATUS["IN_PROGRESS"]
 
-        # 5. 一時応答（回答作成中）を返す
+        # 5. 質問の保存と利用回数の加算を1つのトランザクションで行う
+        #    (同時に届いた発話で上限を超えないよう、トランザクション内で再確認する)
+        submitted = user.submit_question(
+            db=db,
+            question_text=question,
+            answer_text=answer_text,
+            answer_status=answer_status,
+            news_edition=edition,
+        )
+        if not submitted:
+            if user.daily_usage_count >= DAILY_QUESTION_LIMIT:
+                if language == LANGUAGE_CODE["JA"]:
+                    speak = "本日の質問回数が上限に達しました。また明日ご利用ください。"
+                else:
+                    speak = "You have reached the daily question limit. Please come back tomorrow."
+            else:
+                if language == LANGUAGE_CODE["JA"]:
+                    speak = (
+                        "前回の質問に対する回答を作成中です。もう少々お待ちください。"
+                    )
+                else:
+                    speak = "Your previous question is still being processed. Please wait a bit longer."
+            return speak, None
+
+        if hit:
+            if language == LANGUAGE_CODE["JA"]:
+                speak = "質問を受け付けました。回答の準備ができています。"
+                ask = "「回答!」と言ってみてください。"
+            else:
+                speak = "Your question has been received. The answer is ready."
+                ask = "Please say 'Answer!' to hear it."
+            return speak, ask
+
+        # 6. 一時応答（回答作成中）を返す
         if language == LANGUAGE_CODE["JA"]:
             speak = "質問を受け付けました。ただいま回答を作成中です。"
             ask = "「回答!」と言ってみてください。回答が作成されていれば再生できます。"
@@ -108,14 +339,49 @@ class AlexaHandler:
         return speak, ask
 
     @staticmethod
-    def answer(user_id: str, language_code: str, db: firestore.Client):
+    def answer(
+        user_id: str,
+        language_code: str,
+        db: firestore.Client,
+        session: dict = None,
+        wait_until: float = None,
+        wait_mode: str = "listen",
+        progressive=None,
+    ):
         """
-        ユーザーのanswer_statusに応じて適切な応答を返す
+        ユーザーのanswer_statusに応じて適切な応答を返す。
+        wait_until (time.monotonic の値) を指定すると、回答作成中の場合は
+        progressive で途中経過を伝えてから、その時刻まで回答を待つ
         """
-        user_ref = User.collection(db)
-        user = User.get_or_create(
-            user_ref, user_id=user_id, language_code=language_code
-        )
+        # 待機モードでは wait_for_answer の最初の読み取りが質問の読み直しを兼ねる
+        waiting = wait_until is not None and wait_until > time.monotonic()
+        user = User.load(db, user_id, language_code, session, refresh=not waiting)
+        speak, ask = AlexaHandler._answer(user, db, wait_until, wait_mode, progressive)
+        user.save_session(session)
+        return speak, ask
+
+    @staticmethod
+    def _transition(
+        user: User, question: Question, answer_status: str, db, last_update_time=None
+    ):
+        """
+        読み上げた質問の状態を進める。その間に別のデバイスから新しい質問が
+        保存されていた場合は、そちらを読み直してセッションの状態に反映する
+        """
+        if question.transition(db, answer_status, last_update_time):
+            user.set_cached_question(question)
+        else:
+            user.set_cached_question(None)
+            user.refresh_question(db)
+
+    @staticmethod
+    def _answer(
+        user: User,
+        db: firestore.Client,
+        wait_until: float = None,
+        wait_mode: str = "listen",
+        progressive=None,
+    ):
         language = user.language_code
 
         # 日付情報
@@ -123,6 +389,26 @@ class AlexaHandler:
         speak = ""
         ask = ""
 
+        # 待機モードでは、同じターンのうちに回答ができあがるのを待つ
+        last_update_time = None
+        if (
+            answer_status == ANSWER_STATUS["IN_PROGRESS"]
+            and wait_until is not None
+            and wait_until > time.monotonic()
+        ):
+            if progressive is not None:
+                if language == LANGUAGE_CODE["JA"]:
+                    progressive("回答を作成中です。少々お待ちください。")
+                else:
+                    progressive("I'm preparing the answer. Just a moment.")
+            waited = Question.wait_for_answer(
+                db, user.id, wait_until, listen=wait_mode != "poll"
+            )
+            if waited:
+                question, last_update_time = waited
+                user.set_cached_question(question, version=last_update_time)
+                answer_status = user.get_answer_status(db)
+
         # 質問がないとき
         if answer_status == ANSWER_STATUS["NO_QUESTION"]:
             if language == LANGUAGE_CODE["JA"]:
@@ -138,6 +424,16 @@ class AlexaHandler:
         # 回答を作成中のとき
         if answer_status == ANSWER_STATUS["IN_PROGRESS"]:
 
+            # ストリーミング生成で、回答の冒頭だけ先に保存されている場合
+            if question.answer_text:
+                if language == LANGUAGE_CODE["JA"]:
+                    speak = f"「{question.question_text}」という質問への回答を作成中です。冒頭をお伝えします。「{question.answer_text}」。続きはもう少々お待ちください。"
+                    ask = "「回答!」と言ってみてください。回答が作成されていれば続きを再生できます。"
+                else:
+                    speak = f"We're preparing the answer to your question '{question.question_text}'. Here is how it begins: '{question.answer_text}'. The rest will be ready shortly."
+                    ask = "Please say 'Answer!'. If the answer is ready, it will be played."
+                return speak, ask
+
             if language == LANGUAGE_CODE["JA"]:
                 speak = f"現在、質問に対する回答を作成中です。「{question.question_text}」という質問をお預かりしています。もう少々お待ちください。"
                 ask = "「回答!」と言ってみてください。回答が作成されていれば再生できます。"
@@ -159,14 +455,21 @@ class AlexaHandler:
                 date_str = question.created.strftime("%B %-d")
                 speak = f"Here is the answer to your question on {date_str}: '{question.question_text}'. '{question.answer_text}'. That is all."
                 ask = "If you have any other questions, please say 'Question!' and then ask your question."
-            question.answer_status = ANSWER_STATUS["ANSWERED"]
-            question_ref = Question.collection(db)
-            question.update(question_ref)
+            if answer_status == ANSWER_STATUS["READY"] and question.trace_id:
+                # 質問から回答を聞くまでの時間を、質問のトレースに記録する
+                tracing.record(
+                    "question.delivered",
+                    question.created.timestamp(),
+                    trace_id=question.trace_id,
+                )
+            AlexaHandler._transition(
+                user, question, ANSWER_STATUS["ANSWERED"], db, last_update_time
+            )
             return speak, ask
 
-        question.answer_status = ANSWER_STATUS["ERROR"]
-        question_ref = Question.collection(db)
-        question.update(question_ref)
+        AlexaHandler._transition(
+            user, question, ANSWER_STATUS["ERROR"], db, last_update_time
+        )
 
         # 回答中にエラーが起きたとき
         if answer_status == ANSWER_STATUS["ERROR"]:
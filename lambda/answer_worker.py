@@ -0,0 +1,392 @@
+"""
+回答作成ワーカー
+
+questions コレクションの IN_PROGRESS の質問をバッチで取り出し、LLM で回答を作成して
+READY (失敗時は ERROR) に更新します。同じニュース版に対する同じ質問 (正規化後) は
+1回だけ生成し、質問したすべてのユーザーに同じ回答を配ります。ニュース版は質問を
+受け付けたときに保存したものを使います。書き込みはトランザクションで質問が変わって
+いないことを確かめてから行い、別のデバイスで質問し直されたものは上書きしません。
+プロンプトは prompt_context.PromptBuilder でトークン予算の範囲に組み立てます。
+会話の文脈 (要約と直近のやり取り) は回答を共有しない1人だけの質問にのみ含めます。
+--stream では回答をストリーミングで生成し、最初の1文ができた時点で
+回答作成中のまま answer_text に保存します (AnswerIntent が冒頭を読み上げられるように)。
+
+    python answer_worker.py                 # 本番の Firestore と GenAI を使う
+    python answer_worker.py --local --stub  # インメモリ Firestore とスタブ LLM で実行
+    python answer_worker.py --local --stub --stream
+"""
+
+import argparse
+import logging
+import os
+import random
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from briefing import Briefing
+from conversation_record import ConversationBuffer, ConversationRecord
+from news import News
+from prompt_context import PromptBuilder, first_sentence
+from question import Question, ANSWER_STATUS
+from semantic_cache import SemanticCache
+import tracing
+from user import User, LANGUAGE_CODE
+
+logger = logging.getLogger(__name__)
+
+# ワーカーが質問について使うフィールド (回答本文などは読まない)
+QUESTION_FIELDS = ("user_id", "question_text", "created", "news_edition", "trace_id")
+BATCH_SIZE = 100
+CONCURRENCY = 4
+MAX_RETRIES = 3
+BACKOFF_SECONDS = 0.5
+MAX_BACKOFF_SECONDS = 8.0
+
+
+class AnswerWorker:
+    def __init__(
+        self,
+        db,
+        llm,
+        batch_size: int = BATCH_SIZE,
+        concurrency: int = CONCURRENCY,
+        max_retries: int = MAX_RETRIES,
+        backoff_seconds: float = BACKOFF_SECONDS,
+        answer_cache: SemanticCache = None,
+        stream: bool = False,
+    ):
+        self.db = db
+        self.llm = llm
+        self.stream = stream and hasattr(llm, "generate_stream")
+        self.prompt_builder = PromptBuilder(db)
+        self.batch_size = batch_size
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff_seconds = backoff_seconds
+        self.answer_cache = (
+            answer_cache if answer_cache is not None else SemanticCache()
+        )
+
+    def fetch_batch(self, cursor=None) -> list:
+        query = (
+            Question.collection(self.db)
+            .where(
+                filter=FieldFilter("answer_status", "==", ANSWER_STATUS["IN_PROGRESS"])
+            )
+            .select(Question.projection(*QUESTION_FIELDS))
+            .order_by("created")
+            .limit(self.batch_size)
+        )
+        if cursor is not None:
+            query = query.start_after(cursor)
+        return list(query.stream())
+
+    def load_languages(self, user_ids: list) -> dict:
+        """
+        質問したユーザーの言語設定を get_all でまとめて取得する
+        """
+        ref = User.collection(self.db)
+        languages = {}
+        for snapshot in self.db.get_all(
+            [ref.document(i) for i in user_ids],
+            field_paths=User.projection("language_code"),
+        ):
+            data = snapshot.to_dict() if snapshot.exists else {}
+            languages[snapshot.id] = data.get("language_code") or LANGUAGE_CODE["JA"]
+        return languages
+
+    def group_questions(self, questions: list, languages: dict) -> dict:
+        """
+        (言語, ニュース版, 正規化した質問) ごとに質問をまとめる。
+        ニュース版を持たない古い質問は、いまの最新ニュースで回答する
+        """
+        groups = {}
+        for question in questions:
+            language = languages.get(question.user_id, LANGUAGE_CODE["JA"])
+            edition = question.news_edition
+            if edition is None:
+                latest = News.get_latest_news(self.db, language)
+                edition = latest.id if latest else None
+            key = (language, edition, Question.normalize_text(question.question_text))
+            groups.setdefault(key, []).append(question)
+        return groups
+
+    def build_prompt(
+        self, language: str, question_text: str, edition: str, conversation: str = ""
+    ) -> str:
+        return self.prompt_builder.build(language, question_text, edition, conversation)
+
+    def generate(self, prompt: str, on_first_sentence=None) -> str:
+        """
+        指数バックオフ付きで LLM を呼び出す。再試行し尽くした場合は None を返す。
+        ストリーミング時は、最初の1文ができた時点で on_first_sentence を呼ぶ
+        """
+        for attempt in range(self.max_retries + 1):
+            try:
+                with tracing.span("llm.generate", attempt=attempt, stream=self.stream):
+                    if self.stream:
+                        return self._generate_stream(prompt, on_first_sentence)
+                    return self.llm.generate(prompt)
+            except Exception as e:
+                if attempt == self.max_retries:
+                    logger.error("answer generation failed: %s", e, exc_info=True)
+                    return None
+                delay = min(MAX_BACKOFF_SECONDS, self.backoff_seconds * 2**attempt)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+
+    def _generate_stream(self, prompt: str, on_first_sentence=None) -> str:
+        text = ""
+        for chunk in self.llm.generate_stream(prompt):
+            text += chunk
+            if on_first_sentence is not None:
+                head = first_sentence(text)
+                if head:
+                    on_first_sentence(head)
+                    on_first_sentence = None
+        return text.strip()
+
+    def answer_group(self, key: tuple, members: list) -> tuple:
+        """
+        同じニュース版で言い換えの質問が回答済みならそれを使い、なければ生成する。
+        回答をグループ内で共有するため、会話の文脈は質問したのが1人のときだけ含め、
+        文脈を含めた回答は個人向けなので意味キャッシュには追加しない。
+        (回答, LLM を呼び出したか, 個人の文脈を含めたか) を返す
+        """
+        language, edition, _ = key
+        question_text = members[0].question_text
+        # 生成は1回なので、グループの先頭の質問のトレースに記録し、他の質問はリンクで示す
+        with tracing.span(
+            "answer_worker.answer_group",
+            trace_id=members[0].trace_id,
+            members=len(members),
+            links=[q.trace_id for q in members[1:] if q.trace_id],
+        ):
+            self.answer_cache.warm(self.db, edition)
+            hit = self.answer_cache.lookup(edition, question_text)
+            if hit:
+                return hit[0], False, False
+            with tracing.span("prompt.build"):
+                conversation = (
+                    ConversationRecord.get_prompt_context(self.db, members[0].user_id)
+                    if len(members) == 1
+                    else ""
+                )
+                prompt = self.build_prompt(
+                    language, question_text, edition, conversation
+                )
+            answer_text = self.generate(
+                prompt,
+                on_first_sentence=lambda head: self.publish_preview(members, head),
+            )
+            if answer_text and not conversation:
+                self.answer_cache.add(edition, question_text, answer_text)
+            return answer_text, True, bool(conversation)
+
+    def update_current(
+        self, questions: list, updates_for, invalidate_briefing: bool = False
+    ) -> list:
+        """
+        questions/{user_id} がまだ同じ質問の回答作成中であるものだけに updates_for(question) を
+        1つのトランザクションで書き込み、書き込んだ質問を返す
+        """
+        ref = Question.collection(self.db)
+        refs = [ref.document(question.user_id) for question in questions]
+
+        @firestore.transactional
+        def _update(transaction) -> list:
+            current = {s.id: s for s in transaction.get_all(refs)}
+            updated = []
+            for question, doc_ref in zip(questions, refs):
+                snapshot = current.get(question.user_id)
+                if snapshot is None or not snapshot.exists:
+                    continue
+                data = snapshot.to_dict()
+                in_progress = data.get("answer_status") == ANSWER_STATUS["IN_PROGRESS"]
+                if not in_progress or not question.is_same_question(data):
+                    continue
+                transaction.update(doc_ref, updates_for(question))
+                if invalidate_briefing:
+                    Briefing.invalidate(transaction, self.db, question.user_id)
+                updated.append(question)
+            return updated
+
+        return _update(self.db.transaction())
+
+    def publish_preview(self, questions: list, head: str):
+        """
+        生成途中の回答の冒頭を、状態は回答作成中のまま answer_text に書き込む
+        """
+        self.update_current(questions, lambda question: {"answer_text": head})
+
+    def publish(
+        self,
+        questions: list,
+        answer_text: str,
+        edition: str = None,
+        personalized: bool = False,
+    ) -> list:
+        """
+        同じグループの質問に回答を書き込み、会話履歴に追記する。
+        personalized は個人の会話の文脈を使った回答で、意味キャッシュの読み込みから除かれる。
+        書き込んだ (質問し直されていなかった) 質問を返す
+        """
+        status = ANSWER_STATUS["READY"] if answer_text else ANSWER_STATUS["ERROR"]
+
+        def updates_for(question) -> dict:
+            updates = {
+                "answer_text": answer_text or "",
+                "answer_status": status,
+                "personalized": personalized,
+            }
+            # 受け付けたときのニュース版は上書きしない
+            if question.news_edition is None:
+                updates["news_edition"] = edition
+            return updates
+
+        questions = self.update_current(
+            questions, updates_for, invalidate_briefing=True
+        )
+
+        # 質問を受け付けてから回答ができあがるまでを、それぞれの質問のトレースに記録する
+        for question in questions:
+            if question.trace_id:
+                tracing.record(
+                    "question.ready",
+                    question.created.timestamp(),
+                    trace_id=question.trace_id,
+                    status=status,
+                )
+
+        if answer_text:
+            for question in questions:
+                ConversationBuffer.append(
+                    self.db,
+                    question.user_id,
+                    [
+                        ConversationRecord(
+                            question.user_id, "user", question.question_text
+                        ),
+                        ConversationRecord(question.user_id, "agent", answer_text),
+                    ],
+                )
+        return questions
+
+    def run(self) -> dict:
+        stats = {
+            "questions": 0,
+            "generations": 0,
+            "ready": 0,
+            "error": 0,
+            "superseded": 0,
+        }
+        cursor = None
+
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            while True:
+                snapshots = self.fetch_batch(cursor)
+                if not snapshots:
+                    break
+                cursor = snapshots[-1]
+
+                questions = [
+                    Question.from_dict(s.to_dict(), fields=QUESTION_FIELDS)
+                    for s in snapshots
+                ]
+                languages = self.load_languages([q.user_id for q in questions])
+                groups = self.group_questions(questions, languages)
+
+                answers = executor.map(
+                    self.answer_group, groups.keys(), groups.values()
+                )
+
+                for key, members, answer in zip(
+                    groups.keys(), groups.values(), answers
+                ):
+                    answer_text, generated, personalized = answer
+                    published = self.publish(members, answer_text, key[1], personalized)
+                    stats["ready" if answer_text else "error"] += len(published)
+                    stats["superseded"] += len(members) - len(published)
+                    stats["generations"] += 1 if generated else 0
+
+                stats["questions"] += len(questions)
+                if len(snapshots) < self.batch_size:
+                    break
+
+        logger.info("answer worker finished: %s", stats)
+        return stats
+
+
+def seed_local(db):
+    """
+    --local 用のサンプルデータ。朝のニュースの後に同じ質問が集中する状況を再現する
+    """
+    News(
+        content="AIエージェントの新しいフレームワークが公開されました。",
+        sample_question="AIエージェント関連のニュースは？",
+        keyword="AIエージェント",
+        language_code=LANGUAGE_CODE["JA"],
+    ).save(db)
+    texts = [
+        "AIエージェント関連のニュースは？",
+        "AIエージェント関連のニュースは",
+        "量子コンピュータの話題は？",
+    ]
+    for i in range(30):
+        user = User(f"local-user-{i}", language_code=LANGUAGE_CODE["JA"])
+        user.save(User.collection(db))
+        user.submit_question(db, texts[i % len(texts)])
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--local", action="store_true", help="インメモリ Firestore を使う"
+    )
+    parser.add_argument("--stub", action="store_true", help="スタブ LLM を使う")
+    parser.add_argument(
+        "--stream", action="store_true", help="回答をストリーミングで生成する"
+    )
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--concurrency", type=int, default=CONCURRENCY)
+    args = parser.parse_args()
+
+    if args.local:
+        # インメモリ Firestore はデプロイするパッケージに含めず、benchmarks/ に置いている
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        sys.path.insert(0, os.path.join(root, "benchmarks"))
+        from firestore_fake import FakeClient
+
+        from metrics import instrument
+
+        db = instrument(FakeClient())
+        seed_local(db)
+    else:
+        from clients import get_db
+
+        db = get_db()
+
+    if args.stub:
+        from llm import StubLLM
+
+        llm = StubLLM()
+    else:
+        from llm import GenAILLM
+
+        llm = GenAILLM()
+
+    worker = AnswerWorker(
+        db,
+        llm,
+        batch_size=args.batch_size,
+        concurrency=args.concurrency,
+        stream=args.stream,
+    )
+    print(worker.run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+ユーザーごとに事前に組み立てた LaunchRequest の応答 (briefings/{user_id})
+
+ニュースの配信後にバッチ (maintenance.py build-briefings) で作成し、LaunchRequest は
+1回のポイントリードで応答とセッションの状態を復元します。質問の状態を変える書き込み
+(質問の受付・回答の作成・再生) は、同じバッチまたはトランザクションでブリーフィングを
+削除して無効にします。バッチはユーザーと質問をトランザクションの中で読み直してから
+書き込むため、無効化と入れ違いに古いブリーフィングを書き戻すことはありません。
+"""
+
+from datetime import datetime, timezone
+from model import Model
+
+
+class Briefing(Model):
+    COLLECTION = "briefings"
+    FIELDS = (
+        "user_id",
+        "language_code",
+        "news_id",
+        "speak",
+        "ask",
+        "cursor",
+        "user_state",
+        "created",
+    )
+
+    def __init__(
+        self,
+        user_id: str,
+        language_code: str,
+        news_id: str,
+        speak: str,
+        ask: str = None,
+        cursor: dict = None,
+        user_state: dict = None,
+        created: datetime = None,
+    ):
+        self.user_id = user_id
+        self.language_code = language_code
+        # 応答を組み立てたときの最新ニュース。新しいニュースが配信されていれば使わない
+        self.news_id = news_id
+        self.speak = speak
+        self.ask = ask
+        # 続きのセグメントがあるときのニュースのカーソル
+        self.cursor = cursor
+        # User.to_session の形式。次のターンからの Firestore の読み取りを省く
+        self.user_state = user_state
+        self.created = created if created else datetime.now(timezone.utc)
+
+    @staticmethod
+    def collection(db):
+        return db.collection(Briefing.COLLECTION)
+
+    @staticmethod
+    def ref(db, user_id: str):
+        return Briefing.collection(db).document(user_id)
+
+    @staticmethod
+    def get(db, user_id: str) -> "Briefing":
+        doc = Briefing.ref(db, user_id).get()
+        if doc.exists:
+            return Briefing.from_dict(doc.to_dict())
+        return None
+
+    @staticmethod
+    async def get_async(db, user_id: str) -> "Briefing":
+        doc = await Briefing.ref(db, user_id).get()
+        if doc.exists:
+            return Briefing.from_dict(doc.to_dict())
+        return None
+
+    @staticmethod
+    def invalidate(writer, db, user_id: str):
+        """
+        writer (バッチまたはトランザクション) に、ブリーフィングの削除を加える
+        """
+        writer.delete(Briefing.ref(db, user_id))
@@ -0,0 +1,86 @@
+import asyncio
+import os
+import json
+import threading
+from metrics import instrument
+
+# 初回利用時に生成し、ウォームスタート間で再利用する
+_db = None
+_async_db = None
+_genai = None
+_loops = threading.local()
+
+
+def _initialize_firebase():
+    import firebase_admin
+    from firebase_admin import credentials
+
+    if not firebase_admin._apps:
+        SERVICE_ACCOUNT_KEY = os.environ["SERVICE_ACCOUNT_KEY"]
+        cred = credentials.Certificate(json.loads(SERVICE_ACCOUNT_KEY))
+        firebase_admin.initialize_app(cred)
+
+
+def get_db():
+    """
+    Firestoreクライアントを初回呼び出し時に初期化し、計測用のラッパーで包んで返す
+    """
+    global _db
+    if _db is None:
+        from firebase_admin import firestore
+
+        _initialize_firebase()
+        _db = instrument(firestore.client())
+    return _db
+
+
+def set_db(db):
+    """
+    ローカル実行やベンチマークで、Firestoreクライアントを差し替える
+    """
+    global _db
+    _db = instrument(db)
+
+
+def get_async_db():
+    """
+    非同期のFirestoreクライアント (AsyncClient) を初回呼び出し時に初期化して返す。
+    gRPC のチャネルはイベントループに結びつくため、run_async と組み合わせて使う
+    """
+    global _async_db
+    if _async_db is None:
+        from firebase_admin import firestore_async
+
+        _initialize_firebase()
+        _async_db = instrument(firestore_async.client())
+    return _async_db
+
+
+def set_async_db(db):
+    global _async_db
+    _async_db = instrument(db)
+
+
+def run_async(coroutine):
+    """
+    同期のハンドラーからコルーチンを実行する。
+    イベントループはコンテナ (Lambda では1スレッド) ごとに1つ作り、ウォームスタート間で使い回す。
+    負荷試験などで複数スレッドから呼ばれた場合はスレッドごとのループを使う
+    """
+    loop = getattr(_loops, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = _loops.loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coroutine)
+
+
+def get_genai():
+    """
+    google.generativeai を初回呼び出し時にimportして設定済みのモジュールを返す
+    """
+    global _genai
+    if _genai is None:
+        import google.generativeai as genai
+
+        genai.configure(api_key=os.environ["GENAI_API_KEY"])
+        _genai = genai
+    return _genai
@@ -1,10 +1,30 @@
+import logging
 import uuid
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
+from google.cloud import firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
+from model import Model
 
+logger = logging.getLogger(__name__)
 
-class ConversationRecord:
+DELETE_PAGE_SIZE = 500
+
+# ユーザーごとに保持する直近の会話ターン数 (圧縮が追いつかない場合の上限)
+CONVERSATION_BUFFER_SIZE = 20
+
+# 圧縮後もそのまま残す直近の会話ターン数。これより古いターンは要約に畳み込む
+CONVERSATION_WINDOW_TURNS = 6
+
+# 会話履歴の保持期間。expires_at を Firestore の TTL ポリシーに設定して削除させる
+CONVERSATION_TTL = timedelta(days=90)
+
+
+class ConversationRecord(Model):
+    # 旧形式 (1メッセージ1ドキュメント) のコレクション。移行・集計・削除処理のみで参照する
     COLLECTION = "conversations"
+    FIELDS = ("id", "user_id", "role", "message", "timestamp", "expires_at")
+    # 会話バッファの1ターンとして保存するフィールド
+    TURN_FIELDS = ("role", "message", "timestamp")
 
     def __init__(
         self,
@@ -13,38 +33,17 @@ class ConversationRecord:
         message: str,
         timestamp: datetime = None,
         id: str = None,
+        expires_at: datetime = None,
     ):
         self.id = id if id else str(uuid.uuid4())
         self.user_id = user_id
         self.role = role  # "user" or "agent"
         self.message = message
         self.timestamp = timestamp if timestamp else datetime.now()
-
-    @staticmethod
-    def from_dict(source: dict):
-        """
-        Firestore ドキュメントから取得した dict を ConversationRecord インスタンスに変換します。
-        """
-        return ConversationRecord(
-            id=source.get("id"),
-            user_id=source.get("user_id"),
-            role=source.get("role"),
-            message=source.get("message"),
-            timestamp=source.get("timestamp", datetime.now()),
+        self.expires_at = (
+            expires_at if expires_at else self.timestamp + CONVERSATION_TTL
         )
 
-    def to_dict(self) -> dict:
-        """
-        ConversationRecord インスタンスを Firestore に保存できるよう dict に変換します。
-        """
-        return {
-            "id": self.id,
-            "user_id": self.user_id,
-            "role": self.role,
-            "message": self.message,
-            "timestamp": self.timestamp,
-        }
-
     @staticmethod
     def collection(db):
         """
@@ -62,31 +61,22 @@ class ConversationRecord:
     @staticmethod
     def record_message(db, user_id: str, role: str, message: str):
         """
-        会話の1メッセージ分を新規に作成し、Firestoreに保存します。
+        会話の1メッセージ分を新規に作成し、ユーザーの会話バッファに追記します。
         """
-        ref = ConversationRecord.collection(db)
         record = ConversationRecord(user_id=user_id, role=role, message=message)
-        record.save(ref)
+        ConversationBuffer.append(db, user_id, [record])
         return record
 
     @staticmethod
     def get_recent_messages(db, user_id: str, limit: int = 10, since: datetime = None):
         """
-        指定ユーザーの会話履歴を新しい順で最大 limit 件取得し、古い順に並べ替えて返す。
+        指定ユーザーの会話履歴のうち直近の最大 limit 件を古い順に返す。
         since が指定されていれば、その日時以降の履歴に絞り込む。
         """
-        ref = ConversationRecord.collection(db).where(
-            filter=FieldFilter("user_id", "==", user_id)
-        )
+        records = ConversationBuffer.get(db, user_id)
         if since:
-            ref = ref.where(filter=FieldFilter("timestamp", ">=", since))
-
-        query = ref.order_by("timestamp", direction="DESCENDING").limit(limit)
-        docs = query.stream()
-        records = [ConversationRecord.from_dict(doc.to_dict()) for doc in docs]
-
-        # 新しいものが先頭なので、時系列順に並べ替えて返す
-        return list(reversed(records))
+            records = [r for r in records if r.timestamp >= since]
+        return records[-limit:] if limit else records
 
     @staticmethod
     def get_recent_conversation_str(db, user_id: str, limit: int = 10) -> str:
@@ -102,22 +92,357 @@ class ConversationRecord:
         return "\n".join(lines)
 
     @staticmethod
-    def delete_all_conversations(db, user_id: str):
+    def get_prompt_context(
+        db, user_id: str, limit: int = CONVERSATION_WINDOW_TURNS
+    ) -> str:
         """
-        該当ユーザーの会話履歴をすべて削除します。
+        プロンプトに含める会話の文脈を返します。
+        古いやり取りの要約と直近 limit 件のやり取りを、1回のポイントリードで取得します。
         """
-        ref = ConversationRecord.collection(db)
-        query = ref.where(filter=FieldFilter("user_id", "==", user_id))
-        docs = query.stream()
-        for doc in docs:
-            doc.reference.delete()
+        summary, records = ConversationBuffer.get_context(db, user_id)
+        lines = [f"summary: {summary}"] if summary else []
+        lines += [f"{r.role}: {r.message}" for r in records[-limit:]]
+        return "\n".join(lines)
+
+    @staticmethod
+    def expire_legacy_conversations(db, page_size: int = DELETE_PAGE_SIZE) -> int:
+        """
+        旧形式の会話履歴に expires_at (timestamp + CONVERSATION_TTL) を書き込み、
+        書き込んだドキュメント数を返します。TTL ポリシーにより、保持期間を過ぎたものから
+        Firestore が削除します。delete_all_conversations と同じく、再実行しても安全です。
+        コレクショングループで読むため、conversations と users/{id}/conversations の
+        両方が対象になります (TTL ポリシーもコレクショングループ単位で設定します)。
+        """
+        query = (
+            db.collection_group(ConversationRecord.COLLECTION)
+            .select(ConversationRecord.projection("timestamp", "expires_at"))
+            .order_by("__name__")
+            .limit(page_size)
+        )
+
+        updated = 0
+        last_doc = None
+        bulk_writer = db.bulk_writer()
+        try:
+            while True:
+                page = query.start_after(last_doc) if last_doc else query
+                docs = list(page.stream())
+                if not docs:
+                    break
+                for doc in docs:
+                    data = doc.to_dict()
+                    if data.get("expires_at") or not data.get("timestamp"):
+                        continue
+                    bulk_writer.update(
+                        doc.reference,
+                        {"expires_at": data["timestamp"] + CONVERSATION_TTL},
+                    )
+                    updated += 1
+                bulk_writer.flush()
+                last_doc = docs[-1]
+                if len(docs) < page_size:
+                    break
+        finally:
+            bulk_writer.close()
+        return updated
+
+    @staticmethod
+    def delete_all_conversations(
+        db, user_id: str, page_size: int = DELETE_PAGE_SIZE
+    ) -> int:
+        """
+        該当ユーザーの会話バッファと旧形式の会話履歴 (conversations と
+        users/{id}/conversations) をすべて削除し、削除した旧形式のドキュメント数を返します。
+        旧形式はカーソルで page_size 件ずつ読み、BulkWriter でまとめて削除します。
+        途中で中断されても、再実行すれば残りのドキュメントから再開できます。
+        """
+        deleted = 0
+        bulk_writer = db.bulk_writer()
+        try:
+            for query in ConversationRecord.legacy_queries(db, user_id):
+                query = query.select(["__name__"]).order_by("__name__").limit(page_size)
+                last_doc = None
+                while True:
+                    page = query.start_after(last_doc) if last_doc else query
+                    docs = list(page.stream())
+                    if not docs:
+                        break
+                    for doc in docs:
+                        bulk_writer.delete(doc.reference)
+                    # ページごとに書き込みを確定させ、中断時の取りこぼしを小さくする
+                    bulk_writer.flush()
+                    deleted += len(docs)
+                    last_doc = docs[-1]
+                    if len(docs) < page_size:
+                        break
+        finally:
+            bulk_writer.close()
+
+        ConversationBuffer.ref(db, user_id).delete()
+        return deleted
 
     @staticmethod
     def get_conversation_count(db, user_id: str) -> int:
         """
-        該当ユーザーの会話が現在何回続いているかを返します（ドキュメント数をカウント）。
+        該当ユーザーの会話が現在何回続いているかを返します。
+        会話バッファに追記時に加算される total を1回のポイントリードで取得します。
+        会話バッファがまだないユーザーは、旧形式の会話履歴を集計クエリで数えます。
         """
-        ref = ConversationRecord.collection(db)
-        query = ref.where(filter=FieldFilter("user_id", "==", user_id))
-        docs = query.stream()
-        return len(list(docs))
+        # turns は読まず、total だけを取得する
+        doc = ConversationBuffer.ref(db, user_id).get(field_paths=["total"])
+        if doc.exists:
+            return doc.to_dict().get("total", 0)
+        return ConversationRecord.count_legacy_conversations(db, user_id)
+
+    @staticmethod
+    def legacy_queries(db, user_id: str) -> list:
+        """
+        旧形式の会話履歴 (conversations と users/{id}/conversations) のクエリを返します。
+        """
+        return [
+            ConversationRecord.collection(db).where(
+                filter=FieldFilter("user_id", "==", user_id)
+            ),
+            db.collection("users")
+            .document(user_id)
+            .collection(ConversationRecord.COLLECTION),
+        ]
+
+    @staticmethod
+    def count_legacy_conversations(db, user_id: str) -> int:
+        """
+        旧形式の会話履歴のドキュメント数を返します。
+        """
+        return sum(
+            ConversationRecord._count(query)
+            for query in ConversationRecord.legacy_queries(db, user_id)
+        )
+
+    @staticmethod
+    def _count(query) -> int:
+        """
+        count 集計に対応したクライアントでは集計クエリで (1000 件ごとに1読み取り)、
+        対応していなければドキュメント ID だけを読んで数えます。
+        """
+        if not callable(getattr(query, "count", None)):
+            return sum(1 for _ in query.select(["__name__"]).stream())
+        results = query.count(alias="count").get()
+        return int(results[0][0].value)
+
+
+class ConversationBuffer:
+    """
+    ユーザーごとの直近 CONVERSATION_BUFFER_SIZE ターンを1ドキュメントに保持するリングバッファ
+
+    compact で古いターンを summary に畳み込み、直近 CONVERSATION_WINDOW_TURNS ターンだけを
+    turns に残します。summarized はこれまでに要約へ畳み込んだターン数 (total の中での位置)、
+    size は turns の長さで、圧縮が必要なバッファの検索に使います。
+    """
+
+    COLLECTION = "conversation_buffers"
+
+    @staticmethod
+    def ref(db, user_id: str):
+        return db.collection(ConversationBuffer.COLLECTION).document(user_id)
+
+    @staticmethod
+    def _to_turn(record: ConversationRecord) -> dict:
+        return {f: getattr(record, f) for f in ConversationRecord.TURN_FIELDS}
+
+    @staticmethod
+    def append(db, user_id: str, records: list, size: int = CONVERSATION_BUFFER_SIZE):
+        """
+        会話を追記し、古いターンを size 件を超えた分だけ切り捨てます。
+        読み取りと書き込みは1つのトランザクションで行います。
+        """
+        doc_ref = ConversationBuffer.ref(db, user_id)
+        new_turns = [ConversationBuffer._to_turn(r) for r in records]
+
+        @firestore.transactional
+        def _append(transaction):
+            doc = doc_ref.get(transaction=transaction)
+            data = doc.to_dict() if doc.exists else {}
+            turns = (data.get("turns", []) + new_turns)[-size:]
+            # 要約 (summary / summarized) はそのまま引き継ぐ
+            transaction.set(
+                doc_ref,
+                dict(
+                    data,
+                    user_id=user_id,
+                    turns=turns,
+                    size=len(turns),
+                    total=data.get("total", 0) + len(new_turns),
+                    updated=new_turns[-1]["timestamp"],
+                    expires_at=datetime.now(timezone.utc) + CONVERSATION_TTL,
+                ),
+            )
+
+        _append(db.transaction())
+
+    @staticmethod
+    def migrate_legacy(db, user_id: str, size: int = CONVERSATION_BUFFER_SIZE) -> int:
+        """
+        旧形式の会話履歴の直近 size 件を会話バッファに取り込み、取り込んだターン数を返します。
+        取り込み後のバッファには migrated を付け、再実行しても二重には取り込みません。
+        """
+        doc_ref = ConversationBuffer.ref(db, user_id)
+        doc = doc_ref.get(field_paths=["migrated"])
+        if doc.exists and doc.to_dict().get("migrated"):
+            return 0
+
+        legacy = []
+        for query in ConversationRecord.legacy_queries(db, user_id):
+            query = query.order_by("timestamp", direction="DESCENDING").limit(size)
+            legacy += [
+                ConversationRecord.from_dict(d.to_dict()) for d in query.stream()
+            ]
+        if not legacy:
+            return 0
+        legacy_total = ConversationRecord.count_legacy_conversations(db, user_id)
+        legacy.sort(key=lambda r: r.timestamp)
+        legacy_turns = [ConversationBuffer._to_turn(r) for r in legacy[-size:]]
+
+        @firestore.transactional
+        def _migrate(transaction) -> bool:
+            doc = doc_ref.get(transaction=transaction)
+            data = doc.to_dict() if doc.exists else {}
+            if data.get("migrated"):
+                return False
+            # デプロイ後に追記されたターンと合わせて、時系列順に size 件まで残す
+            turns = sorted(
+                legacy_turns + data.get("turns", []), key=lambda t: t["timestamp"]
+            )[-size:]
+            transaction.set(
+                doc_ref,
+                dict(
+                    data,
+                    user_id=user_id,
+                    turns=turns,
+                    size=len(turns),
+                    total=data.get("total", 0) + legacy_total,
+                    updated=turns[-1]["timestamp"],
+                    expires_at=datetime.now(timezone.utc) + CONVERSATION_TTL,
+                    migrated=True,
+                ),
+            )
+            return True
+
+        if not _migrate(db.transaction()):
+            return 0
+        return len(legacy_turns)
+
+    @staticmethod
+    def get(db, user_id: str) -> list:
+        """
+        バッファ内の会話を古い順の ConversationRecord のリストとして返します。
+        """
+        return ConversationBuffer.get_context(db, user_id)[1]
+
+    @staticmethod
+    def get_context(db, user_id: str) -> tuple:
+        """
+        古いやり取りの要約 (なければ空文字) と、バッファ内の会話を古い順に返します。
+        """
+        doc = ConversationBuffer.ref(db, user_id).get()
+        if not doc.exists:
+            return "", []
+        data = doc.to_dict()
+        return data.get("summary", ""), ConversationBuffer._to_records(
+            user_id, data.get("turns", [])
+        )
+
+    @staticmethod
+    def _to_records(user_id: str, turns: list) -> list:
+        records = [
+            ConversationRecord.from_dict(dict(turn, user_id=user_id)) for turn in turns
+        ]
+        return sorted(records, key=lambda r: r.timestamp)
+
+    @staticmethod
+    def compact(
+        db, user_id: str, summarizer, window: int = CONVERSATION_WINDOW_TURNS
+    ) -> int:
+        """
+        直近 window ターンより古いターンを summarizer で要約に畳み込み、畳み込んだターン数を返します。
+        要約の生成はトランザクションの外で行い、書き込み時に別の圧縮と競合していれば何もしません。
+        """
+        doc_ref = ConversationBuffer.ref(db, user_id)
+        doc = doc_ref.get()
+        if not doc.exists:
+            return 0
+        data = doc.to_dict()
+        turns = data.get("turns", [])
+        if len(turns) <= window:
+            return 0
+
+        # 畳み込むのは total の中で cut より前のターン
+        cut = data.get("total", 0) - window
+        records = ConversationBuffer._to_records(user_id, turns[:-window])
+        summary = summarizer.summarize(data.get("summary", ""), records)
+
+        @firestore.transactional
+        def _compact(transaction) -> bool:
+            current = doc_ref.get(transaction=transaction)
+            if not current.exists:
+                return False
+            latest = current.to_dict()
+            if latest.get("summarized", 0) != data.get("summarized", 0):
+                return False
+            # 要約を作っている間に追記されたターンは残す
+            start = latest.get("total", 0) - len(latest.get("turns", []))
+            remaining = latest.get("turns", [])[max(0, cut - start) :]
+            transaction.update(
+                doc_ref,
+                {
+                    "summary": summary,
+                    "summarized": cut,
+                    "turns": remaining,
+                    "size": len(remaining),
+                },
+            )
+            return True
+
+        if not _compact(db.transaction()):
+            return 0
+        return len(records)
+
+    @staticmethod
+    def compact_all(
+        db,
+        summarizer,
+        window: int = CONVERSATION_WINDOW_TURNS,
+        page_size: int = DELETE_PAGE_SIZE,
+    ) -> dict:
+        """
+        size が window を超えているバッファを page_size 件ずつ読み、順に圧縮します。
+        要約に失敗したユーザーは飛ばし、次回の実行で再び対象になります。
+        """
+        query = (
+            db.collection(ConversationBuffer.COLLECTION)
+            .where(filter=FieldFilter("size", ">", window))
+            .select(["size"])
+            .order_by("size")
+            .order_by("__name__")
+            .limit(page_size)
+        )
+
+        stats = {"users": 0, "turns": 0, "errors": 0}
+        last_doc = None
+        while True:
+            page = query.start_after(last_doc) if last_doc else query
+            docs = list(page.stream())
+            if not docs:
+                break
+            for doc in docs:
+                try:
+                    folded = ConversationBuffer.compact(db, doc.id, summarizer, window)
+                except Exception as e:
+                    logger.error("compaction failed for %s: %s", doc.id, e)
+                    stats["errors"] += 1
+                    continue
+                stats["users"] += 1 if folded else 0
+                stats["turns"] += folded
+            last_doc = docs[-1]
+            if len(docs) < page_size:
+                break
+        return stats
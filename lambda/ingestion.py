@@ -0,0 +1,429 @@
+"""
+ニュース収集パイプライン
+
+複数のニュースソースを asyncio で並行に取得し (ホストごとに同時接続数を制限)、
+SimHash で似た記事をクラスタにまとめ、取り上げたソースの多いクラスタから順に
+言語ごとのニュースを1件作成して news コレクションに保存します。キーワードは
+トップのクラスタの見出しに共通する語から選び、質問の例文に使います。
+取得処理 (Fetcher) は差し替えられるため、フィクスチャを使ってオフラインで実行できます。
+
+    python ingestion.py --sources sources.json
+    python ingestion.py --sources sources.json --fixtures ../benchmarks/fixtures/feeds --local
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import re
+import sys
+import urllib.request
+import xml.etree.ElementTree as ET
+from collections import Counter
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+from news import News
+from news_index import tokenize
+from user import LANGUAGE_CODE
+
+logger = logging.getLogger(__name__)
+
+PER_HOST_CONNECTIONS = 2
+TOTAL_CONNECTIONS = 16
+FETCH_TIMEOUT_SECONDS = 10
+SIMHASH_BITS = 64
+SIMHASH_MAX_DISTANCE = 10
+# 64bit を帯に分け、いずれかの帯が一致したものだけ距離を比べる。距離 d の2つの
+# ハッシュは高々 d 個の帯でしか異ならないため、帯が d + 1 個あれば取りこぼさない
+SIMHASH_BANDS = SIMHASH_MAX_DISTANCE + 1
+TOP_CLUSTERS = 5
+
+# キーワードの候補: 英数字の語・カタカナ語・2文字以上の漢字語 (ひらがなや記号で区切る)
+_KEYWORD_SEGMENT = re.compile(
+    r"[A-Za-z0-9][A-Za-z0-9+#.]*[A-Za-z0-9+#]|[A-Za-z0-9]"
+    r"|[\u30a1-\u30fa\u30fc]{2,}|[\u4e00-\u9fff\u3005]{2,}"
+)
+# 連結してキーワードにする語の最大数 (例: "AI" + "エージェント")
+KEYWORD_MAX_SEGMENTS = 3
+# ニュースの見出しによく出るが、話題を表さない語
+KEYWORD_STOPWORDS = {
+    LANGUAGE_CODE["JA"]: {
+        "発表",
+        "公開",
+        "開始",
+        "提供",
+        "正式",
+        "リリース",
+        "予定",
+        "前年比",
+    },
+    LANGUAGE_CODE["EN"]: {
+        "a",
+        "an",
+        "and",
+        "announces",
+        "for",
+        "in",
+        "is",
+        "launches",
+        "new",
+        "now",
+        "of",
+        "on",
+        "releases",
+        "the",
+        "to",
+        "unveils",
+        "with",
+    },
+}
+
+SAMPLE_QUESTION_TEMPLATE = {
+    LANGUAGE_CODE["JA"]: "{keyword}関連のニュースはありますか？",
+    LANGUAGE_CODE["EN"]: "Is there any news about {keyword}?",
+}
+
+
+class Article:
+    def __init__(
+        self,
+        source: str,
+        title: str,
+        summary: str,
+        url: str,
+        language_code: str,
+        published: datetime = None,
+    ):
+        self.source = source
+        self.title = title
+        self.summary = summary
+        self.url = url
+        self.language_code = language_code
+        self.published = published if published else datetime.now(timezone.utc)
+        self.fingerprint = simhash(f"{title} {summary}")
+
+    @staticmethod
+    def from_dict(source: dict, source_name: str, language_code: str) -> "Article":
+        published = source.get("published")
+        if isinstance(published, str):
+            published = datetime.fromisoformat(published)
+            if published.tzinfo is None:
+                published = published.replace(tzinfo=timezone.utc)
+        return Article(
+            source=source_name,
+            title=source.get("title", ""),
+            summary=source.get("summary", ""),
+            url=source.get("url", ""),
+            language_code=language_code,
+            published=published,
+        )
+
+
+def simhash(text: str, bits: int = SIMHASH_BITS) -> int:
+    # 各ビットについて、そのビットが立っているトークンの重みの合計を数え、
+    # 全体の重みの半分を超えたビットを立てる
+    set_weights = [0] * bits
+    total = 0
+    for token, count in Counter(tokenize(text)).items():
+        digest = hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest()
+        h = int.from_bytes(digest, "big") & ((1 << bits) - 1)
+        total += count
+        while h:
+            low = h & -h
+            set_weights[low.bit_length() - 1] += count
+            h ^= low
+    return sum(1 << i for i, w in enumerate(set_weights) if 2 * w > total)
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+class FixtureFetcher:
+    """
+    {fixtures_dir}/{source名}.json に保存された記事の一覧を返す
+    """
+
+    def __init__(self, fixtures_dir: str):
+        self.fixtures_dir = fixtures_dir
+
+    async def fetch(self, source: dict) -> list:
+        path = os.path.join(self.fixtures_dir, f"{source['name']}.json")
+        with open(path, encoding="utf-8") as f:
+            items = json.load(f)
+        return [
+            Article.from_dict(item, source["name"], source["language_code"])
+            for item in items
+        ]
+
+
+class RssFetcher:
+    """
+    RSS 2.0 のフィードを取得する。ブロッキングな通信はスレッドで実行する
+    """
+
+    def __init__(self, timeout: float = FETCH_TIMEOUT_SECONDS):
+        self.timeout = timeout
+
+    def _get(self, url: str) -> bytes:
+        with urllib.request.urlopen(url, timeout=self.timeout) as response:
+            return response.read()
+
+    async def fetch(self, source: dict) -> list:
+        body = await asyncio.to_thread(self._get, source["url"])
+        return RssFetcher.parse(body, source)
+
+    @staticmethod
+    def parse(body: bytes, source: dict) -> list:
+        articles = []
+        for item in ET.fromstring(body).iter("item"):
+            articles.append(
+                Article(
+                    source=source["name"],
+                    title=(item.findtext("title") or "").strip(),
+                    summary=(item.findtext("description") or "").strip(),
+                    url=(item.findtext("link") or "").strip(),
+                    language_code=source["language_code"],
+                    published=parse_pub_date(item.findtext("pubDate")),
+                )
+            )
+        return articles
+
+
+def parse_pub_date(value: str) -> datetime:
+    """
+    RSS の pubDate (RFC 822) を UTC 付きの datetime にする。
+    ないか読めなければ None を返し、Article は取得時刻を公開日時とする
+    """
+    if not value or not value.strip():
+        return None
+    try:
+        published = parsedate_to_datetime(value.strip())
+    except (TypeError, ValueError):
+        logger.warning("unparseable pubDate: %s", value)
+        return None
+    # タイムゾーンが "-0000" (不明) の日時は UTC とみなす
+    if published.tzinfo is None:
+        published = published.replace(tzinfo=timezone.utc)
+    return published
+
+
+async def fetch_all(
+    sources: list,
+    fetcher,
+    per_host: int = PER_HOST_CONNECTIONS,
+    total: int = TOTAL_CONNECTIONS,
+) -> list:
+    """
+    全ソースを並行に取得する。失敗したソースはログに残して飛ばす
+    """
+    global_limit = asyncio.Semaphore(total)
+    host_limits = {}
+
+    async def fetch_one(source):
+        host = urlparse(source.get("url", "")).netloc or source["name"]
+        host_limit = host_limits.setdefault(host, asyncio.Semaphore(per_host))
+        # ホストの枠を先に取る (全体の枠を持ったまま同じホストの順番を待たない)
+        async with host_limit, global_limit:
+            try:
+                return await fetcher.fetch(source)
+            except Exception as e:
+                logger.warning("failed to fetch %s: %s", source["name"], e)
+                return []
+
+    results = await asyncio.gather(*(fetch_one(s) for s in sources))
+    return [article for articles in results for article in articles]
+
+
+def cluster_articles(
+    articles: list,
+    max_distance: int = SIMHASH_MAX_DISTANCE,
+    bands: int = SIMHASH_BANDS,
+) -> list:
+    """
+    SimHash の距離が max_distance 以下の記事を同じクラスタにまとめる (Union-Find)
+    """
+    if bands <= max_distance:
+        raise ValueError(f"bands must exceed max_distance ({max_distance})")
+    parent = list(range(len(articles)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    # 64bit を余りなく帯に割り振る (11 帯なら 6bit が 9 つと 5bit が 2 つ)
+    spans = []
+    offset = 0
+    for band in range(bands):
+        width = SIMHASH_BITS // bands + (1 if band < SIMHASH_BITS % bands else 0)
+        spans.append((offset, (1 << width) - 1))
+        offset += width
+
+    buckets = {}
+    for i, article in enumerate(articles):
+        for band, (shift, mask) in enumerate(spans):
+            key = (band, (article.fingerprint >> shift) & mask)
+            for j in buckets.get(key, []):
+                if (
+                    find(i) != find(j)
+                    and hamming(article.fingerprint, articles[j].fingerprint)
+                    <= max_distance
+                ):
+                    parent[find(i)] = find(j)
+            buckets.setdefault(key, []).append(i)
+
+    clusters = {}
+    for i, article in enumerate(articles):
+        clusters.setdefault(find(i), []).append(article)
+    return list(clusters.values())
+
+
+def rank_clusters(clusters: list) -> list:
+    """
+    取り上げたソースの数が多い順、同数なら新しい順に並べる
+    """
+    return sorted(
+        clusters,
+        key=lambda c: (len({a.source for a in c}), max(a.published for a in c)),
+        reverse=True,
+    )
+
+
+def keyword_candidates(title: str, language_code: str) -> set:
+    """
+    見出しから、続けて書かれた (間が空白1つまでの) 語を KEYWORD_MAX_SEGMENTS 個まで
+    連結した候補を作る。数字だけの候補と、ストップワードを含む候補は除く
+    """
+    stopwords = KEYWORD_STOPWORDS.get(language_code, set())
+    runs = [[]]
+    end = 0
+    for match in _KEYWORD_SEGMENT.finditer(title):
+        word = match.group()
+        if word.lower() in stopwords or title[end : match.start()] not in ("", " "):
+            runs.append([])
+        if word.lower() not in stopwords:
+            runs[-1].append(match)
+        end = match.end()
+
+    candidates = set()
+    for run in runs:
+        for i in range(len(run)):
+            for j in range(i + 1, min(i + KEYWORD_MAX_SEGMENTS, len(run)) + 1):
+                term = title[run[i].start() : run[j - 1].end()]
+                if not term.isdigit():
+                    candidates.add(term)
+    return candidates
+
+
+def extract_keyword(cluster: list, clusters: list, language_code: str) -> str:
+    """
+    cluster の見出しから、多くのソースの見出しに含まれ、他のクラスタの見出しには
+    少ない語を選ぶ。同点なら長い語。候補がなければ代表記事の見出しを返す
+    """
+    titles = [(a.source, a.title.lower()) for a in cluster]
+    other_titles = [a.title.lower() for c in clusters if c is not cluster for a in c]
+
+    def score(term: str) -> tuple:
+        lowered = term.lower()
+        sources = {source for source, title in titles if lowered in title}
+        others = sum(1 for title in other_titles if lowered in title)
+        return len(sources), -others, len(term)
+
+    candidates = set()
+    for article in cluster:
+        candidates |= keyword_candidates(article.title, language_code)
+    if not candidates:
+        return max(cluster, key=lambda a: a.published).title
+    return max(sorted(candidates), key=score)
+
+
+def build_news(language_code: str, clusters: list, top: int = TOP_CLUSTERS) -> News:
+    """
+    上位のクラスタから代表記事を1件ずつ選び、1件のニュースにまとめる
+    """
+    ranked = rank_clusters(clusters)[:top]
+    if not ranked:
+        return None
+    # 代表記事はクラスタ内で最も新しい記事
+    leads = [max(c, key=lambda a: a.published) for c in ranked]
+    if language_code == LANGUAGE_CODE["JA"]:
+        content = "".join(f"{a.title}。{a.summary}" for a in leads)
+    else:
+        content = " ".join(f"{a.title}. {a.summary}" for a in leads)
+    keyword = extract_keyword(ranked[0], clusters, language_code)
+    template = SAMPLE_QUESTION_TEMPLATE.get(
+        language_code, SAMPLE_QUESTION_TEMPLATE[LANGUAGE_CODE["EN"]]
+    )
+    return News(
+        content=content,
+        sample_question=template.format(keyword=keyword),
+        keyword=keyword,
+        language_code=language_code,
+    )
+
+
+async def ingest(db, sources: list, fetcher, dry_run: bool = False) -> list:
+    articles = await fetch_all(sources, fetcher)
+    by_language = {}
+    for article in articles:
+        by_language.setdefault(article.language_code, []).append(article)
+
+    saved = []
+    for language_code, language_articles in by_language.items():
+        clusters = cluster_articles(language_articles)
+        news = build_news(language_code, clusters)
+        if news is None:
+            continue
+        logger.info(
+            "%s: %d articles -> %d clusters",
+            language_code,
+            len(language_articles),
+            len(clusters),
+        )
+        if not dry_run:
+            news.save(db)
+        saved.append(news)
+    return saved
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sources", required=True, help="ソース一覧のJSON")
+    parser.add_argument(
+        "--fixtures", help="フィクスチャのディレクトリ (オフライン実行)"
+    )
+    parser.add_argument(
+        "--local", action="store_true", help="インメモリ Firestore に保存する"
+    )
+    parser.add_argument("--dry-run", action="store_true", help="保存しない")
+    args = parser.parse_args()
+
+    with open(args.sources, encoding="utf-8") as f:
+        sources = json.load(f)
+
+    fetcher = FixtureFetcher(args.fixtures) if args.fixtures else RssFetcher()
+    if args.local or args.dry_run:
+        # インメモリ Firestore はデプロイするパッケージに含めず、benchmarks/ に置いている
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        sys.path.insert(0, os.path.join(root, "benchmarks"))
+        from firestore_fake import FakeClient
+
+        db = FakeClient()
+    else:
+        from clients import get_db
+
+        db = get_db()
+
+    for news in asyncio.run(ingest(db, sources, fetcher, dry_run=args.dry_run)):
+        print(f"[{news.language_code}] {news.keyword}\n{news.content}\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,32 +1,128 @@
 # -*- coding: utf-8 -*-
 
-import os
-import json
+import importlib
 import logging
+import os
+import time
 
-from ask_sdk_core.skill_builder import SkillBuilder
+from ask_sdk_core.api_client import DefaultApiClient
+from ask_sdk_core.skill_builder import CustomSkillBuilder
 from ask_sdk_core.dispatch_components import AbstractRequestHandler
 from ask_sdk_core.dispatch_components import AbstractExceptionHandler
+from ask_sdk_core.dispatch_components import (
+    AbstractRequestInterceptor,
+    AbstractResponseInterceptor,
+)
 import ask_sdk_core.utils as ask_utils
 from ask_sdk_core.handler_input import HandlerInput
 from ask_sdk_model import Response
-import firebase_admin
-from firebase_admin import credentials, firestore
-import google.generativeai as genai
-from alexa_handler import AlexaHandler
+from ask_sdk_model.services.directive import (
+    Header,
+    SendDirectiveRequest,
+    SpeakDirective,
+)
+from clients import get_async_db, get_db, run_async
+import metrics
+import tracing
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
-# GenAI initialization
-genai.configure(api_key=os.environ["GENAI_API_KEY"])
+# AnswerIntent で回答作成中のときの待ち方: off (待たない) / listen / poll
+ANSWER_WAIT_MODE = os.environ.get("ANSWER_WAIT_MODE", "off")
+# Alexa がスキルの応答を待つ時間
+ALEXA_RESPONSE_TIMEOUT_SECONDS = 8.0
+# 待機を打ち切ってから応答を組み立てて返すまでの余裕
+RESPONSE_MARGIN_SECONDS = 1.5
+
+
+def get_alexa_handler():
+    """
+    Firestoreを使うハンドラーが呼ばれた時点で初めてモデル層をimportする
+    """
+    from alexa_handler import AlexaHandler
+
+    return AlexaHandler
+
+
+def is_warmup_event(event) -> bool:
+    """
+    EventBridge のスケジュール (aws.events) または {"warmup": true} の呼び出しか
+    """
+    return isinstance(event, dict) and (
+        event.get("source") == "aws.events" or bool(event.get("warmup"))
+    )
+
+
+def warm_up() -> dict:
+    """
+    ウォームアップの呼び出しで、最初のユーザーが払うはずの初期化を先に済ませる。
+    モデル層と意味的キャッシュの import、Firestore (同期・非同期) のチャネル確立、言語ごとの最新ニュースの
+    キャッシュを順に行い、実行したステップと所要時間を返す。失敗したステップは記録して続ける
+    """
+    steps = {}
+    errors = {}
+
+    def step(name, func):
+        start = time.perf_counter()
+        try:
+            func()
+        except Exception as e:
+            logger.warning("warm-up step %s failed: %s", name, e)
+            errors[name] = str(e)
+            return
+        steps[name] = round((time.perf_counter() - start) * 1000, 3)
+
+    step("imports", get_alexa_handler)
+    # 質問の受け付けでだけ使う (numpy を読み込む) モジュール
+    step("semantic_cache", lambda: importlib.import_module("semantic_cache"))
+    from news import News
+    from user import LANGUAGE_CODE
+
+    # ニュースのバージョンは小さなドキュメントなので、チャネルを開く読み取りに使う
+    step("firestore", lambda: News.get_version(get_db(), LANGUAGE_CODE["JA"]))
+    step(
+        "firestore_async",
+        lambda: run_async(News.get_version_async(get_async_db(), LANGUAGE_CODE["JA"])),
+    )
+    for language_code in LANGUAGE_CODE.values():
+        step(
+            f"news:{language_code}",
+            lambda: News.get_latest_news(get_db(), language_code),
+        )
+
+    metrics.mark_warm()
+    report = {"warmup": True, "steps": steps, "errors": errors}
+    logger.info("warm-up: %s", report)
+    return report
+
 
-# Firestore initialization
-if not firebase_admin._apps:
-    SERVICE_ACCOUNT_KEY = os.environ["SERVICE_ACCOUNT_KEY"]
-    cred = credentials.Certificate(json.loads(SERVICE_ACCOUNT_KEY))
-    firebase_admin.initialize_app(cred)
-db = firestore.client()
+def get_wait_deadline(handler_input):
+    """
+    Alexa の応答待ち時間と Lambda の残り時間の短い方から、回答を待てる期限
+    (time.monotonic の値) を求める
+    """
+    budget = ALEXA_RESPONSE_TIMEOUT_SECONDS - metrics.elapsed_seconds()
+    context = handler_input.context
+    if context is not None and hasattr(context, "get_remaining_time_in_millis"):
+        budget = min(budget, context.get_remaining_time_in_millis() / 1000)
+    return time.monotonic() + budget - RESPONSE_MARGIN_SECONDS
+
+
+def send_progressive_response(handler_input, speech: str):
+    """
+    プログレッシブ応答で途中経過を読み上げる。失敗しても本来の応答は返す
+    """
+    try:
+        request_id = handler_input.request_envelope.request.request_id
+        handler_input.service_client_factory.get_directive_service().enqueue(
+            SendDirectiveRequest(
+                header=Header(request_id=request_id),
+                directive=SpeakDirective(speech=speech),
+            )
+        )
+    except Exception as e:
+        logger.warning("failed to send progressive response: %s", e)
 
 
 def get_language_code(locale: str):
@@ -46,8 +142,14 @@ class LaunchRequestHandler(AbstractRequestHandler):
         locale = handler_input.request_envelope.request.locale
         language_code = get_language_code(locale)
 
-        speak, ask = AlexaHandler.play_news(
-            user_id=user_id, language_code=language_code, db=db
+        # セッションの最初のリクエストなので、独立した読み取りを並行に行う
+        speak, ask = run_async(
+            get_alexa_handler().play_news_async(
+                user_id=user_id,
+                language_code=language_code,
+                db=get_async_db(),
+                session=handler_input.attributes_manager.session_attributes,
+            )
         )
 
         response_builder = handler_input.response_builder.speak(speak)
@@ -71,8 +173,12 @@ class QuestionIntentHandler(AbstractRequestHandler):
         locale = handler_input.request_envelope.request.locale
         language_code = get_language_code(locale)
 
-        speak, ask = AlexaHandler.receive_question(
-            user_id=user_id, language_code=language_code, question=query, db=db
+        speak, ask = get_alexa_handler().receive_question(
+            user_id=user_id,
+            language_code=language_code,
+            question=query,
+            db=get_db(),
+            session=handler_input.attributes_manager.session_attributes,
         )
 
         response_builder = handler_input.response_builder.speak(speak)
@@ -94,8 +200,22 @@ class AnswerIntentHandler(AbstractRequestHandler):
         locale = handler_input.request_envelope.request.locale
         language_code = get_language_code(locale)
 
-        speak, ask = AlexaHandler.answer(
-            user_id=user_id, language_code=language_code, db=db
+        wait = {}
+        if ANSWER_WAIT_MODE != "off":
+            wait = {
+                "wait_until": get_wait_deadline(handler_input),
+                "wait_mode": ANSWER_WAIT_MODE,
+                "progressive": lambda speech: send_progressive_response(
+                    handler_input, speech
+                ),
+            }
+
+        speak, ask = get_alexa_handler().answer(
+            user_id=user_id,
+            language_code=language_code,
+            db=get_db(),
+            session=handler_input.attributes_manager.session_attributes,
+            **wait,
         )
 
         response_builder = handler_input.response_builder.speak(speak)
@@ -117,8 +237,63 @@ class NewsIntentHandler(AbstractRequestHandler):
         locale = handler_input.request_envelope.request.locale
         language_code = get_language_code(locale)
 
-        speak, ask = AlexaHandler.play_news(
-            user_id=user_id, language_code=language_code, db=db
+        speak, ask = get_alexa_handler().play_news(
+            user_id=user_id,
+            language_code=language_code,
+            db=get_db(),
+            session=handler_input.attributes_manager.session_attributes,
+        )
+
+        response_builder = handler_input.response_builder.speak(speak)
+
+        if ask is not None:
+            response_builder.ask(ask)
+
+        return response_builder.response
+
+
+class NextIntentHandler(AbstractRequestHandler):
+    """ニュースの続きの再生"""
+
+    def can_handle(self, handler_input):
+        return ask_utils.is_intent_name("AMAZON.NextIntent")(handler_input)
+
+    def handle(self, handler_input):
+        user_id = handler_input.request_envelope.session.user.user_id
+        locale = handler_input.request_envelope.request.locale
+        language_code = get_language_code(locale)
+
+        speak, ask = get_alexa_handler().next_news(
+            user_id=user_id,
+            language_code=language_code,
+            db=get_db(),
+            session=handler_input.attributes_manager.session_attributes,
+        )
+
+        response_builder = handler_input.response_builder.speak(speak)
+
+        if ask is not None:
+            response_builder.ask(ask)
+
+        return response_builder.response
+
+
+class SkipIntentHandler(AbstractRequestHandler):
+    """ニュースの残りを飛ばす"""
+
+    def can_handle(self, handler_input):
+        return ask_utils.is_intent_name("SkipIntent")(handler_input)
+
+    def handle(self, handler_input):
+        user_id = handler_input.request_envelope.session.user.user_id
+        locale = handler_input.request_envelope.request.locale
+        language_code = get_language_code(locale)
+
+        speak, ask = get_alexa_handler().skip_news(
+            user_id=user_id,
+            language_code=language_code,
+            db=get_db(),
+            session=handler_input.attributes_manager.session_attributes,
         )
 
         response_builder = handler_input.response_builder.speak(speak)
@@ -213,6 +388,8 @@ class CatchAllExceptionHandler(AbstractExceptionHandler):
     def handle(self, handler_input, exception):
         # type: (HandlerInput, Exception) -> Response
         logger.error(exception, exc_info=True)
+        metrics.finish_request(error=True)
+        tracing.finish_trace(error=True)
 
         speak_output = "Sorry, I had trouble doing what you asked. Please try again."
 
@@ -223,20 +400,57 @@ class CatchAllExceptionHandler(AbstractExceptionHandler):
         )
 
 
+class MetricsRequestInterceptor(AbstractRequestInterceptor):
+    """リクエストごとの計測を開始する"""
+
+    def process(self, handler_input):
+        # type: (HandlerInput) -> None
+        if ask_utils.is_request_type("IntentRequest")(handler_input):
+            name = ask_utils.get_intent_name(handler_input)
+        else:
+            name = ask_utils.get_request_type(handler_input)
+        request_id = handler_input.request_envelope.request.request_id
+        metrics.start_request(name, request_id)
+        tracing.start_trace(f"alexa.{name}", request_id=request_id)
+
+
+class MetricsResponseInterceptor(AbstractResponseInterceptor):
+    """計測結果を EMF 形式のログとして1行出力する"""
+
+    def process(self, handler_input, response):
+        # type: (HandlerInput, Response) -> None
+        metrics.finish_request()
+        tracing.finish_trace()
+
+
 # The SkillBuilder object acts as the entry point for your skill, routing all request and response
 # payloads to the handlers above. Make sure any new handlers or interceptors you've
 # defined are included below. The order matters - they're processed top to bottom.
 
-sb = SkillBuilder()
+# プログレッシブ応答 (Directive サービス) を使うため API クライアントを渡す
+sb = CustomSkillBuilder(api_client=DefaultApiClient())
 
 sb.add_request_handler(LaunchRequestHandler())
 sb.add_request_handler(QuestionIntentHandler())
 sb.add_request_handler(AnswerIntentHandler())
 sb.add_request_handler(NewsIntentHandler())
+sb.add_request_handler(NextIntentHandler())
+sb.add_request_handler(SkipIntentHandler())
 sb.add_request_handler(HelpIntentHandler())
 sb.add_request_handler(CancelOrStopIntentHandler())
 sb.add_request_handler(SessionEndedRequestHandler())
 sb.add_request_handler(IntentReflectorHandler())
 sb.add_exception_handler(CatchAllExceptionHandler())
+sb.add_global_request_interceptor(MetricsRequestInterceptor())
+sb.add_global_response_interceptor(MetricsResponseInterceptor())
 
-handler = sb.lambda_handler()
+skill_handler = sb.lambda_handler()
+
+
+def handler(event, context):
+    """
+    Lambda のエントリーポイント。ウォームアップの呼び出しはスキルに渡さずに処理する
+    """
+    if is_warmup_event(event):
+        return warm_up()
+    return skill_handler(event, context)
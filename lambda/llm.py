@@ -0,0 +1,56 @@
+"""
+回答生成に使う LLM クライアント
+
+generate(prompt) -> str を持つオブジェクトであれば差し替えられます。
+generate_stream(prompt) で回答を断片ごとに返せるものは、ストリーミング生成にも使えます。
+"""
+
+import os
+import time
+
+from clients import get_genai
+
+DEFAULT_MODEL = "gemini-1.5-flash"
+
+
+class GenAILLM:
+    def __init__(self, model_name: str = None):
+        self.model_name = model_name or os.environ.get("GENAI_MODEL", DEFAULT_MODEL)
+        self._model = None
+
+    def generate(self, prompt: str) -> str:
+        if self._model is None:
+            self._model = get_genai().GenerativeModel(self.model_name)
+        response = self._model.generate_content(prompt)
+        return response.text.strip()
+
+    def generate_stream(self, prompt: str):
+        if self._model is None:
+            self._model = get_genai().GenerativeModel(self.model_name)
+        for chunk in self._model.generate_content(prompt, stream=True):
+            yield chunk.text
+
+
+class StubLLM:
+    """
+    ローカル実行用。プロンプトの末尾の質問をそのまま含む固定の回答を返す
+    """
+
+    def __init__(self, latency: float = 0.0, fail_times: int = 0):
+        self.latency = latency
+        self.fail_times = fail_times
+        self.calls = 0
+
+    def generate(self, prompt: str) -> str:
+        self.calls += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if self.calls <= self.fail_times:
+            raise RuntimeError("stub failure")
+        question = prompt.strip().splitlines()[-1]
+        return f"(stub) {question} への回答です。"
+
+    def generate_stream(self, prompt: str, chunk_chars: int = 8):
+        text = self.generate(prompt) + "詳細は続報をお待ちください。"
+        for i in range(0, len(text), chunk_chars):
+            yield text[i : i + chunk_chars]
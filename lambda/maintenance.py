@@ -0,0 +1,263 @@
+"""
+リクエスト外で実行するメンテナンス用のエントリーポイント
+
+    python maintenance.py delete-conversations USER_ID [USER_ID ...]
+    python maintenance.py compact-conversations [--window 6] [--stub]
+    python maintenance.py expire-legacy-conversations
+    python maintenance.py migrate-conversations [--page-size 500]
+    python maintenance.py rebuild-news-index
+    python maintenance.py build-briefings [--page-size 500]
+"""
+
+import argparse
+import logging
+from datetime import datetime, timedelta, timezone
+
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+from briefing import Briefing
+from clients import get_db
+from conversation_record import (
+    CONVERSATION_BUFFER_SIZE,
+    CONVERSATION_WINDOW_TURNS,
+    DELETE_PAGE_SIZE,
+    ConversationBuffer,
+    ConversationRecord,
+)
+from news import News
+from news_index import COLLECTION as NEWS_INDEX_COLLECTION, NewsIndex
+from question import Question
+from user import ACTIVE_USER_DAYS, User
+
+logger = logging.getLogger(__name__)
+
+
+def delete_conversations(db, user_ids, page_size: int = DELETE_PAGE_SIZE) -> int:
+    total = 0
+    for user_id in user_ids:
+        deleted = ConversationRecord.delete_all_conversations(
+            db, user_id, page_size=page_size
+        )
+        logger.info("deleted %d conversations for %s", deleted, user_id)
+        total += deleted
+    return total
+
+
+def compact_conversations(
+    db, summarizer, window: int = CONVERSATION_WINDOW_TURNS, page_size=DELETE_PAGE_SIZE
+) -> dict:
+    """
+    直近 window ターンより古い会話を、ユーザーごとの要約に畳み込む
+    """
+    stats = ConversationBuffer.compact_all(db, summarizer, window, page_size)
+    logger.info("compacted conversations: %s", stats)
+    return stats
+
+
+def migrate_conversations(
+    db, page_size: int = DELETE_PAGE_SIZE, size: int = CONVERSATION_BUFFER_SIZE
+) -> dict:
+    """
+    ユーザーを page_size 件ずつ読み、旧形式の会話履歴を会話バッファに取り込む。
+    取り込み済みのユーザーは飛ばすので、中断しても再実行すれば続きから進む
+    """
+    query = (
+        User.collection(db).select(["__name__"]).order_by("__name__").limit(page_size)
+    )
+
+    stats = {"users": 0, "turns": 0}
+    last_doc = None
+    while True:
+        page = query.start_after(last_doc) if last_doc else query
+        docs = list(page.stream())
+        if not docs:
+            break
+        for doc in docs:
+            turns = ConversationBuffer.migrate_legacy(db, doc.id, size)
+            stats["users"] += 1 if turns else 0
+            stats["turns"] += turns
+        last_doc = docs[-1]
+        if len(docs) < page_size:
+            break
+    logger.info("migrated conversations: %s", stats)
+    return stats
+
+
+def rebuild_news_index(db) -> int:
+    """
+    news コレクション全体から検索インデックスのシャードを作り直し、
+    同じバッチで言語ごとのバージョンを進めて、コンテナ内のインデックスを読み直させる
+    """
+    shards = {}
+    count = 0
+    for doc in News.get_collection(db).stream():
+        news = News.from_dict(doc.to_dict())
+        shard = shards.setdefault(
+            NewsIndex.shard_id(news), (news.language_code, NewsIndex())
+        )
+        shard[1].add_news(news)
+        count += 1
+
+    ref = db.collection(NEWS_INDEX_COLLECTION)
+    batch = db.batch()
+    for shard_id, (language_code, index) in shards.items():
+        batch.set(
+            ref.document(shard_id),
+            {"language_code": language_code, "blob": index.to_bytes()},
+        )
+    for language_code in {language_code for language_code, _ in shards.values()}:
+        News.bump_version(batch, db, language_code)
+    batch.commit()
+    logger.info("indexed %d news into %d shards", count, len(shards))
+    return count
+
+
+def build_briefings(db, page_size: int = DELETE_PAGE_SIZE) -> int:
+    """
+    last_active が ACTIVE_USER_DAYS 以内のユーザーを page_size 件ずつ読み、
+    最新ニュースのブリーフィングを書き込む。書き込んだ件数を返す
+    """
+    cutoff = datetime.now(timezone.utc) - timedelta(days=ACTIVE_USER_DAYS)
+    query = (
+        User.collection(db)
+        .where(filter=FieldFilter("last_active", ">=", cutoff))
+        .select(User.projection("last_active"))
+        .order_by("last_active")
+        .order_by("__name__")
+        .limit(page_size)
+    )
+
+    written = 0
+    last_doc = None
+    while True:
+        page = query.start_after(last_doc) if last_doc else query
+        docs = list(page.stream())
+        if not docs:
+            break
+        written += write_briefings(db, [doc.id for doc in docs])
+        last_doc = docs[-1]
+        if len(docs) < page_size:
+            break
+    logger.info("built %d briefings", written)
+    return written
+
+
+def write_briefings(db, user_ids: list) -> int:
+    """
+    ユーザーと質問を get_all でまとめて読み、ブリーフィングを1つのトランザクションで
+    書き込む。読んだ後に質問が受け付けられていれば (ブリーフィングの削除と競合するため)
+    トランザクションが読み直すので、古い応答を書き戻さない
+    """
+    from alexa_handler import AlexaHandler
+
+    user_refs = [User.collection(db).document(i) for i in user_ids]
+    question_refs = [Question.collection(db).document(i) for i in user_ids]
+
+    @firestore.transactional
+    def _write(transaction) -> int:
+        snapshots = {
+            snapshot.reference.path: snapshot
+            for snapshot in transaction.get_all(user_refs + question_refs)
+        }
+        written = 0
+        for user_ref, question_ref in zip(user_refs, question_refs):
+            user_doc = snapshots.get(user_ref.path)
+            if user_doc is None or not user_doc.exists:
+                continue
+            user = User.from_dict(dict(user_doc.to_dict(), id=user_doc.id))
+            latest_news = News.get_latest_news(db, user.language_code)
+            if not latest_news:
+                continue
+            question_doc = snapshots.get(question_ref.path)
+            if question_doc is not None and question_doc.exists:
+                user.set_cached_question(
+                    Question.from_dict(question_doc.to_dict()),
+                    version=question_doc.update_time,
+                )
+            else:
+                user.set_cached_question(None)
+            briefing = AlexaHandler.render_briefing(
+                user, latest_news, user.get_question(db)
+            )
+            transaction.set(Briefing.ref(db, user.id), briefing.to_dict())
+            written += 1
+        return written
+
+    return _write(db.transaction())
+
+
+def main():
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description=__doc__)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    delete_parser = subparsers.add_parser(
+        "delete-conversations", help="ユーザーの会話履歴を一括削除する"
+    )
+    delete_parser.add_argument("user_ids", nargs="+")
+    delete_parser.add_argument("--page-size", type=int, default=DELETE_PAGE_SIZE)
+
+    compact_parser = subparsers.add_parser(
+        "compact-conversations", help="古い会話を要約に畳み込む"
+    )
+    compact_parser.add_argument("--window", type=int, default=CONVERSATION_WINDOW_TURNS)
+    compact_parser.add_argument("--page-size", type=int, default=DELETE_PAGE_SIZE)
+    compact_parser.add_argument(
+        "--stub", action="store_true", help="スタブの要約器を使う"
+    )
+
+    expire_parser = subparsers.add_parser(
+        "expire-legacy-conversations",
+        help="旧形式の会話履歴に TTL 用の expires_at を書き込む",
+    )
+    expire_parser.add_argument("--page-size", type=int, default=DELETE_PAGE_SIZE)
+
+    migrate_parser = subparsers.add_parser(
+        "migrate-conversations",
+        help="旧形式の会話履歴を会話バッファに取り込む",
+    )
+    migrate_parser.add_argument("--page-size", type=int, default=DELETE_PAGE_SIZE)
+
+    subparsers.add_parser(
+        "rebuild-news-index", help="ニュースの検索インデックスを作り直す"
+    )
+
+    briefing_parser = subparsers.add_parser(
+        "build-briefings",
+        help="アクティブなユーザーごとの LaunchRequest の応答を作り直す",
+    )
+    briefing_parser.add_argument("--page-size", type=int, default=DELETE_PAGE_SIZE)
+
+    args = parser.parse_args()
+    if args.command == "rebuild-news-index":
+        total = rebuild_news_index(get_db())
+        print(f"indexed {total} news")
+    elif args.command == "build-briefings":
+        total = build_briefings(get_db(), args.page_size)
+        print(f"built {total} briefings")
+    elif args.command == "compact-conversations":
+        if args.stub:
+            from summarizer import StubSummarizer
+
+            summarizer = StubSummarizer()
+        else:
+            from llm import GenAILLM
+            from summarizer import LLMSummarizer
+
+            summarizer = LLMSummarizer(GenAILLM())
+        stats = compact_conversations(get_db(), summarizer, args.window, args.page_size)
+        print(f"compacted {stats['turns']} turns for {stats['users']} users")
+    elif args.command == "expire-legacy-conversations":
+        total = ConversationRecord.expire_legacy_conversations(get_db(), args.page_size)
+        print(f"set expires_at on {total} documents")
+    elif args.command == "migrate-conversations":
+        stats = migrate_conversations(get_db(), args.page_size)
+        print(f"migrated {stats['turns']} turns for {stats['users']} users")
+    elif args.command == "delete-conversations":
+        total = delete_conversations(get_db(), args.user_ids, args.page_size)
+        print(f"deleted {total} documents")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,233 @@
+"""
+リクエスト単位のレイテンシと Firestore 操作数の計測
+
+instrument() で包んだ Firestore クライアント経由の呼び出しを数え、
+リクエストの終わりに CloudWatch Embedded Metric Format (EMF) の
+JSON を1行出力します。on_snapshot のリスナーに届いたスナップショットも
+読み取りとして数えます。RPC ごとのスパンも tracing に記録します。
+"""
+
+import contextvars
+import inspect
+import json
+import time
+
+import tracing
+
+NAMESPACE = "TechCurator"
+
+# RPC を伴う呼び出し。戻り値はラップせず、そのまま返す
+_RPC_METHODS = {
+    "get",
+    "stream",
+    "get_all",
+    "commit",
+    "flush",
+    "close",
+    "_begin",
+    "_commit",
+}
+# 書き込み操作 (バッチ・トランザクションへの追加も1件として数える)
+_WRITE_METHODS = {"set", "update", "delete", "create"}
+
+_current = contextvars.ContextVar("request_metrics", default=None)
+_cold_start = True
+
+
+class RequestMetrics:
+    def __init__(self, intent_name: str, request_id: str = None):
+        self.intent_name = intent_name
+        self.request_id = request_id
+        self.started = time.perf_counter()
+        self.firestore_ms = 0.0
+        self.reads = 0
+        self.writes = 0
+
+    def to_emf(self, cold_start: bool, error: bool) -> dict:
+        handler_ms = (time.perf_counter() - self.started) * 1000
+        return {
+            "_aws": {
+                "Timestamp": int(time.time() * 1000),
+                "CloudWatchMetrics": [
+                    {
+                        "Namespace": NAMESPACE,
+                        "Dimensions": [["Intent"]],
+                        "Metrics": [
+                            {"Name": "HandlerTime", "Unit": "Milliseconds"},
+                            {"Name": "FirestoreTime", "Unit": "Milliseconds"},
+                            {"Name": "FirestoreReads", "Unit": "Count"},
+                            {"Name": "FirestoreWrites", "Unit": "Count"},
+                            {"Name": "ColdStart", "Unit": "Count"},
+                            {"Name": "Error", "Unit": "Count"},
+                        ],
+                    }
+                ],
+            },
+            "Intent": self.intent_name,
+            "RequestId": self.request_id,
+            "HandlerTime": round(handler_ms, 3),
+            "FirestoreTime": round(self.firestore_ms, 3),
+            "FirestoreReads": self.reads,
+            "FirestoreWrites": self.writes,
+            "ColdStart": 1 if cold_start else 0,
+            "Error": 1 if error else 0,
+        }
+
+
+def start_request(intent_name: str, request_id: str = None) -> RequestMetrics:
+    metrics = RequestMetrics(intent_name, request_id)
+    _current.set(metrics)
+    return metrics
+
+
+def elapsed_seconds() -> float:
+    """
+    計測中のリクエストが始まってからの経過秒数
+    """
+    metrics = _current.get()
+    if metrics is None:
+        return 0.0
+    return time.perf_counter() - metrics.started
+
+
+def mark_warm():
+    """
+    ウォームアップ済みのコンテナでは、次のリクエストをコールドスタートとして数えない
+    """
+    global _cold_start
+    _cold_start = False
+
+
+def finish_request(error: bool = False) -> dict:
+    """
+    計測中のリクエストを閉じ、EMF の1行を標準出力に書き出して返す
+    """
+    global _cold_start
+    metrics = _current.get()
+    if metrics is None:
+        return None
+    _current.set(None)
+
+    record = metrics.to_emf(cold_start=_cold_start, error=error)
+    _cold_start = False
+    # Lambda のログ形式で前置きが付かないよう、logger ではなく print で出力する
+    print(json.dumps(record, ensure_ascii=False))
+    return record
+
+
+_PLAIN_TYPES = (str, bytes, int, float, bool, dict, list, tuple)
+
+
+def _unwrap(value):
+    if isinstance(value, _Instrumented):
+        return value._target
+    if isinstance(value, (list, tuple)):
+        return type(value)(_unwrap(v) for v in value)
+    return value
+
+
+def _record(metrics: RequestMetrics, name: str, result, start: float):
+    elapsed = time.perf_counter() - start
+    tracing.record(f"firestore.{name}", time.time() - elapsed)
+    if metrics is None:
+        return
+    metrics.firestore_ms += elapsed * 1000
+    if name in ("stream", "get_all", "get") and isinstance(result, list):
+        # 結果が0件のクエリも1読み取りとして課金される
+        metrics.reads += max(1, len(result))
+    elif name == "get":
+        metrics.reads += 1
+
+
+async def _timed_await(awaitable, name: str, metrics: RequestMetrics):
+    # 並行に待った時間はそれぞれ足し合わせる
+    start = time.perf_counter()
+    result = await awaitable
+    _record(metrics, name, result, start)
+    return result
+
+
+async def _timed_aiter(iterable, name: str, metrics: RequestMetrics):
+    start = time.perf_counter()
+    results = [item async for item in iterable]
+    _record(metrics, name, results, start)
+    for item in results:
+        yield item
+
+
+def _counted_listener(callback, metrics: RequestMetrics):
+    """
+    リスナーに届いたスナップショットを、リスナーを登録したリクエストの読み取りとして数える
+    (コールバックは別スレッドで呼ばれるため、contextvars ではなく登録時の metrics に足す)
+    """
+
+    def on_snapshot(snapshots, changes, read_time):
+        metrics.reads += len(snapshots)
+        return callback(snapshots, changes, read_time)
+
+    return on_snapshot
+
+
+class _Instrumented:
+    """
+    Firestore のクライアント・参照・クエリを包み、RPC の時間と読み書き数を記録する
+    """
+
+    __slots__ = ("_target",)
+
+    def __init__(self, target):
+        self._target = target
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def call(*args, **kwargs):
+            args = [_unwrap(a) for a in args]
+            kwargs = {k: _unwrap(v) for k, v in kwargs.items()}
+            metrics = _current.get()
+
+            if name in _WRITE_METHODS and metrics is not None:
+                metrics.writes += 1
+            if name == "on_snapshot" and metrics is not None:
+                args[0] = _counted_listener(args[0], metrics)
+
+            start = time.perf_counter()
+            result = attr(*args, **kwargs)
+
+            # AsyncClient の RPC はコルーチンか非同期イテレーターを返す
+            if inspect.isawaitable(result):
+                return _timed_await(result, name, metrics)
+            if hasattr(result, "__aiter__"):
+                return _timed_aiter(result, name, metrics)
+
+            # ドキュメントへの直接の書き込みも1往復の RPC として記録する
+            direct_write = name in _WRITE_METHODS and type(self._target).__name__ == (
+                "DocumentReference"
+            )
+            if name not in _RPC_METHODS and not direct_write:
+                if result is None or isinstance(result, _PLAIN_TYPES):
+                    return result
+                return _Instrumented(result)
+
+            if name in ("stream", "get_all"):
+                result = list(result)
+            _record(metrics, name, result, start)
+            if name in ("stream", "get_all"):
+                return iter(result)
+            return result
+
+        return call
+
+    def __repr__(self):
+        return f"Instrumented({self._target!r})"
+
+
+def instrument(db):
+    """
+    Firestore クライアントを計測用のラッパーで包んで返す
+    """
+    if db is None or isinstance(db, _Instrumented):
+        return db
+    return _Instrumented(db)
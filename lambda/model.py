@@ -0,0 +1,76 @@
+"""
+Firestore のドキュメントに対応するモデルの基底クラス
+
+各モデルは FIELDS にドキュメントのフィールドを宣言し、その宣言から
+インスタンスの __slots__ と to_dict / from_dict が作られます。
+select / field_paths で一部のフィールドだけを読んだ場合は、from_dict に
+同じ fields を渡すと、そのフィールドだけを持つインスタンスになります
+(読んでいないフィールドを参照すると AttributeError)。ドキュメントにない項目
+(フィールドが追加される前のドキュメントなど) は、コンストラクタの既定値か、
+既定値のない引数ではモデルの MISSING_DEFAULTS の値 (宣言がなければ None) になります。
+"""
+
+import inspect
+
+
+class ModelMeta(type):
+    """
+    FIELDS と PRIVATE_SLOTS (キャッシュなどドキュメントに含めない属性) から __slots__ を作る
+    """
+
+    def __new__(mcls, name, bases, namespace):
+        namespace["__slots__"] = tuple(namespace.get("FIELDS", ())) + tuple(
+            namespace.get("PRIVATE_SLOTS", ())
+        )
+        # ドキュメントになかったフィールドに入れる値 (既定値がなければ None)
+        init = namespace.get("__init__")
+        parameters = inspect.signature(init).parameters if init else {}
+        fields = [f for f in namespace.get("FIELDS", ()) if f in parameters]
+        namespace["_REQUIRED"] = tuple(
+            f for f in fields if parameters[f].default is inspect.Parameter.empty
+        )
+        namespace["_DEFAULTS"] = dict(
+            {
+                f: parameters[f].default
+                for f in fields
+                if parameters[f].default is not inspect.Parameter.empty
+            },
+            **namespace.get("MISSING_DEFAULTS", {}),
+        )
+        return super().__new__(mcls, name, bases, namespace)
+
+
+class Model(metaclass=ModelMeta):
+    FIELDS = ()
+
+    @classmethod
+    def projection(cls, *fields) -> list:
+        """
+        select / field_paths に渡すフィールド名のリスト。宣言にない名前は ValueError
+        """
+        unknown = [f for f in fields if f not in cls.FIELDS]
+        if unknown:
+            raise ValueError(f"{cls.__name__} has no field: {', '.join(unknown)}")
+        return list(fields)
+
+    @classmethod
+    def from_dict(cls, source: dict, fields=None):
+        """
+        ドキュメントの dict からインスタンスを作る。ない項目はコンストラクタの既定値で補う。
+        fields を渡した場合は、そのフィールドだけを持つインスタンスにする
+        """
+        if not source:
+            return None
+        if fields is None:
+            kwargs = {f: source[f] for f in cls.FIELDS if f in source}
+            # 既定値のない引数がドキュメントになければ、MISSING_DEFAULTS で補う
+            for f in cls._REQUIRED:
+                kwargs.setdefault(f, cls._DEFAULTS.get(f))
+            return cls(**kwargs)
+        instance = cls.__new__(cls)
+        for f in cls.projection(*fields):
+            setattr(instance, f, source[f] if f in source else cls._DEFAULTS.get(f))
+        return instance
+
+    def to_dict(self) -> dict:
+        return {f: getattr(self, f) for f in self.FIELDS if hasattr(self, f)}
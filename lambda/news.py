@@ -1,11 +1,45 @@
+import time
 import uuid
+from collections import OrderedDict
 from datetime import datetime
 from firebase_admin import firestore
 from google.cloud.firestore_v1.base_query import FieldFilter
+from model import Model
+from news_index import NewsIndex, get_index, split_passages
 
+# コンテナ内キャッシュの設定
+NEWS_CACHE_TTL_SECONDS = 600
+NEWS_VERSION_CHECK_SECONDS = 5
+NEWS_CACHE_MAX_ENTRIES = 8
+NEWS_CACHE_DEPTH = 3
 
-class News:
+# 1ターンで読み上げるセグメントの最大文字数 (文の途中では切らない)
+SEGMENT_MAX_CHARS = 400
+
+
+class News(Model):
     COLLECTION = "news"
+    FIELDS = (
+        "id",
+        "content",
+        "sample_question",
+        "keyword",
+        "language_code",
+        "published",
+        "segments",
+    )
+    VERSION_COLLECTION = "news_versions"
+    # これらのフィールドを持たない古いドキュメントは空文字列として読む
+    MISSING_DEFAULTS = {
+        "content": "",
+        "sample_question": "",
+        "keyword": "",
+        "language_code": "",
+    }
+
+    # 言語コード -> {"news": [News], "version": int, "fetched_at": float, "checked_at": float}
+    # モジュールレベルに置くことで、ウォームスタート間で再利用される
+    _cache = OrderedDict()
 
     def __init__(
         self,
@@ -15,6 +49,7 @@ class News:
         language_code: str,
         published: datetime = None,
         id: str = None,
+        segments: list = None,
     ):
         self.id = id if id else str(uuid.uuid4())
         self.content = content
@@ -22,74 +57,194 @@ class News:
         self.keyword = keyword
         self.language_code = language_code
         self.published = published if published else datetime.now()
-
-    @staticmethod
-    def from_dict(source):
-        return News(
-            id=source.get("id"),
-            content=source.get("content", ""),
-            sample_question=source.get("sample_question", ""),
-            keyword=source.get("keyword", ""),
-            language_code=source.get("language_code", ""),
-            published=source.get("published", datetime.now()),
+        # 読み上げ用に文の区切りで分けた本文。segments を持たない古いドキュメントは読み込み時に分ける
+        self.segments = (
+            segments if segments else split_passages(content, SEGMENT_MAX_CHARS)
         )
 
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "content": self.content,
-            "sample_question": self.sample_question,
-            "keyword": self.keyword,
-            "language_code": self.language_code,
-            "published": self.published,
-        }
-
-    def save(self, ref):
-        doc_ref = ref.document(self.id)
-        doc_ref.set(self.to_dict())
+    def save(self, db: firestore.Client):
+        """
+        検索インデックスのシャードに追記してから、ニュースの保存と言語ごとのバージョンの
+        更新を1つのバッチで行う。バージョンが変わった時点でインデックスは追記済みなので、
+        検索側が新しいバージョンで古いインデックスをキャッシュすることはない
+        """
+        NewsIndex.index_news(db, self)
+        batch = db.batch()
+        batch.set(News.get_collection(db).document(self.id), self.to_dict())
+        News.bump_version(batch, db, self.language_code, self.published)
+        batch.commit()
 
     @staticmethod
     def get_collection(db: firestore.Client):
         return db.collection(News.COLLECTION)
 
     @staticmethod
-    def get_recent_news(db: firestore.Client, language_code: str) -> str:
+    def version_ref(db: firestore.Client, language_code: str):
+        return db.collection(News.VERSION_COLLECTION).document(language_code)
+
+    @staticmethod
+    def bump_version(writer, db: firestore.Client, language_code: str, updated=None):
+        """
+        writer (バッチまたはトランザクション) に、言語ごとのバージョンの加算を加える。
+        updated は新しく配信したニュースの公開日時 (インデックスの再構築では省略する)
+        """
+        fields = {"version": firestore.Increment(1)}
+        if updated is not None:
+            fields["updated"] = updated
+        writer.set(News.version_ref(db, language_code), fields, merge=True)
+
+    @staticmethod
+    def get(db: firestore.Client, news_id: str) -> "News":
+        doc = News.get_collection(db).document(news_id).get()
+        if doc.exists:
+            return News.from_dict(doc.to_dict())
+        return None
+
+    @staticmethod
+    def get_version(db: firestore.Client, language_code: str) -> int:
+        doc = News.version_ref(db, language_code).get()
+        if doc.exists:
+            return doc.to_dict().get("version", 0)
+        return 0
+
+    @staticmethod
+    def clear_cache():
+        News._cache.clear()
+
+    @staticmethod
+    def _query_recent(db: firestore.Client, language_code: str, limit: int):
         collection_ref = News.get_collection(db)
         query = (
             collection_ref.where(
                 filter=FieldFilter("language_code", "==", language_code)
             )
             .order_by("published", direction="DESCENDING")
-            .limit(3)
+            .limit(limit)
         )
+        return [News.from_dict(doc.to_dict()) for doc in query.stream()]
 
-        docs = query.stream()
+    @staticmethod
+    def get_cached_news(db: firestore.Client, language_code: str) -> list:
+        """
+        指定した言語の新しい順のニュースを、コンテナ内キャッシュ経由で返す。
+        TTL内でも数秒ごとにバージョンを確認し、新しい配信があれば取り直す。
+        """
+        now = time.monotonic()
+        entry = News._cache.get(language_code)
+
+        if entry and now - entry["fetched_at"] < NEWS_CACHE_TTL_SECONDS:
+            News._cache.move_to_end(language_code)
+            if now - entry["checked_at"] < NEWS_VERSION_CHECK_SECONDS:
+                return entry["news"]
+            version = News.get_version(db, language_code)
+            if version == entry["version"]:
+                entry["checked_at"] = now
+                return entry["news"]
+        else:
+            version = News.get_version(db, language_code)
+
+        news = News._query_recent(db, language_code, NEWS_CACHE_DEPTH)
+        News._store_cache(language_code, news, version, now)
+        return news
+
+    @staticmethod
+    def _store_cache(language_code: str, news: list, version: int, now: float):
+        News._cache[language_code] = {
+            "news": news,
+            "version": version,
+            "fetched_at": now,
+            "checked_at": now,
+        }
+        News._cache.move_to_end(language_code)
+        while len(News._cache) > NEWS_CACHE_MAX_ENTRIES:
+            News._cache.popitem(last=False)
+
+    # --- AsyncClient 用 (キャッシュは同期版と共有する) ---
+
+    @staticmethod
+    async def get_version_async(db, language_code: str) -> int:
+        doc = await News.version_ref(db, language_code).get()
+        if doc.exists:
+            return doc.to_dict().get("version", 0)
+        return 0
+
+    @staticmethod
+    async def _query_recent_async(db, language_code: str, limit: int):
+        query = (
+            News.get_collection(db)
+            .where(filter=FieldFilter("language_code", "==", language_code))
+            .order_by("published", direction="DESCENDING")
+            .limit(limit)
+        )
+        return [News.from_dict(doc.to_dict()) async for doc in query.stream()]
+
+    @staticmethod
+    async def get_cached_news_async(db, language_code: str) -> list:
+        """
+        get_cached_news の非同期版。他の読み取りと並行に呼ばれることを想定し、
+        キャッシュがない場合はバージョンを確認せずにニュースだけを取得する
+        """
+        now = time.monotonic()
+        entry = News._cache.get(language_code)
+
+        if entry and now - entry["fetched_at"] < NEWS_CACHE_TTL_SECONDS:
+            News._cache.move_to_end(language_code)
+            if now - entry["checked_at"] < NEWS_VERSION_CHECK_SECONDS:
+                return entry["news"]
+            version = await News.get_version_async(db, language_code)
+            if version == entry["version"]:
+                entry["checked_at"] = now
+                return entry["news"]
+        else:
+            # バージョンが分からないため None で保存し、次の確認で取り直させる
+            version = None
+        news = await News._query_recent_async(db, language_code, NEWS_CACHE_DEPTH)
+
+        News._store_cache(language_code, news, version, now)
+        return news
+
+    @staticmethod
+    async def get_latest_news_async(db, language_code: str) -> "News":
+        news = await News.get_cached_news_async(db, language_code)
+        return news[0] if news else None
+
+    @staticmethod
+    def get_recent_news(db: firestore.Client, language_code: str) -> str:
         result_strings = []
 
-        for doc in docs:
-            news_dict = doc.to_dict()
-            published_date = news_dict.get("published", datetime.now()).strftime(
-                "%Y-%m-%d %H:%M UTC"
-            )
-            content = news_dict.get("content", "")
-            result_strings.append(f"{published_date}\n{content}")
+        for news in News.get_cached_news(db, language_code):
+            published_date = news.published.strftime("%Y-%m-%d %H:%M UTC")
+            result_strings.append(f"{published_date}\n{news.content}")
 
         return "\n\n".join(result_strings)
 
+    @staticmethod
+    def search_passages(
+        db: firestore.Client, language_code: str, query: str, k: int = 5
+    ) -> list:
+        """
+        ニュースアーカイブ全体から、質問に関連するパッセージを BM25 で検索する
+        """
+        index = get_index(db, language_code, News.get_version(db, language_code))
+        return index.search(query, k=k)
+
+    @staticmethod
+    def get_relevant_news(
+        db: firestore.Client, language_code: str, query: str, k: int = 5
+    ) -> str:
+        """
+        質問に関連するパッセージを日付付きで連結して返す。
+        インデックスが空の場合は直近のニュースを返す
+        """
+        passages = News.search_passages(db, language_code, query, k=k)
+        if not passages:
+            return News.get_recent_news(db, language_code)
+        return "\n\n".join(f"{p['published'][:10]}\n{p['text']}" for p in passages)
+
     @staticmethod
     def get_latest_news(db: firestore.Client, language_code: str) -> "News":
         """
         指定した言語の最新ニュースを1件取得してNewsインスタンスを返す
         """
-        collection_ref = News.get_collection(db)
-        query = (
-            collection_ref.where(
-                filter=FieldFilter("language_code", "==", language_code)
-            )
-            .order_by("published", direction="DESCENDING")
-            .limit(1)
-        )
-        docs = query.stream()
-        for doc in docs:
-            return News.from_dict(doc.to_dict())
-        return None
+        news = News.get_cached_news(db, language_code)
+        return news[0] if news else None
@@ -0,0 +1,248 @@
+"""
+ニュースアーカイブの BM25 検索インデックス
+
+ニュースの content と keyword を文単位のパッセージに分け、転置インデックスで
+BM25 スコアを計算します。日本語は文字 bigram、英数字は単語単位でトークン化します。
+インデックスは言語・月ごとのシャードとして news_index コレクションに zlib 圧縮で保存し、
+News.save のたびに該当シャードへ追記します。検索側は言語ごとに1度だけ読み込み、
+ニュースのバージョンが変わったときだけ読み直します。
+"""
+
+import json
+import math
+import re
+import unicodedata
+import zlib
+from collections import Counter
+from google.cloud import firestore
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+COLLECTION = "news_index"
+PASSAGE_MAX_CHARS = 300
+BM25_K1 = 1.2
+BM25_B = 0.75
+# keyword に含まれる語は本文の語より重く数える
+KEYWORD_WEIGHT = 2
+
+_WORD = re.compile(r"[a-z0-9]+|[^\sa-z0-9]+")
+_SENTENCE_END = re.compile(r"(?<=[。．.!?！？\n])")
+
+
+def tokenize(text: str) -> list:
+    """
+    英数字は単語、それ以外 (日本語など) は文字 bigram に分割する
+    """
+    text = unicodedata.normalize("NFKC", text or "").lower()
+    tokens = []
+    for chunk in _WORD.findall(text):
+        if chunk[0].isascii() and chunk[0].isalnum():
+            tokens.append(chunk)
+            continue
+        chars = [
+            ch
+            for ch in chunk
+            if not unicodedata.category(ch).startswith(("P", "Z", "S"))
+        ]
+        if len(chars) == 1:
+            tokens.append(chars[0])
+        tokens.extend(a + b for a, b in zip(chars, chars[1:]))
+    return tokens
+
+
+def split_passages(content: str, max_chars: int = PASSAGE_MAX_CHARS) -> list:
+    """
+    文の区切りで max_chars 程度のパッセージにまとめる
+    """
+    passages = []
+    current = ""
+    for sentence in _SENTENCE_END.split(content or ""):
+        sentence = sentence.strip()
+        if not sentence:
+            continue
+        if current and len(current) + len(sentence) > max_chars:
+            passages.append(current)
+            current = ""
+        # 英文は文の間に空白を戻す
+        if current and current[-1].isascii():
+            current += " "
+        current += sentence
+    if current:
+        passages.append(current)
+    return passages
+
+
+class NewsIndex:
+    def __init__(self):
+        # パッセージ: [news_id, published(ISO), text, 長さ]。削除済みは None
+        self.passages = []
+        self.postings = {}
+        self.news_passages = {}
+        self.total_length = 0
+        self.live_count = 0
+
+    def add_news(self, news):
+        """
+        ニュース1件をインデックスに追加する。同じIDがあれば置き換える
+        """
+        self.remove_news(news.id)
+        keyword_terms = Counter(tokenize(news.keyword))
+        published = (
+            news.published.isoformat()
+            if hasattr(news.published, "isoformat")
+            else str(news.published)
+        )
+        ids = []
+        for text in split_passages(news.content):
+            terms = Counter(tokenize(text))
+            for term, count in keyword_terms.items():
+                terms[term] += count * KEYWORD_WEIGHT
+            length = sum(terms.values())
+            index = len(self.passages)
+            self.passages.append([news.id, published, text, length])
+            for term, tf in terms.items():
+                self.postings.setdefault(term, []).append([index, tf])
+            self.total_length += length
+            self.live_count += 1
+            ids.append(index)
+        self.news_passages[news.id] = ids
+
+    def remove_news(self, news_id: str):
+        for index in self.news_passages.pop(news_id, []):
+            passage = self.passages[index]
+            if passage is not None:
+                self.total_length -= passage[3]
+                self.live_count -= 1
+                self.passages[index] = None
+
+    def search(self, query: str, k: int = 5) -> list:
+        """
+        BM25 スコアの高い順に最大 k 件のパッセージを返す
+        """
+        if not self.live_count:
+            return []
+        avgdl = self.total_length / self.live_count
+        scores = {}
+        for term in set(tokenize(query)):
+            postings = [p for p in self.postings.get(term, []) if self.passages[p[0]]]
+            if not postings:
+                continue
+            df = len(postings)
+            idf = math.log(1 + (self.live_count - df + 0.5) / (df + 0.5))
+            for index, tf in postings:
+                length = self.passages[index][3]
+                denom = tf + BM25_K1 * (1 - BM25_B + BM25_B * length / avgdl)
+                scores[index] = (
+                    scores.get(index, 0.0) + idf * tf * (BM25_K1 + 1) / denom
+                )
+
+        top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+        return [
+            {
+                "news_id": self.passages[index][0],
+                "published": self.passages[index][1],
+                "text": self.passages[index][2],
+                "score": score,
+            }
+            for index, score in top
+        ]
+
+    def merge(self, other: "NewsIndex"):
+        offsets = {}
+        for index, passage in enumerate(other.passages):
+            if passage is None:
+                continue
+            offsets[index] = len(self.passages)
+            self.passages.append(list(passage))
+            self.news_passages.setdefault(passage[0], []).append(offsets[index])
+            self.total_length += passage[3]
+            self.live_count += 1
+        for term, postings in other.postings.items():
+            merged = [[offsets[i], tf] for i, tf in postings if i in offsets]
+            if merged:
+                self.postings.setdefault(term, []).extend(merged)
+
+    def to_bytes(self) -> bytes:
+        """
+        削除済みのパッセージを詰めてから JSON を zlib で圧縮する
+        """
+        compact = NewsIndex()
+        compact.merge(self)
+        payload = {"passages": compact.passages, "postings": compact.postings}
+        return zlib.compress(
+            json.dumps(payload, ensure_ascii=False, separators=(",", ":")).encode(
+                "utf-8"
+            ),
+            9,
+        )
+
+    @staticmethod
+    def from_bytes(data: bytes) -> "NewsIndex":
+        payload = json.loads(zlib.decompress(data).decode("utf-8"))
+        index = NewsIndex()
+        index.passages = payload["passages"]
+        index.postings = payload["postings"]
+        for offset, passage in enumerate(index.passages):
+            index.news_passages.setdefault(passage[0], []).append(offset)
+            index.total_length += passage[3]
+            index.live_count += 1
+        return index
+
+    # --- Firestore 上のシャード ---
+
+    @staticmethod
+    def shard_id(news) -> str:
+        return f"{news.language_code}-{news.published.strftime('%Y-%m')}"
+
+    @staticmethod
+    def index_news(db, news):
+        """
+        ニュースを言語・月ごとのシャードにトランザクションで追記する
+        """
+        doc_ref = db.collection(COLLECTION).document(NewsIndex.shard_id(news))
+
+        @firestore.transactional
+        def _index(transaction):
+            doc = doc_ref.get(transaction=transaction)
+            shard = (
+                NewsIndex.from_bytes(doc.to_dict()["blob"])
+                if doc.exists
+                else NewsIndex()
+            )
+            shard.add_news(news)
+            transaction.set(
+                doc_ref,
+                {
+                    "language_code": news.language_code,
+                    "blob": shard.to_bytes(),
+                    "updated": news.published,
+                },
+            )
+
+        _index(db.transaction())
+
+    @staticmethod
+    def load(db, language_code: str) -> "NewsIndex":
+        query = db.collection(COLLECTION).where(
+            filter=FieldFilter("language_code", "==", language_code)
+        )
+        index = NewsIndex()
+        for doc in query.stream():
+            index.merge(NewsIndex.from_bytes(doc.to_dict()["blob"]))
+        return index
+
+
+# 言語コード -> (NewsIndex, ニュースのバージョン)
+_loaded = {}
+
+
+def get_index(db, language_code: str, version: int) -> NewsIndex:
+    """
+    言語ごとのインデックスをコンテナ内で使い回す。
+    ニュースのバージョン (News.get_version) が変わっていれば読み直す
+    """
+    cached = _loaded.get(language_code)
+    if cached and cached[1] == version:
+        return cached[0]
+    index = NewsIndex.load(db, language_code)
+    _loaded[language_code] = (index, version)
+    return index
@@ -0,0 +1,220 @@
+"""
+回答作成のプロンプトを組み立てる
+
+質問に関連するパッセージ・最新ニュースの要約版・会話の文脈を、この優先度の順に
+トークン予算の範囲で詰めます。先に入れたセクションと重複する文は除き、予算に
+収まらない部分は文の区切りで切り詰めます。最新ニュースの部分は言語とニュース版
+ごとにコンテナ内でキャッシュし、質問ごとには作り直しません。
+"""
+
+import re
+import threading
+import unicodedata
+from collections import OrderedDict
+
+from news import News, NEWS_CACHE_MAX_ENTRIES
+from question import Question
+from user import LANGUAGE_CODE
+
+# プロンプト全体とセクションごとのトークン数の上限 (estimate_tokens による概算)
+PROMPT_TOKEN_BUDGET = 2000
+PASSAGE_TOKENS = 1000
+NEWS_DIGEST_TOKENS = 600
+CONVERSATION_TOKENS = 300
+PASSAGE_K = 5
+
+PROMPT_TEMPLATE = {
+    LANGUAGE_CODE["JA"]: (
+        "以下のニュースをもとに、ユーザーの質問に音声で読み上げやすい短い日本語で回答してください。\n\n"
+        "{context}# 質問\n{question}"
+    ),
+    LANGUAGE_CODE["EN"]: (
+        "Answer the user's question based on the news below, "
+        "in short English that is easy to read aloud.\n\n"
+        "{context}# Question\n{question}"
+    ),
+}
+SECTION_TITLES = {
+    LANGUAGE_CODE["JA"]: {
+        "passages": "関連するニュース",
+        "digest": "最新のニュース",
+        "conversation": "これまでの会話",
+    },
+    LANGUAGE_CODE["EN"]: {
+        "passages": "Related news",
+        "digest": "Latest news",
+        "conversation": "Conversation so far",
+    },
+}
+
+_SENTENCE_END = re.compile(r"(?<=[。．.!?！？\n])")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    全角文字は1文字1トークン、それ以外は4文字1トークンとして概算する
+    """
+    wide = sum(1 for ch in text if unicodedata.east_asian_width(ch) in ("W", "F"))
+    return wide + (len(text) - wide + 3) // 4
+
+
+def split_sentences(text: str) -> list:
+    return [s.strip() for s in _SENTENCE_END.split(text or "") if s.strip()]
+
+
+def first_sentence(text: str) -> str:
+    """
+    text が1文以上を含んでいれば最初の文を返す。文がまだ終わっていなければ None
+    """
+    match = _SENTENCE_END.search(text or "")
+    if not match:
+        return None
+    return text[: match.end()].strip() or None
+
+
+def join_sentences(sentences: list) -> str:
+    text = ""
+    for sentence in sentences:
+        # 英文は文の間に空白を戻す
+        if text and text[-1].isascii():
+            text += " "
+        text += sentence
+    return text
+
+
+def truncate_to_tokens(text: str, budget: int) -> str:
+    """
+    budget に収まるところまで、文の区切りで切り詰める
+    """
+    kept = []
+    for sentence in split_sentences(text):
+        if estimate_tokens(join_sentences(kept + [sentence])) > budget:
+            break
+        kept.append(sentence)
+    return join_sentences(kept)
+
+
+class PromptBuilder:
+    # (言語, ニュース版) -> 最新ニュースの要約版 [(見出し, 本文)]
+    _digests = OrderedDict()
+    # 回答作成ワーカーのスレッドから共有されるため、_digests の読み書きはロックの中で行う
+    _digests_lock = threading.Lock()
+
+    def __init__(self, db, budget: int = PROMPT_TOKEN_BUDGET):
+        self.db = db
+        self.budget = budget
+
+    def build(
+        self, language: str, question_text: str, edition: str, conversation: str = ""
+    ) -> str:
+        """
+        質問のプロンプトを作る。conversation は ConversationRecord.get_prompt_context の形式
+        """
+        template = PROMPT_TEMPLATE.get(language, PROMPT_TEMPLATE[LANGUAGE_CODE["EN"]])
+        titles = SECTION_TITLES.get(language, SECTION_TITLES[LANGUAGE_CODE["EN"]])
+        remaining = self.budget - estimate_tokens(
+            template.format(context="", question=question_text)
+        )
+        # 質問と同じ文は文脈に含めない
+        seen = {Question.normalize_text(question_text)}
+
+        passages = [
+            (p["published"][:10], p["text"])
+            for p in News.search_passages(self.db, language, question_text, k=PASSAGE_K)
+        ]
+        # 会話は新しい行を優先して詰め、古い順に戻す
+        lines = [(None, line) for line in (conversation or "").splitlines()]
+        sections = [
+            ("passages", passages, PASSAGE_TOKENS, False),
+            (
+                "digest",
+                PromptBuilder.news_digest(self.db, language, edition),
+                NEWS_DIGEST_TOKENS,
+                False,
+            ),
+            ("conversation", lines[::-1], CONVERSATION_TOKENS, True),
+        ]
+
+        context = ""
+        for name, units, cap, reverse in sections:
+            budget = min(cap, remaining - estimate_tokens(f"# {titles[name]}\n\n\n"))
+            kept, _ = PromptBuilder._fill(units, budget, seen)
+            if not kept:
+                continue
+            if reverse:
+                kept.reverse()
+            context += f"# {titles[name]}\n" + "\n\n".join(kept) + "\n\n"
+            remaining = self.budget - estimate_tokens(
+                template.format(context=context, question=question_text)
+            )
+        return template.format(context=context, question=question_text)
+
+    @staticmethod
+    def _fill(units: list, budget: int, seen: set) -> tuple:
+        """
+        (見出し, 本文) を順に budget まで詰める。seen にある文は除き、詰めた文を seen に加える
+        """
+        kept = []
+        used = 0
+        for header, body in units:
+            if used >= budget:
+                break
+            sentences = [
+                s
+                for s in split_sentences(body)
+                if Question.normalize_text(s) not in seen
+            ]
+            if not sentences:
+                continue
+            prefix = f"{header}\n" if header else ""
+            text = truncate_to_tokens(
+                join_sentences(sentences), budget - used - estimate_tokens(prefix)
+            )
+            if not text:
+                break
+            kept.append(prefix + text)
+            used += estimate_tokens(prefix + text) + 1
+            seen.update(Question.normalize_text(s) for s in split_sentences(text))
+        return kept, used
+
+    @staticmethod
+    def news_digest(db, language: str, edition: str) -> list:
+        """
+        ニュース版 edition の時点のニュース (edition とそれより前の直近のニュース) を
+        NEWS_DIGEST_TOKENS に収めた [(日付, 本文)] を返す。言語とニュース版ごとに1度だけ作る
+        """
+        key = (language, edition)
+        with PromptBuilder._digests_lock:
+            digest = PromptBuilder._digests.get(key)
+            if digest is not None:
+                PromptBuilder._digests.move_to_end(key)
+                return digest
+
+        units = [
+            (news.published.strftime("%Y-%m-%d"), news.content)
+            for news in PromptBuilder._edition_news(db, language, edition)
+        ]
+        kept, _ = PromptBuilder._fill(units, NEWS_DIGEST_TOKENS, set())
+        digest = [tuple(unit.split("\n", 1)) for unit in kept]
+
+        with PromptBuilder._digests_lock:
+            PromptBuilder._digests[key] = digest
+            PromptBuilder._digests.move_to_end(key)
+            while len(PromptBuilder._digests) > NEWS_CACHE_MAX_ENTRIES:
+                PromptBuilder._digests.popitem(last=False)
+        return digest
+
+    @staticmethod
+    def _edition_news(db, language: str, edition: str) -> list:
+        """
+        直近のニュースのキャッシュに edition があればそこから後 (古い方) を返し、
+        なければ edition のドキュメントを読む。edition のない古い質問は直近のニュース
+        """
+        recent = News.get_cached_news(db, language)
+        if edition is None:
+            return recent
+        ids = [news.id for news in recent]
+        if edition in ids:
+            return recent[ids.index(edition) :]
+        news = News.get(db, edition)
+        return [news] if news else []
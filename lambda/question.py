@@ -1,6 +1,12 @@
-from datetime import datetime
+import threading
+import time
+import unicodedata
+from datetime import datetime, timezone
+from google.api_core.exceptions import FailedPrecondition, NotFound
 from google.cloud import firestore
 from google.cloud.firestore import CollectionReference
+from briefing import Briefing
+from model import Model
 
 ANSWER_STATUS = {
     "NO_QUESTION": "質問なし",
@@ -10,9 +16,23 @@ ANSWER_STATUS = {
     "ERROR": "エラー",
 }
 
+# 待機モードでポーリングするときの間隔 (指数的に伸ばし、上限で頭打ちにする)
+WAIT_POLL_INITIAL_SECONDS = 0.25
+WAIT_POLL_MAX_SECONDS = 1.0
 
-class Question:
+
+class Question(Model):
     COLLECTION = "questions"
+    FIELDS = (
+        "user_id",
+        "question_text",
+        "answer_text",
+        "answer_status",
+        "created",
+        "news_edition",
+        "trace_id",
+        "personalized",
+    )
 
     def __init__(
         self,
@@ -21,32 +41,47 @@ class Question:
         answer_text: str = "",
         answer_status: str = ANSWER_STATUS["IN_PROGRESS"],
         created: datetime = None,
+        news_edition: str = None,
+        trace_id: str = None,
+        personalized: bool = False,
     ):
         self.user_id = user_id
         self.question_text = question_text
         self.answer_text = answer_text
         self.answer_status = answer_status
         self.created = created if created else datetime.now()
+        # 回答の根拠にしたニュース (最新ニュースのID)
+        self.news_edition = news_edition
+        # 質問を受け付けたリクエストのトレース (回答作成ワーカーが引き継ぐ)
+        self.trace_id = trace_id
+        # 回答にユーザー個人の会話の文脈を使ったか (使った回答は他のユーザーに配らない)
+        self.personalized = personalized
 
-    def to_dict(self):
-        return {
-            "user_id": self.user_id,
-            "question_text": self.question_text,
-            "answer_text": self.answer_text,
-            "answer_status": self.answer_status,
-            "created": self.created,
-        }
+    def to_session(self) -> dict:
+        """
+        Alexa のセッション属性 (JSON) に保存できる形にする
+        """
+        return dict(self.to_dict(), created=self.created.isoformat())
 
     @staticmethod
-    def from_dict(source: dict) -> "Question":
+    def from_session(source: dict) -> "Question":
         if not source:
             return None
-        return Question(
-            user_id=source.get("user_id"),
-            question_text=source.get("question_text"),
-            answer_text=source.get("answer_text", ""),
-            answer_status=source.get("answer_status", ANSWER_STATUS["IN_PROGRESS"]),
-            created=source.get("created", datetime.now()),
+        return Question.from_dict(
+            dict(source, created=datetime.fromisoformat(source["created"]))
+        )
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        """
+        表記揺れを吸収するため、NFKC正規化・小文字化し、空白と記号を取り除く
+        """
+        text = unicodedata.normalize("NFKC", text or "").lower()
+        return "".join(
+            ch
+            for ch in text
+            if not ch.isspace()
+            and not unicodedata.category(ch).startswith(("P", "Z", "S"))
         )
 
     @staticmethod
@@ -67,9 +102,126 @@ class Question:
             return Question.from_dict(doc.to_dict())
         return None
 
+    @staticmethod
+    def wait_for_answer(
+        db: firestore.Client, user_id: str, deadline: float, listen: bool = True
+    ) -> tuple:
+        """
+        回答作成中の質問が別の状態に変わるまで、deadline (time.monotonic の値) まで待つ。
+        listen なら on_snapshot のリスナーで、そうでなければ指数バックオフのポーリングで待つ。
+        最初の読み取りはすぐに行うので、呼び出し側で質問を読み直しておく必要はない。
+        最後に読んだ (質問, 更新時刻) を返し (質問がなければ質問は None)、
+        時間内に1度も読めなければ None を返す
+        """
+        doc_ref = Question.collection(db).document(user_id)
+
+        def latest(snapshot) -> tuple:
+            question = (
+                Question.from_dict(snapshot.to_dict()) if snapshot.exists else None
+            )
+            return question, snapshot.update_time
+
+        def settled(result: tuple) -> bool:
+            question = result[0]
+            return question is None or (
+                question.answer_status != ANSWER_STATUS["IN_PROGRESS"]
+            )
+
+        if listen:
+            done = threading.Event()
+            result = []
+
+            def on_snapshot(snapshots, changes, read_time):
+                for snapshot in snapshots:
+                    if done.is_set():
+                        continue
+                    result.append(latest(snapshot))
+                    if settled(result[-1]):
+                        done.set()
+
+            watch = doc_ref.on_snapshot(on_snapshot)
+            try:
+                done.wait(max(0.0, deadline - time.monotonic()))
+            finally:
+                watch.unsubscribe()
+            return result[-1] if result else None
+
+        delay = WAIT_POLL_INITIAL_SECONDS
+        result = latest(doc_ref.get())
+        while not settled(result):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(delay, remaining))
+            result = latest(doc_ref.get())
+            delay = min(delay * 2, WAIT_POLL_MAX_SECONDS)
+        return result
+
+    @staticmethod
+    async def get_async(ref, user_id: str) -> "Question":
+        doc = await ref.document(user_id).get()
+        if doc.exists:
+            return Question.from_dict(doc.to_dict())
+        return None
+
+    def is_same_question(self, source: dict) -> bool:
+        """
+        保存されているドキュメントがこの質問 (同じ本文・同じ作成時刻) かどうか
+        """
+
+        def as_utc(value):
+            if isinstance(value, datetime) and value.tzinfo is None:
+                return value.replace(tzinfo=timezone.utc)
+            return value
+
+        return source.get("question_text") == self.question_text and as_utc(
+            source.get("created")
+        ) == as_utc(self.created)
+
+    def transition(
+        self, db: firestore.Client, answer_status: str, last_update_time=None
+    ) -> bool:
+        """
+        questions/{user_id} がまだこの質問のままなら、answer_status だけを更新する。
+        別のデバイスから新しい質問が保存されていれば上書きせず False を返す。
+        この質問を読んだときの更新時刻 last_update_time が分かっていれば、読み直さずに
+        更新時刻を前提条件にして書き込む
+        """
+        doc_ref = Question.collection(db).document(self.user_id)
+
+        if last_update_time is not None:
+            batch = db.batch()
+            batch.update(
+                doc_ref,
+                {"answer_status": answer_status},
+                option=db.write_option(last_update_time=last_update_time),
+            )
+            Briefing.invalidate(batch, db, self.user_id)
+            try:
+                batch.commit()
+            except (FailedPrecondition, NotFound):
+                return False
+            self.answer_status = answer_status
+            return True
+
+        @firestore.transactional
+        def _transition(transaction) -> bool:
+            doc = doc_ref.get(transaction=transaction)
+            if not doc.exists or not self.is_same_question(doc.to_dict()):
+                return False
+            transaction.update(doc_ref, {"answer_status": answer_status})
+            Briefing.invalidate(transaction, db, self.user_id)
+            return True
+
+        if not _transition(db.transaction()):
+            return False
+        self.answer_status = answer_status
+        return True
+
     def update(self, ref: CollectionReference) -> bool:
         doc_ref = ref.document(self.user_id)
-        if doc_ref.get().exists:
+        try:
             doc_ref.update(self.to_dict())
-            return True
-        return False
+        except NotFound:
+            return False
+        return True
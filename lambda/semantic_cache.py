@@ -0,0 +1,201 @@
+"""
+回答済みの質問を再利用するためのセマンティックキャッシュ
+
+回答済みの質問の埋め込みを NumPy の行列に保持し、コサイン類似度の top-k で
+言い換えられた質問を探します。エントリはニュース版 (edition) に紐づき、
+古い版・古いエントリ・使われていないエントリから順に追い出されます。
+埋め込み関数は embed(text) -> np.ndarray を持つオブジェクトで差し替えられます。
+回答作成ワーカーのスレッドから共有されるため、エントリと行列の読み書きはロックの中で行います。
+"""
+
+import threading
+import time
+import zlib
+from google.cloud.firestore_v1.base_query import FieldFilter
+
+import numpy as np
+
+from question import Question, ANSWER_STATUS
+
+SIMILARITY_THRESHOLD = 0.85
+CACHE_CAPACITY = 512
+MAX_AGE_SECONDS = 24 * 60 * 60
+# Firestore から回答済みの質問を読み直す間隔
+WARM_TTL_SECONDS = 300
+
+
+class HashingEmbedder:
+    """
+    文字 n-gram を特徴量ハッシュで固定長のベクトルにする、オフラインで使える埋め込み
+    """
+
+    def __init__(self, dim: int = 512, ngram_sizes=(2, 3)):
+        self.dim = dim
+        self.ngram_sizes = ngram_sizes
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        normalized = Question.normalize_text(text)
+        for n in self.ngram_sizes:
+            for i in range(max(1, len(normalized) - n + 1)):
+                gram = normalized[i : i + n].encode("utf-8")
+                h = zlib.crc32(gram)
+                vector[h % self.dim] += 1.0 if (h >> 31) & 1 else -1.0
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+
+class SemanticCache:
+    def __init__(
+        self,
+        embedder=None,
+        threshold: float = SIMILARITY_THRESHOLD,
+        capacity: int = CACHE_CAPACITY,
+        max_age_seconds: float = MAX_AGE_SECONDS,
+    ):
+        self.embedder = embedder or HashingEmbedder()
+        self.threshold = threshold
+        self.capacity = capacity
+        self.max_age_seconds = max_age_seconds
+        self._matrix = None
+        self._entries = []
+        self._warmed = {}
+        # add/lookup/warm/retain_editions の間で、エントリと行列の行の対応を保つ
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _ensure_matrix(self, dim: int):
+        if self._matrix is None:
+            self._matrix = np.zeros((self.capacity, dim), dtype=np.float32)
+
+    def _evict_slot(self, now: float) -> int:
+        """
+        追い出す行を選ぶ。期限切れか、最近参照されていないニュース版のエントリを優先し、
+        なければ最も使われていないもの
+        """
+        live = {
+            edition
+            for edition, warmed_at in self._warmed.items()
+            if now - warmed_at < WARM_TTL_SECONDS
+        }
+        for i, entry in enumerate(self._entries):
+            if (
+                now - entry["added_at"] > self.max_age_seconds
+                or entry["edition"] not in live
+            ):
+                return i
+        return min(
+            range(len(self._entries)), key=lambda i: self._entries[i]["last_used"]
+        )
+
+    def add(self, edition: str, question_text: str, answer_text: str):
+        if not edition or not question_text or not answer_text:
+            return
+        vector = self.embedder.embed(question_text)
+        with self._lock:
+            self._ensure_matrix(vector.shape[0])
+            now = time.monotonic()
+
+            entry = {
+                "edition": edition,
+                "question_text": question_text,
+                "answer_text": answer_text,
+                "added_at": now,
+                "last_used": now,
+            }
+            if len(self._entries) < self.capacity:
+                slot = len(self._entries)
+                self._entries.append(entry)
+            else:
+                slot = self._evict_slot(now)
+                self._entries[slot] = entry
+            self._matrix[slot] = vector
+
+    def lookup(self, edition: str, question_text: str, k: int = 3):
+        """
+        同じニュース版の中で最も近い回答済みの質問を探し、
+        類似度がしきい値以上なら (回答, 類似度) を返す
+        """
+        if not self._entries or not edition:
+            return None
+        vector = self.embedder.embed(question_text)
+        with self._lock:
+            count = len(self._entries)
+            scores = self._matrix[:count] @ vector
+
+            now = time.monotonic()
+            for i, entry in enumerate(self._entries):
+                if (
+                    entry["edition"] != edition
+                    or now - entry["added_at"] > self.max_age_seconds
+                ):
+                    scores[i] = -1.0
+
+            k = min(k, count)
+            top = np.argpartition(-scores, k - 1)[:k]
+            best = max(top, key=lambda i: scores[i])
+            if scores[best] < self.threshold:
+                return None
+
+            self._entries[best]["last_used"] = now
+            return self._entries[best]["answer_text"], float(scores[best])
+
+    def retain_editions(self, editions):
+        """
+        現在のニュース版以外のエントリを取り除く
+        """
+        editions = set(editions)
+        with self._lock:
+            keep = [i for i, e in enumerate(self._entries) if e["edition"] in editions]
+            if len(keep) == len(self._entries):
+                return
+            if keep:
+                self._matrix[: len(keep)] = self._matrix[keep]
+            self._entries = [self._entries[i] for i in keep]
+            self._warmed = {k: v for k, v in self._warmed.items() if k in editions}
+
+    def warm(self, db, edition: str):
+        """
+        指定したニュース版で回答済みの質問を Firestore から読み込む (個人向けの回答を除く)。
+        WARM_TTL_SECONDS の間は読み直さない
+        """
+        now = time.monotonic()
+        with self._lock:
+            if (
+                not edition
+                or now - self._warmed.get(edition, -WARM_TTL_SECONDS) < WARM_TTL_SECONDS
+            ):
+                return
+            # 他のスレッドが同じ版を重ねて読み込まないよう、読む前に記録する
+            self._warmed[edition] = now
+
+        query = (
+            Question.collection(db)
+            .where(filter=FieldFilter("news_edition", "==", edition))
+            .where(
+                filter=FieldFilter(
+                    "answer_status",
+                    "in",
+                    [ANSWER_STATUS["READY"], ANSWER_STATUS["ANSWERED"]],
+                )
+            )
+            .select(Question.projection("question_text", "answer_text", "personalized"))
+            .limit(self.capacity)
+        )
+        with self._lock:
+            known = {
+                e["question_text"] for e in self._entries if e["edition"] == edition
+            }
+        for doc in query.stream():
+            data = doc.to_dict()
+            # 個人の会話の文脈を使った回答は、他のユーザーに配らない
+            if data.get("personalized"):
+                continue
+            if data.get("question_text") not in known:
+                self.add(edition, data.get("question_text"), data.get("answer_text"))
+
+
+# ウォームスタート間で共有するインスタンス
+answer_cache = SemanticCache()
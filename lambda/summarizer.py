@@ -0,0 +1,41 @@
+"""
+会話履歴の圧縮に使う要約器
+
+summarize(summary, turns) -> str を持つオブジェクトであれば差し替えられます。
+summary はこれまでの要約 (なければ空文字)、turns は要約に畳み込む古い順の
+ConversationRecord のリストで、両方をまとめ直した新しい要約を返します。
+"""
+
+# 要約の最大文字数。プロンプトに毎回含めるので短く保つ
+SUMMARY_MAX_CHARS = 600
+
+SUMMARY_PROMPT = (
+    "以下はユーザーと音声アシスタントの会話のこれまでの要約と、その続きのやり取りです。"
+    "今後の回答の文脈に必要な内容 (ユーザーの関心、質問したトピック、伝えた事実) を残し、"
+    "全体を{max_chars}文字以内の1つの要約にまとめ直してください。\n\n"
+    "# これまでの要約\n{summary}\n\n# 続きのやり取り\n{turns}"
+)
+
+
+class LLMSummarizer:
+    def __init__(self, llm):
+        self.llm = llm
+
+    def summarize(self, summary: str, turns: list) -> str:
+        prompt = SUMMARY_PROMPT.format(
+            max_chars=SUMMARY_MAX_CHARS,
+            summary=summary or "(なし)",
+            turns="\n".join(f"{t.role}: {t.message}" for t in turns),
+        )
+        return self.llm.generate(prompt).strip()[:SUMMARY_MAX_CHARS]
+
+
+class StubSummarizer:
+    """
+    ローカル実行用。ユーザーの発言を古い順につなげ、上限を超えた分は古い方から捨てる
+    """
+
+    def summarize(self, summary: str, turns: list) -> str:
+        topics = [t.message for t in turns if t.role == "user"]
+        text = " / ".join(([summary] if summary else []) + topics)
+        return text[-SUMMARY_MAX_CHARS:]
@@ -0,0 +1,187 @@
+"""
+音声リクエストから回答作成ワーカーまでをつなぐトレース
+
+span() で囲んだ処理の開始時刻と所要時間を、trace_id・親の span_id とともに
+1スパン1行の JSON として書き出します。QuestionIntent のトレース ID は質問の
+ドキュメント (trace_id) に保存し、回答作成ワーカーと AnswerIntent は同じトレースに
+スパンを追加します。
+
+出力先は環境変数 TRACE_EXPORTER で選びます (未設定ならトレースしません)。
+
+    stdout : 標準出力 (Lambda では CloudWatch Logs)
+    file   : TRACE_FILE (既定は /tmp/traces.jsonl) に追記
+"""
+
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+import uuid
+
+TRACE_FILE = os.environ.get("TRACE_FILE", "/tmp/traces.jsonl")
+
+_current = contextvars.ContextVar("trace_span", default=None)
+_exporter = None
+_configured = False
+
+
+class StdoutExporter:
+    def export(self, record: dict):
+        # EMF と同じく、logger の前置きが付かないよう print で出力する
+        print(json.dumps(record, ensure_ascii=False))
+
+
+class FileExporter:
+    def __init__(self, path: str = TRACE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, record: dict):
+        line = json.dumps(record, ensure_ascii=False) + "\n"
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(line)
+
+
+class MemoryExporter:
+    """
+    ベンチマーク用。書き出したスパンをリストに溜める
+    """
+
+    def __init__(self):
+        self.records = []
+        self._lock = threading.Lock()
+
+    def export(self, record: dict):
+        with self._lock:
+            self.records.append(record)
+
+
+def get_exporter():
+    global _exporter, _configured
+    if not _configured:
+        kind = os.environ.get("TRACE_EXPORTER", "")
+        if kind == "stdout":
+            _exporter = StdoutExporter()
+        elif kind == "file":
+            _exporter = FileExporter()
+        _configured = True
+    return _exporter
+
+
+def set_exporter(exporter):
+    """
+    ローカル実行やベンチマークで出力先を差し替える (None ならトレースしない)
+    """
+    global _exporter, _configured
+    _exporter = exporter
+    _configured = True
+
+
+def new_id(length: int = 32) -> str:
+    return uuid.uuid4().hex[:length]
+
+
+class Span:
+    __slots__ = ("name", "trace_id", "span_id", "parent_id", "start", "attributes")
+
+    def __init__(
+        self,
+        name: str,
+        trace_id: str,
+        parent_id: str = None,
+        start: float = None,
+        attributes: dict = None,
+    ):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = new_id(16)
+        self.parent_id = parent_id
+        self.start = start if start is not None else time.time()
+        self.attributes = attributes or {}
+
+    def end(self, end: float = None, error: bool = False):
+        exporter = get_exporter()
+        if exporter is None:
+            return
+        end = end if end is not None else time.time()
+        record = {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": round(self.start, 6),
+            "duration_ms": round((end - self.start) * 1000, 3),
+            "attributes": self.attributes,
+        }
+        if error:
+            record["error"] = True
+        exporter.export(record)
+
+
+def current_trace_id() -> str:
+    span = _current.get()
+    return span.trace_id if span else None
+
+
+def start_trace(name: str, trace_id: str = None, **attributes) -> Span:
+    """
+    トレースのルートスパンを開始する。trace_id を渡せばそのトレースを引き継ぐ
+    """
+    if get_exporter() is None:
+        return None
+    span = Span(name, trace_id or new_id(), attributes=attributes)
+    _current.set(span)
+    return span
+
+
+def finish_trace(error: bool = False):
+    span = _current.get()
+    if span is None:
+        return
+    _current.set(None)
+    span.end(error=error)
+
+
+@contextlib.contextmanager
+def span(name: str, trace_id: str = None, **attributes):
+    """
+    現在のスパンの子スパンで囲む。trace_id を渡した場合は、そのトレースのルートとして
+    (別プロセスで始まったトレースを引き継いで) 開始する。トレース中でなければ何もしない
+    """
+    parent = _current.get()
+    if get_exporter() is None or (parent is None and trace_id is None):
+        yield None
+        return
+    if trace_id is None:
+        current = Span(name, parent.trace_id, parent.span_id, attributes=attributes)
+    else:
+        current = Span(name, trace_id, attributes=attributes)
+    token = _current.set(current)
+    error = False
+    try:
+        yield current
+    except Exception:
+        error = True
+        raise
+    finally:
+        _current.reset(token)
+        current.end(error=error)
+
+
+def record(name: str, start: float, trace_id: str = None, **attributes):
+    """
+    start (time.time() の値) から現在までの終わったスパンを記録する。
+    trace_id を渡せばそのトレースに、なければ現在のスパンの子として記録する
+    """
+    if get_exporter() is None:
+        return
+    parent = _current.get()
+    if trace_id is None:
+        if parent is None:
+            return
+        Span(name, parent.trace_id, parent.span_id, start, attributes).end()
+    else:
+        Span(name, trace_id, start=start, attributes=attributes).end()
@@ -1,50 +1,77 @@
+import asyncio
 from datetime import datetime, timedelta, timezone
 from zoneinfo import ZoneInfo
 from google.cloud import firestore
 from google.cloud.firestore import CollectionReference
-from google.cloud.firestore_v1.base_query import FieldFilter
-from conversation_record import ConversationRecord
+from briefing import Briefing
+from conversation_record import ConversationRecord, ConversationBuffer
+from model import Model
 from question import Question, ANSWER_STATUS
+import tracing
 
 LANGUAGE_CODE = {
     "EN": "en",
     "JA": "ja",
 }
 
+DAILY_QUESTION_LIMIT = 3
 
-class User:
+# last_active がこの日数以内のユーザーを、ブリーフィングを作るアクティブなユーザーとする
+ACTIVE_USER_DAYS = 7
+# last_active の更新間隔。LaunchRequest ごとには書き込まない
+ACTIVE_MARK_INTERVAL = timedelta(days=1)
+
+# セッション属性に保存するスナップショットのキー
+SESSION_STATE_KEY = "user_state"
+
+
+class User(Model):
     COLLECTION = "users"
+    FIELDS = ("id", "daily_usage", "language_code", "last_active")
+    PRIVATE_SLOTS = ("_cached_question", "_cached_answer_status", "_question_version")
 
     def __init__(
         self,
         id: str,
         language_code: str,
-        daily_usage_count: int = 0,
-        last_question_date: datetime = None,
+        daily_usage: dict = None,
+        last_active: datetime = None,
     ):
         self.id = id
         self.language_code = language_code
-        self.daily_usage_count = daily_usage_count
-        self.last_question_date = (
-            last_question_date if last_question_date else datetime.now(timezone.utc)
-        )
+        # 現地日付のキー ("d20240501") -> その日の質問回数
+        self.daily_usage = dict(daily_usage) if daily_usage else {}
+        # 最後にスキルを使った日時 (ACTIVE_MARK_INTERVAL ごとに更新)。持たない古いユーザーは None
+        self.last_active = last_active
 
-    @staticmethod
-    def from_dict(source):
-        return User(
-            id=source.get("id"),
-            daily_usage_count=source.get("daily_usage_count", 0),
-            last_question_date=source.get("last_question_date", datetime.now(timezone.utc)),
-            language_code=source.get("language_code"),
-        )
+    @classmethod
+    def from_dict(cls, source: dict, fields=None) -> "User":
+        user = super().from_dict(source, fields)
+        # 旧形式 (daily_usage_count + last_question_date) のドキュメントを読み替える
+        if fields is None and not user.daily_usage and source.get("last_question_date"):
+            key = user.usage_key(source["last_question_date"])
+            user.daily_usage = {key: source.get("daily_usage_count", 0)}
+        return user
 
-    def to_dict(self):
-        return {
-            "id": self.id,
-            "daily_usage_count": self.daily_usage_count,
-            "last_question_date": self.last_question_date,
-            "language_code": self.language_code,
-        }
+    def local_now(self, now: datetime = None) -> datetime:
+        now = now if now else datetime.now(timezone.utc)
+        if self.language_code == LANGUAGE_CODE["JA"]:
+            return now.astimezone(ZoneInfo("Asia/Tokyo"))
+        return now
+
+    def usage_key(self, now: datetime = None) -> str:
+        """
+        ユーザーの現地日付から、質問回数のカウンターのキーを作る
+        """
+        return self.local_now(now).strftime("d%Y%m%d")
+
+    @property
+    def daily_usage_count(self) -> int:
+        """
+        今日 (ユーザーの現地日付) の質問回数。日付が変わればキーが変わるため、
+        リセットのための書き込みは不要
+        """
+        return self.daily_usage.get(self.usage_key(), 0)
 
     def save(self, ref: CollectionReference):
         doc_ref = ref.document(self.id)
@@ -59,9 +86,7 @@ class User:
         doc = ref.document(id).get()
         if doc.exists:
             data = doc.to_dict()
-            user = User.from_dict(data)
-            user = user.reset_usage_count(ref)
-            return user
+            return User.from_dict(data)
         else:
             return None
 
@@ -71,10 +96,180 @@ class User:
     ) -> "User":
         user = User.get(ref, user_id)
         if not user:
-            user = User(user_id, language_code=language_code)
+            user = User(
+                user_id,
+                language_code=language_code,
+                last_active=datetime.now(timezone.utc),
+            )
+            user.save(ref)
+        return user
+
+    @staticmethod
+    def get_or_create_with_question(
+        db: firestore.Client, user_id: str, language_code: str
+    ) -> "User":
+        """
+        users/{id} と questions/{id} を get_all で1回の往復にまとめて取得し、
+        質問をキャッシュした状態の User を返す
+        """
+        ref = User.collection(db)
+        user_doc_ref = ref.document(user_id)
+        question_doc_ref = Question.collection(db).document(user_id)
+        snapshots = {
+            snapshot.reference.path: snapshot
+            for snapshot in db.get_all([user_doc_ref, question_doc_ref])
+        }
+
+        user_doc = snapshots.get(user_doc_ref.path)
+        if user_doc is not None and user_doc.exists:
+            user = User.from_dict(user_doc.to_dict())
+        else:
+            user = User(
+                user_id,
+                language_code=language_code,
+                last_active=datetime.now(timezone.utc),
+            )
             user.save(ref)
+
+        question_doc = snapshots.get(question_doc_ref.path)
+        if question_doc is not None and question_doc.exists:
+            user.set_cached_question(
+                Question.from_dict(question_doc.to_dict()),
+                version=question_doc.update_time,
+            )
+        else:
+            user.set_cached_question(None)
+        return user
+
+    # --- AsyncClient 用 ---
+
+    @staticmethod
+    async def get_or_create_async(ref, user_id: str, language_code: str) -> "User":
+        doc_ref = ref.document(user_id)
+        doc = await doc_ref.get()
+        if doc.exists:
+            return User.from_dict(doc.to_dict())
+        user = User(
+            user_id,
+            language_code=language_code,
+            last_active=datetime.now(timezone.utc),
+        )
+        await doc_ref.set(user.to_dict())
+        return user
+
+    async def get_question_async(self, db) -> Question:
+        if hasattr(self, "_cached_question"):
+            return self._cached_question
+        self.set_cached_question(
+            await Question.get_async(Question.collection(db), self.id)
+        )
+        return self._cached_question
+
+    @staticmethod
+    async def get_or_create_with_question_async(
+        db, user_id: str, language_code: str
+    ) -> "User":
+        """
+        users/{id} と questions/{id} を並行に読み、質問をキャッシュした状態の User を返す
+        """
+        user, question = await asyncio.gather(
+            User.get_or_create_async(User.collection(db), user_id, language_code),
+            Question.get_async(Question.collection(db), user_id),
+        )
+        user.set_cached_question(question)
+        return user
+
+    @staticmethod
+    def load(
+        db: firestore.Client,
+        user_id: str,
+        language_code: str,
+        session: dict = None,
+        refresh: bool = True,
+    ) -> "User":
+        """
+        セッション属性にスナップショットがあればそれを使う。
+        ワーカーが書き換えうる回答作成中の質問だけ Firestore で確認する
+        (refresh が False なら、呼び出し側で読み直すものとして確認しない)
+        """
+        state = session.get(SESSION_STATE_KEY) if session is not None else None
+        if not state or state.get("id") != user_id:
+            return User.get_or_create_with_question(db, user_id, language_code)
+
+        user = User.from_session(state)
+        if refresh and user.get_answer_status(db) == ANSWER_STATUS["IN_PROGRESS"]:
+            user.refresh_question(db)
+        return user
+
+    def is_recently_active(self, now: datetime = None) -> bool:
+        now = now if now else datetime.now(timezone.utc)
+        return (
+            self.last_active is not None
+            and now - self.last_active < ACTIVE_MARK_INTERVAL
+        )
+
+    def mark_active(self, db: firestore.Client):
+        """
+        last_active を更新する。ACTIVE_MARK_INTERVAL 以内に更新済みなら書き込まない
+        """
+        if self.is_recently_active():
+            return
+        self.last_active = datetime.now(timezone.utc)
+        self.update(User.collection(db), {"last_active": self.last_active})
+
+    async def mark_active_async(self, db):
+        if self.is_recently_active():
+            return
+        self.last_active = datetime.now(timezone.utc)
+        await User.collection(db).document(self.id).update(
+            {"last_active": self.last_active}
+        )
+
+    def refresh_question(self, db: firestore.Client):
+        """
+        questions/{id} を1回だけ読む。更新時刻 (バージョン) がスナップショットと
+        同じならキャッシュした質問をそのまま使う
+        """
+        doc = Question.collection(db).document(self.id).get()
+        if not doc.exists:
+            self.set_cached_question(None)
+            return
+        if str(doc.update_time) == getattr(self, "_question_version", None):
+            return
+        self.set_cached_question(
+            Question.from_dict(doc.to_dict()), version=doc.update_time
+        )
+
+    def to_session(self) -> dict:
+        question = getattr(self, "_cached_question", None)
+        return {
+            "id": self.id,
+            "language_code": self.language_code,
+            "daily_usage": {self.usage_key(): self.daily_usage_count},
+            "question": question.to_session() if question else None,
+            "question_version": getattr(self, "_question_version", None),
+        }
+
+    @staticmethod
+    def from_session(state: dict) -> "User":
+        user = User(
+            state["id"],
+            language_code=state.get("language_code"),
+            daily_usage=state.get("daily_usage"),
+        )
+        user.set_cached_question(
+            Question.from_session(state.get("question")),
+            version=state.get("question_version"),
+        )
         return user
 
+    def save_session(self, session: dict):
+        """
+        次のターンで Firestore を読まずに済むよう、状態をセッション属性に残す
+        """
+        if session is not None:
+            session[SESSION_STATE_KEY] = self.to_session()
+
     @staticmethod
     def collection(db):
         return db.collection(User.COLLECTION)
@@ -84,37 +279,21 @@ class User:
         doc_ref = ref.document(id)
         return doc_ref.get().exists
 
-    def reset_usage_count(self, ref: CollectionReference) -> "User":
-        now = datetime.now(timezone.utc)
-        last_local = self.last_question_date
-
-        if self.language_code == LANGUAGE_CODE["JA"]:
-            now = now.astimezone(ZoneInfo("Asia/Tokyo"))
-            last_local = last_local.astimezone(ZoneInfo("Asia/Tokyo"))
-
-        if last_local.date() != now.date():
-            self.daily_usage_count = 0
-            self.last_question_date = now
-            self.save(ref)
-        return self
-
     def conversations(self, db):
         since = datetime.now(timezone.utc) - timedelta(hours=24)
-        ref = db.collection("users").document(self.id).collection("conversations")
-        query = ref.where(filter=FieldFilter("timestamp", ">=", since))
-        docs = query.stream()
-        return [ConversationRecord.from_dict(doc.to_dict()) for doc in docs]
+        return ConversationRecord.get_recent_messages(
+            db, self.id, limit=None, since=since
+        )
 
     def format_conversations(self, db):
         formatted = [
             f"{conv.timestamp.strftime('%Y-%m-%d %H:%M')} - {conv.role}: {conv.message}"
-            for conv in sorted(self.conversations(db), key=lambda x: x.timestamp)
+            for conv in self.conversations(db)
         ]
         return "\n".join(formatted)
 
     def add_conversation(self, db, user_message: str, agent_message: str):
         now = datetime.now(timezone.utc)
-        ref = db.collection("users").document(self.id).collection("conversations")
 
         user_timestamp = now - timedelta(seconds=10)
         agent_timestamp = now
@@ -124,8 +303,7 @@ class User:
             self.id, "agent", agent_message, agent_timestamp
         )
 
-        ref.document(user_record.id).set(user_record.to_dict())
-        ref.document(agent_record.id).set(agent_record.to_dict())
+        ConversationBuffer.append(db, self.id, [user_record, agent_record])
 
     def recreate_question(
         self,
@@ -135,17 +313,105 @@ class User:
     ):
         question_ref = Question.collection(db)
 
-        existing_question = Question.get(question_ref, self.id)
-        if existing_question:
-            existing_question.delete(question_ref)
-
+        # 既存の質問はsetで上書きされるため、削除は不要
         question = Question(
             user_id=self.id,
             question_text=question_text,
             answer_text="",
             answer_status=answer_status,
+            trace_id=tracing.current_trace_id(),
+        )
+        batch = db.batch()
+        batch.set(question_ref.document(self.id), question.to_dict())
+        Briefing.invalidate(batch, db, self.id)
+        batch.commit()
+        self.set_cached_question(question)
+        return question
+
+    def submit_question(
+        self,
+        db: firestore.Client,
+        question_text: str,
+        answer_text: str = "",
+        answer_status: str = ANSWER_STATUS["IN_PROGRESS"],
+        news_edition: str = None,
+    ) -> Question:
+        """
+        質問の上書き保存と daily_usage_count の加算を1つのトランザクションで行う。
+        上限に達している、または回答作成中の質問がある場合は保存せず None を返す
+        """
+        user_doc_ref = User.collection(db).document(self.id)
+        question_doc_ref = Question.collection(db).document(self.id)
+        question = Question(
+            user_id=self.id,
+            question_text=question_text,
+            answer_text=answer_text,
+            answer_status=answer_status,
+            news_edition=news_edition,
+            trace_id=tracing.current_trace_id(),
         )
-        question.save(question_ref)
+
+        @firestore.transactional
+        def _submit(transaction) -> bool:
+            snapshots = {
+                snapshot.reference.path: snapshot
+                for snapshot in transaction.get_all([user_doc_ref, question_doc_ref])
+            }
+            user_doc = snapshots.get(user_doc_ref.path)
+            question_doc = snapshots.get(question_doc_ref.path)
+
+            current = (
+                User.from_dict(user_doc.to_dict())
+                if user_doc is not None and user_doc.exists
+                else User(self.id, language_code=self.language_code)
+            )
+            today = current.usage_key()
+            count = current.daily_usage.get(today, 0)
+            self.daily_usage = {today: count}
+
+            existing = None
+            if question_doc is not None and question_doc.exists:
+                existing = Question.from_dict(question_doc.to_dict())
+                self.set_cached_question(existing, version=question_doc.update_time)
+            else:
+                self.set_cached_question(None)
+
+            if count >= DAILY_QUESTION_LIMIT:
+                return False
+            if existing and existing.answer_status == ANSWER_STATUS["IN_PROGRESS"]:
+                return False
+
+            transaction.set(question_doc_ref, question.to_dict())
+            Briefing.invalidate(transaction, db, self.id)
+            if user_doc is not None and user_doc.exists:
+                # 今日のカウンターを加算し、前日以前のカウンターは削除する
+                updates = {
+                    f"daily_usage.{today}": firestore.Increment(1),
+                    "last_active": datetime.now(timezone.utc),
+                }
+                for key in current.daily_usage:
+                    if key != today:
+                        updates[f"daily_usage.{key}"] = firestore.DELETE_FIELD
+                for legacy in ("daily_usage_count", "last_question_date"):
+                    if legacy in user_doc.to_dict():
+                        updates[legacy] = firestore.DELETE_FIELD
+                transaction.update(user_doc_ref, updates)
+            else:
+                created = User(
+                    self.id,
+                    language_code=current.language_code,
+                    daily_usage={today: 1},
+                    last_active=datetime.now(timezone.utc),
+                )
+                transaction.set(user_doc_ref, created.to_dict())
+            return True
+
+        if not _submit(db.transaction()):
+            return None
+
+        today = self.usage_key()
+        self.daily_usage = {today: self.daily_usage.get(today, 0) + 1}
+        self.set_cached_question(question)
         return question
 
     def get_question(self, db) -> Question:
@@ -156,10 +422,26 @@ class User:
         self._cached_question = Question.from_dict(data) if data else None
         return self._cached_question
 
+    def set_cached_question(self, question: Question, version=None):
+        """
+        version は questions/{id} の update_time。自分で書き込んだ直後は分からないため None
+        """
+        self._cached_question = question
+        self._question_version = str(version) if version is not None else None
+        self._cached_answer_status = (
+            question.answer_status if question else ANSWER_STATUS["NO_QUESTION"]
+        )
+
     def get_answer_status(self, db) -> str:
         if hasattr(self, "_cached_answer_status"):
             return self._cached_answer_status
-        question = self.get_question(db)
+        if hasattr(self, "_cached_question"):
+            question = self._cached_question
+        else:
+            # 状態だけが必要なので、回答本文などは読まない
+            fields = Question.projection("answer_status")
+            doc = Question.collection(db).document(self.id).get(field_paths=fields)
+            question = Question.from_dict(doc.to_dict(), fields=fields)
         if not question:
             self._cached_answer_status = ANSWER_STATUS["NO_QUESTION"]
         else:
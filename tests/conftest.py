@@ -0,0 +1,24 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# lambda/ を先に探す (ingestion.py は両方にある)
+sys.path.insert(0, os.path.join(ROOT, "benchmarks"))
+sys.path.insert(0, os.path.join(ROOT, "lambda"))
+
+
+@pytest.fixture(autouse=True)
+def clear_container_caches():
+    """
+    コンテナ内キャッシュはモジュールレベルにあるため、テストごとに空にする
+    """
+    import news_index
+    from news import News
+    from prompt_context import PromptBuilder
+
+    News.clear_cache()
+    news_index._loaded.clear()
+    PromptBuilder._digests.clear()
+    yield
@@ -0,0 +1,234 @@
+from datetime import datetime, timedelta, timezone
+
+import tracing
+from answer_worker import AnswerWorker
+from conversation_record import (
+    CONVERSATION_BUFFER_SIZE,
+    CONVERSATION_WINDOW_TURNS,
+    ConversationBuffer,
+    ConversationRecord,
+)
+from firestore_fake import FakeClient
+from llm import StubLLM
+from news import News
+from prompt_context import CONVERSATION_TOKENS, estimate_tokens
+from question import Question, ANSWER_STATUS
+from semantic_cache import SemanticCache
+from user import User, LANGUAGE_CODE
+
+
+def make_db() -> FakeClient:
+    db = FakeClient()
+    News(
+        content="AIエージェントの新しいフレームワークが公開されました。",
+        sample_question="AIエージェント関連のニュースは？",
+        keyword="AIエージェント",
+        language_code=LANGUAGE_CODE["JA"],
+    ).save(db)
+    return db
+
+
+def make_worker(db) -> AnswerWorker:
+    return AnswerWorker(db, StubLLM(), backoff_seconds=0, answer_cache=SemanticCache())
+
+
+def test_worker_answers_legacy_question_documents():
+    db = make_db()
+    User("legacy-user", language_code=LANGUAGE_CODE["JA"]).save(User.collection(db))
+    # trace_id と news_edition が追加される前に保存された質問
+    Question.collection(db).document("legacy-user").set(
+        {
+            "user_id": "legacy-user",
+            "question_text": "AIエージェント関連のニュースは？",
+            "answer_text": "",
+            "answer_status": ANSWER_STATUS["IN_PROGRESS"],
+            "created": datetime.now(timezone.utc) - timedelta(minutes=5),
+        }
+    )
+    exporter = tracing.MemoryExporter()
+    tracing.set_exporter(exporter)
+    try:
+        stats = make_worker(db).run()
+    finally:
+        tracing.set_exporter(None)
+
+    assert stats["ready"] == 1
+    question = Question.get(Question.collection(db), "legacy-user")
+    assert question.answer_status == ANSWER_STATUS["READY"]
+    assert question.answer_text
+    # トレースを持たない質問のスパンは書き出さない
+    assert exporter.records == []
+
+
+def submit(db, user_id: str, text: str, edition: str = None) -> Question:
+    user = User(user_id, language_code=LANGUAGE_CODE["JA"])
+    user.save(User.collection(db))
+    return user.submit_question(db, text, news_edition=edition)
+
+
+def test_worker_keeps_the_edition_stored_with_the_question():
+    db = make_db()
+    old_edition = News.get_latest_news(db, LANGUAGE_CODE["JA"]).id
+    submit(db, "user-1", "AIエージェント関連のニュースは？", edition=old_edition)
+    # 質問の後に新しいニュースが配信された
+    News(
+        content="量子コンピュータの新しいチップが発表されました。",
+        sample_question="量子コンピュータの話題は？",
+        keyword="量子コンピュータ",
+        language_code=LANGUAGE_CODE["JA"],
+    ).save(db)
+    News.clear_cache()
+
+    make_worker(db).run()
+
+    question = Question.get(Question.collection(db), "user-1")
+    assert question.answer_status == ANSWER_STATUS["READY"]
+    assert question.news_edition == old_edition
+
+
+class ReaskingLLM(StubLLM):
+    """
+    回答の生成中に、ユーザーが別のデバイスで質問し直す
+    """
+
+    def __init__(self, db):
+        super().__init__()
+        self.db = db
+
+    def generate(self, prompt: str) -> str:
+        Question(
+            "user-1", "量子コンピュータの話題は？", created=datetime.now(timezone.utc)
+        ).save(Question.collection(self.db))
+        return super().generate(prompt)
+
+
+def test_worker_does_not_overwrite_a_reasked_question():
+    db = make_db()
+    submit(db, "user-1", "AIエージェント関連のニュースは？")
+
+    stats = AnswerWorker(db, ReaskingLLM(db), answer_cache=SemanticCache()).run()
+
+    question = Question.get(Question.collection(db), "user-1")
+    assert stats["superseded"] == 1
+    assert question.question_text == "量子コンピュータの話題は？"
+    assert "AIエージェント" not in question.answer_text
+
+
+class RecordingLLM(StubLLM):
+    def __init__(self):
+        super().__init__()
+        self.prompts = []
+
+    def generate(self, prompt: str) -> str:
+        self.prompts.append(prompt)
+        return super().generate(prompt)
+
+
+def test_worker_includes_conversation_only_for_unshared_answers():
+    db = make_db()
+    for user_id in ("user-1", "user-2", "user-3"):
+        ConversationBuffer.append(
+            db,
+            user_id,
+            [ConversationRecord(user_id, "user", f"{user_id}の前の質問です。")],
+        )
+        db.collection(ConversationBuffer.COLLECTION).document(user_id).update(
+            {"summary": f"{user_id}は半導体に関心がある。"}
+        )
+    submit(db, "user-1", "量子コンピュータの話題は？")
+    submit(db, "user-2", "AIエージェント関連のニュースは？")
+    submit(db, "user-3", "AIエージェント関連のニュースは？")
+    llm = RecordingLLM()
+
+    AnswerWorker(db, llm, answer_cache=SemanticCache()).run()
+
+    single, shared = sorted(llm.prompts, key=lambda p: "量子" not in p)
+    assert "user-1は半導体に関心がある。" in single
+    assert "user-1の前の質問です。" in single
+    assert "user-2" not in shared and "user-3" not in shared
+
+
+def test_generations_do_not_count_semantic_cache_hits():
+    db = make_db()
+    worker = make_worker(db)
+    submit(db, "user-1", "AIエージェント関連のニュースは？")
+    submit(db, "user-2", "AIエージェント関連のニュースは？")
+    assert worker.run()["generations"] == 1
+
+    # 同じニュース版の同じ質問は、意味キャッシュの回答を使う
+    submit(db, "user-3", "AIエージェント関連のニュースは？")
+    submit(db, "user-4", "AIエージェント関連のニュースは？")
+    stats = worker.run()
+
+    assert stats["ready"] == 2
+    assert stats["generations"] == 0
+
+
+def test_conversation_stays_within_its_token_budget():
+    db = make_db()
+    records = [
+        ConversationRecord("user-1", "user", f"{i}番目の長い質問です。" * 10)
+        for i in range(CONVERSATION_BUFFER_SIZE)
+    ]
+    ConversationBuffer.append(db, "user-1", records)
+    submit(db, "user-1", "量子コンピュータの話題は？")
+    llm = RecordingLLM()
+
+    AnswerWorker(db, llm, answer_cache=SemanticCache()).run()
+
+    conversation = llm.prompts[0].split("# これまでの会話\n", 1)[1]
+    conversation = conversation.split("\n\n# 質問", 1)[0]
+    assert estimate_tokens(conversation) <= CONVERSATION_TOKENS
+    # 予算に収まらない分は古いやり取りから落とす
+    oldest = CONVERSATION_BUFFER_SIZE - CONVERSATION_WINDOW_TURNS
+    assert f"{oldest}番目" not in conversation
+    assert f"{CONVERSATION_BUFFER_SIZE - 1}番目" in conversation
+
+
+def test_personalized_answers_are_not_shared_through_the_cache():
+    db = make_db()
+    ConversationBuffer.append(
+        db, "alice", [ConversationRecord("alice", "user", "半導体について教えて。")]
+    )
+    edition = News.get_latest_news(db, LANGUAGE_CODE["JA"]).id
+    submit(db, "alice", "AIエージェント関連のニュースは？", edition=edition)
+    AnswerWorker(db, RecordingLLM(), answer_cache=SemanticCache()).run()
+    alice = Question.get(Question.collection(db), "alice")
+    assert alice.personalized
+
+    # 新しいコンテナのキャッシュは、個人向けの回答を読み込まない
+    cache = SemanticCache()
+    cache.warm(db, edition)
+    assert cache.lookup(edition, "AIエージェント関連のニュースは？") is None
+
+    # 別のワーカーの実行でも、bob の質問には改めて回答を作る
+    submit(db, "bob", "AIエージェント関連のニュースは？", edition=edition)
+    stats = AnswerWorker(db, RecordingLLM(), answer_cache=SemanticCache()).run()
+    assert stats["generations"] == 1
+    assert not Question.get(Question.collection(db), "bob").personalized
+
+
+def test_prompt_digest_matches_the_stored_edition():
+    db = make_db()
+    old_edition = News.get_latest_news(db, LANGUAGE_CODE["JA"]).id
+    News(
+        content="量子コンピュータの新しいチップが発表されました。",
+        sample_question="量子コンピュータの話題は？",
+        keyword="量子コンピュータ",
+        language_code=LANGUAGE_CODE["JA"],
+    ).save(db)
+    News.clear_cache()
+    submit(db, "user-1", "今日の話題は？", edition=old_edition)
+    submit(db, "user-2", "今日の話題は？")
+    llm = RecordingLLM()
+
+    AnswerWorker(db, llm, answer_cache=SemanticCache()).run()
+
+    digests = sorted(
+        p.split("# 最新のニュース\n", 1)[1].split("\n\n# ", 1)[0] for p in llm.prompts
+    )
+    # 受け付けたときのニュース版の質問には、その後に配信されたニュースを含めない
+    assert [("量子" in d, "AIエージェント" in d) for d in digests] == [
+        (False, True),
+        (True, True),
+    ]
@@ -0,0 +1,123 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import maintenance
+from conversation_record import (
+    CONVERSATION_BUFFER_SIZE,
+    ConversationBuffer,
+    ConversationRecord,
+)
+from firestore_fake import FakeClient
+
+USER_ID = "user-1"
+
+
+def count_with_stats(db) -> tuple:
+    db.stats.reset()
+    count = ConversationRecord.get_conversation_count(db, USER_ID)
+    return count, db.stats.snapshot()
+
+
+@pytest.mark.parametrize("turns", [1, 40])
+def test_conversation_count_reads_one_document(turns):
+    db = FakeClient()
+    for i in range(turns):
+        ConversationRecord.record_message(db, USER_ID, "user", f"message {i}")
+
+    count, stats = count_with_stats(db)
+
+    assert count == turns
+    assert stats["round_trips"] == 1
+    assert stats["reads"] == 1
+
+
+def seed_legacy(db, turns: int):
+    start = datetime.now(timezone.utc) - timedelta(days=1)
+    subcollection = db.collection("users").document(USER_ID).collection("conversations")
+    for i in range(turns):
+        record = ConversationRecord(
+            USER_ID, "user", f"message {i}", start + timedelta(minutes=i)
+        )
+        # 旧形式は conversations と users/{id}/conversations の両方にある
+        ref = ConversationRecord.collection(db) if i % 2 else subcollection
+        record.save(ref)
+
+
+def test_legacy_conversation_count_reads_are_constant():
+    results = {}
+    for turns in (2, 60):
+        db = FakeClient()
+        seed_legacy(db, turns)
+        results[turns] = count_with_stats(db)
+
+    assert results[2][0] == 2
+    assert results[60][0] == 60
+    # バッファのポイントリード1回と、コレクションごとの集計クエリ1回ずつ
+    assert results[2][1] == results[60][1]
+    assert results[60][1]["reads"] == 3
+
+
+class _NoCountQuery:
+    def __init__(self, query):
+        self._query = query
+
+    def select(self, field_paths):
+        return self._query.select(field_paths)
+
+
+def test_count_without_aggregation_support():
+    db = FakeClient()
+    seed_legacy(db, 5)
+    query = ConversationRecord.legacy_queries(db, USER_ID)[0]
+
+    assert ConversationRecord._count(_NoCountQuery(query)) == 2
+
+
+def test_migrate_legacy_keeps_history_and_new_turns():
+    db = FakeClient()
+    seed_legacy(db, 30)
+    # デプロイ後、移行前に追記された会話
+    ConversationRecord.record_message(db, USER_ID, "agent", "after deploy")
+
+    migrated = ConversationBuffer.migrate_legacy(db, USER_ID)
+
+    messages = [r.message for r in ConversationBuffer.get(db, USER_ID)]
+    assert migrated == CONVERSATION_BUFFER_SIZE
+    assert len(messages) == CONVERSATION_BUFFER_SIZE
+    assert messages[-2:] == ["message 29", "after deploy"]
+    assert ConversationRecord.get_conversation_count(db, USER_ID) == 31
+    # 再実行しても二重に取り込まない
+    assert ConversationBuffer.migrate_legacy(db, USER_ID) == 0
+    assert ConversationRecord.get_conversation_count(db, USER_ID) == 31
+
+
+def test_migrate_conversations_pages_users():
+    db = FakeClient()
+    seed_legacy(db, 4)
+    for user_id in (USER_ID, "user-2", "user-3"):
+        db.collection("users").document(user_id).set({"language_code": "ja-JP"})
+
+    stats = maintenance.migrate_conversations(db, page_size=2)
+
+    assert stats == {"users": 1, "turns": 4}
+    assert len(ConversationBuffer.get(db, USER_ID)) == 4
+
+
+def test_expire_and_delete_cover_both_legacy_collections():
+    db = FakeClient()
+    seed_legacy(db, 6)
+    # expires_at を書き込む前に保存された旧形式のドキュメント
+    for query in ConversationRecord.legacy_queries(db, USER_ID):
+        for doc in query.stream():
+            data = doc.to_dict()
+            del data["expires_at"]
+            doc.reference.set(data)
+
+    assert ConversationRecord.expire_legacy_conversations(db, page_size=2) == 6
+    for query in ConversationRecord.legacy_queries(db, USER_ID):
+        assert all(doc.to_dict().get("expires_at") for doc in query.stream())
+    assert ConversationRecord.expire_legacy_conversations(db) == 0
+
+    assert ConversationRecord.delete_all_conversations(db, USER_ID, page_size=2) == 6
+    assert ConversationRecord.count_legacy_conversations(db, USER_ID) == 0
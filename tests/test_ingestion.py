@@ -0,0 +1,117 @@
+import asyncio
+import json
+import os
+from datetime import datetime, timezone
+
+import pytest
+
+from ingestion import (
+    SIMHASH_BANDS,
+    SIMHASH_MAX_DISTANCE,
+    Article,
+    FixtureFetcher,
+    RssFetcher,
+    build_news,
+    cluster_articles,
+    fetch_all,
+)
+
+FIXTURES = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "benchmarks",
+    "fixtures",
+)
+
+
+def article(title: str, source: str = "source", fingerprint: int = None) -> Article:
+    result = Article(source, title, "", f"https://{source}.example.com/", "ja")
+    if fingerprint is not None:
+        result.fingerprint = fingerprint
+    return result
+
+
+def test_near_duplicates_up_to_max_distance_share_a_cluster():
+    # 異なるビットを、なるべく多くの帯に1つずつ散らす
+    spread = sum(1 << (band * 6) for band in range(SIMHASH_MAX_DISTANCE))
+    articles = [article("a", fingerprint=0), article("b", fingerprint=spread)]
+
+    assert len(cluster_articles(articles)) == 1
+
+
+def test_too_few_bands_are_rejected():
+    with pytest.raises(ValueError):
+        cluster_articles([], max_distance=SIMHASH_BANDS)
+
+
+def load_fixture_articles() -> list:
+    with open(os.path.join(FIXTURES, "sources.json"), encoding="utf-8") as f:
+        sources = json.load(f)
+    fetcher = FixtureFetcher(os.path.join(FIXTURES, "feeds"))
+    return asyncio.run(fetch_all(sources, fetcher))
+
+
+@pytest.mark.parametrize(
+    "language_code, keyword, sample_question",
+    [
+        ("ja", "AIエージェント基盤", "AIエージェント基盤関連のニュースはありますか？"),
+        ("en", "AI agents", "Is there any news about AI agents?"),
+    ],
+)
+def test_keyword_is_a_term_shared_by_the_top_cluster(
+    language_code, keyword, sample_question
+):
+    articles = [a for a in load_fixture_articles() if a.language_code == language_code]
+
+    news = build_news(language_code, cluster_articles(articles))
+
+    assert news.keyword == keyword
+    assert news.sample_question == sample_question
+
+
+class ConcurrencyFetcher:
+    def __init__(self):
+        self.active = 0
+        self.max_active = 0
+
+    async def fetch(self, source: dict) -> list:
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        await asyncio.sleep(0.05)
+        self.active -= 1
+        return []
+
+
+def test_waiting_for_a_host_does_not_hold_a_global_slot():
+    sources = [
+        {"name": "a1", "url": "https://a.example.com/1"},
+        {"name": "a2", "url": "https://a.example.com/2"},
+        {"name": "b1", "url": "https://b.example.com/1"},
+    ]
+    fetcher = ConcurrencyFetcher()
+
+    asyncio.run(fetch_all(sources, fetcher, per_host=1, total=2))
+
+    # a2 が a のホストの枠を待つ間に、b1 が全体の枠を使える
+    assert fetcher.max_active == 2
+
+
+def test_rss_items_keep_their_pub_date():
+    body = """<?xml version="1.0"?>
+<rss version="2.0"><channel>
+  <item><title>A</title><link>https://a.example.com/1</link>
+    <pubDate>Wed, 01 May 2024 09:30:00 +0900</pubDate></item>
+  <item><title>B</title><link>https://a.example.com/2</link>
+    <pubDate>Wed, 01 May 2024 00:00:00 -0000</pubDate></item>
+  <item><title>C</title><link>https://a.example.com/3</link></item>
+  <item><title>D</title><link>https://a.example.com/4</link>
+    <pubDate>yesterday</pubDate></item>
+</channel></rss>""".encode()
+    before = datetime.now(timezone.utc)
+
+    articles = RssFetcher.parse(body, {"name": "a", "language_code": "ja"})
+
+    assert articles[0].published == datetime(2024, 5, 1, 0, 30, tzinfo=timezone.utc)
+    assert articles[1].published == datetime(2024, 5, 1, tzinfo=timezone.utc)
+    # pubDate がないか読めない記事だけ取得時刻を使う
+    assert articles[2].published >= before
+    assert articles[3].published >= before
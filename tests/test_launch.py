@@ -0,0 +1,122 @@
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import maintenance
+import metrics
+from alexa_handler import AlexaHandler
+from briefing import Briefing
+from firestore_fake import AsyncFakeClient, FakeClient
+from news import News
+from question import ANSWER_STATUS
+from user import ACTIVE_USER_DAYS, User, LANGUAGE_CODE, SESSION_STATE_KEY
+
+USER_ID = "user-1"
+
+
+def make_db(last_active=None) -> FakeClient:
+    db = FakeClient()
+    News(
+        content="AIエージェントの新しいフレームワークが公開されました。",
+        sample_question="AIエージェント関連のニュースは？",
+        keyword="AIエージェント",
+        language_code=LANGUAGE_CODE["JA"],
+    ).save(db)
+    User(USER_ID, language_code=LANGUAGE_CODE["JA"], last_active=last_active).save(
+        User.collection(db)
+    )
+    # ニュースはコンテナ内キャッシュに載った状態で計測する
+    News.get_latest_news(db, LANGUAGE_CODE["JA"])
+    return db
+
+
+def test_launch_with_a_briefing_is_a_single_point_read():
+    db = make_db(last_active=datetime.now(timezone.utc))
+    assert maintenance.build_briefings(db) == 1
+    db.stats.reset()
+    session = {}
+
+    speak, _ = AlexaHandler.play_news(USER_ID, "ja", db, session)
+
+    assert "AIエージェント" in speak
+    assert session[SESSION_STATE_KEY]["id"] == USER_ID
+    assert db.stats.snapshot() == {
+        "round_trips": 1,
+        "reads": 1,
+        "writes": 0,
+        "deletes": 0,
+    }
+
+
+def test_async_launch_with_a_briefing_is_a_single_point_read():
+    db = make_db(last_active=datetime.now(timezone.utc))
+    maintenance.build_briefings(db)
+    db.stats.reset()
+    session = {}
+
+    speak, _ = asyncio.run(
+        AlexaHandler.play_news_async(USER_ID, "ja", AsyncFakeClient(db), session)
+    )
+
+    assert "AIエージェント" in speak
+    assert session[SESSION_STATE_KEY]["id"] == USER_ID
+    assert db.stats.snapshot()["reads"] == 1
+
+
+def test_briefings_are_built_only_for_active_users():
+    db = make_db(
+        last_active=datetime.now(timezone.utc) - timedelta(days=ACTIVE_USER_DAYS + 1)
+    )
+    assert maintenance.build_briefings(db) == 0
+
+    # ブリーフィングのないユーザーが使うと、次のバッチの対象になる
+    AlexaHandler.play_news(USER_ID, "ja", db, {})
+    assert maintenance.build_briefings(db) == 1
+
+
+def test_briefing_build_does_not_write_back_a_stale_briefing(monkeypatch):
+    db = make_db(last_active=datetime.now(timezone.utc))
+    render = AlexaHandler.render_briefing
+    submitted = []
+
+    def render_while_question_arrives(user, latest_news, question):
+        # ブリーフィングを組み立てている間に、別のデバイスで質問が受け付けられる
+        if not submitted:
+            submitted.append(
+                User(USER_ID, language_code="ja").submit_question(db, "量子の話題は？")
+            )
+        return render(user, latest_news, question)
+
+    monkeypatch.setattr(AlexaHandler, "render_briefing", render_while_question_arrives)
+    maintenance.build_briefings(db)
+
+    briefing = Briefing.get(db, USER_ID)
+    state = briefing.user_state
+    assert state["question"]["question_text"] == "量子の話題は？"
+    assert state["question"]["answer_status"] == ANSWER_STATUS["IN_PROGRESS"]
+
+
+def test_warmup_event_skips_the_skill_and_survives_a_failing_step(monkeypatch):
+    import lambda_function
+
+    db = make_db()
+
+    def no_async_client():
+        raise RuntimeError("async channel unavailable")
+
+    def skill_handler(event, context):
+        raise AssertionError("warm-up must not reach the ASK dispatcher")
+
+    monkeypatch.setattr(metrics, "_cold_start", True)
+    monkeypatch.setattr(lambda_function, "get_db", lambda: db)
+    monkeypatch.setattr(lambda_function, "get_async_db", no_async_client)
+    monkeypatch.setattr(lambda_function, "skill_handler", skill_handler)
+    News.clear_cache()
+
+    report = lambda_function.handler({"source": "aws.events"}, None)
+
+    assert report["warmup"] is True
+    assert "async channel unavailable" in report["errors"]["firestore_async"]
+    # 失敗したステップの後も残りのステップを続ける
+    assert {"imports", "firestore", "news:ja", "news:en"} <= set(report["steps"])
+    assert LANGUAGE_CODE["JA"] in News._cache
+    assert metrics._cold_start is False
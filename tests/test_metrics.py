@@ -0,0 +1,44 @@
+import threading
+import time
+
+import metrics
+from firestore_fake import FakeClient
+from question import Question, ANSWER_STATUS
+
+USER_ID = "user-1"
+
+
+def test_listener_snapshots_count_as_reads():
+    db = metrics.instrument(FakeClient())
+    Question(USER_ID, "質問").save(Question.collection(db))
+    timer = threading.Timer(
+        0.05,
+        lambda: Question.collection(db)
+        .document(USER_ID)
+        .update({"answer_status": ANSWER_STATUS["READY"]}),
+    )
+
+    request = metrics.start_request("AnswerIntent")
+    timer.start()
+    question, _ = Question.wait_for_answer(db, USER_ID, time.monotonic() + 2.0)
+    timer.join()
+    metrics.finish_request()
+
+    assert question.answer_status == ANSWER_STATUS["READY"]
+    # 登録時の最初のスナップショットと、回答ができたときのスナップショット
+    assert request.reads == 2
+
+
+def test_direct_document_writes_are_recorded_as_rpcs():
+    db = metrics.instrument(FakeClient(latency=0.01))
+    doc_ref = Question.collection(db).document(USER_ID)
+
+    request = metrics.start_request("QuestionIntent")
+    doc_ref.set({"user_id": USER_ID, "question_text": "質問"})
+    doc_ref.update({"answer_status": ANSWER_STATUS["READY"]})
+    doc_ref.delete()
+    record = metrics.finish_request()
+
+    assert request.writes == 3
+    # 3回の往復それぞれの遅延が Firestore の時間に含まれる
+    assert record["FirestoreTime"] >= 30
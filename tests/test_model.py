@@ -0,0 +1,42 @@
+from datetime import datetime, timezone
+
+from conversation_record import ConversationRecord
+from news import News
+from question import Question, ANSWER_STATUS
+
+PUBLISHED = datetime(2024, 5, 1, tzinfo=timezone.utc)
+
+
+def test_legacy_news_without_keyword_reads_as_empty_strings():
+    news = News.from_dict(
+        {
+            "id": "n1",
+            "content": "本文です。",
+            "language_code": "ja",
+            "published": PUBLISHED,
+        }
+    )
+
+    assert news.keyword == ""
+    assert news.sample_question == ""
+    assert news.segments == ["本文です。"]
+    assert news.published == PUBLISHED
+
+
+def test_partial_documents_fill_missing_required_fields():
+    question = Question.from_dict(
+        {"user_id": "user-1", "answer_status": ANSWER_STATUS["READY"]}
+    )
+    record = ConversationRecord.from_dict({"user_id": "user-1"})
+
+    assert question.question_text is None
+    assert question.answer_text == ""
+    assert question.answer_status == ANSWER_STATUS["READY"]
+    assert record.role is None and record.message is None
+    assert record.timestamp is not None
+
+
+def test_projected_read_uses_missing_defaults():
+    news = News.from_dict({"id": "n1"}, fields=["id", "keyword"])
+
+    assert news.keyword == ""
@@ -0,0 +1,156 @@
+import maintenance
+import news
+from firestore_fake import FakeClient
+from news import (
+    NEWS_CACHE_MAX_ENTRIES,
+    NEWS_CACHE_TTL_SECONDS,
+    NEWS_VERSION_CHECK_SECONDS,
+    SEGMENT_MAX_CHARS,
+    News,
+)
+from news_index import NewsIndex, split_passages
+from user import LANGUAGE_CODE
+
+JA = LANGUAGE_CODE["JA"]
+
+
+def make_news(content: str, keyword: str) -> News:
+    return News(
+        content=content,
+        sample_question=f"{keyword}について教えて",
+        keyword=keyword,
+        language_code=JA,
+    )
+
+
+def found(db, query: str) -> list:
+    return [p["text"] for p in News.search_passages(db, JA, query)]
+
+
+def test_search_during_publish_does_not_cache_a_stale_index(monkeypatch):
+    db = FakeClient()
+    make_news("AIエージェントの新しいフレームワークが公開されました。", "AI").save(db)
+    index_news = NewsIndex.index_news
+
+    def search_then_index(db, news):
+        # 別のコンテナが配信の途中で検索する
+        found(db, "量子コンピュータ")
+        index_news(db, news)
+
+    monkeypatch.setattr(NewsIndex, "index_news", search_then_index)
+    make_news("量子コンピュータの新しいチップが発表されました。", "量子").save(db)
+
+    assert found(db, "量子コンピュータ") == [
+        "量子コンピュータの新しいチップが発表されました。"
+    ]
+
+
+def test_rebuilt_index_is_visible_to_warm_containers():
+    db = FakeClient()
+    news = make_news("量子コンピュータの新しいチップが発表されました。", "量子")
+    # インデックスに追記されていないアーカイブ
+    News.get_collection(db).document(news.id).set(news.to_dict())
+    assert found(db, "量子コンピュータ") == []
+
+    maintenance.rebuild_news_index(db)
+
+    assert found(db, "量子コンピュータ") == [news.content]
+
+
+class Clock:
+    """
+    news モジュールの time.monotonic を差し替え、TTL とバージョン確認の間隔を進める
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self) -> float:
+        return self.now
+
+
+def cached_keywords(db) -> list:
+    return [n.keyword for n in News.get_cached_news(db, JA)]
+
+
+def test_cache_checks_the_version_only_after_the_interval(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(news.time, "monotonic", clock.monotonic)
+    db = FakeClient()
+    make_news("AIエージェントの新しいフレームワークが公開されました。", "AI").save(db)
+    assert cached_keywords(db) == ["AI"]
+
+    # 確認の間隔内はキャッシュだけで返す
+    db.stats.reset()
+    clock.now += NEWS_VERSION_CHECK_SECONDS - 1
+    assert cached_keywords(db) == ["AI"]
+    assert db.stats.snapshot()["round_trips"] == 0
+
+    # 間隔を過ぎればバージョンだけを読み、変わっていなければニュースは読まない
+    clock.now += 1
+    assert cached_keywords(db) == ["AI"]
+    assert db.stats.snapshot()["reads"] == 1
+
+
+def test_cache_refetches_when_a_new_edition_is_published(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(news.time, "monotonic", clock.monotonic)
+    db = FakeClient()
+    make_news("AIエージェントの新しいフレームワークが公開されました。", "AI").save(db)
+    cached_keywords(db)
+    make_news("量子コンピュータの新しいチップが発表されました。", "量子").save(db)
+
+    assert cached_keywords(db) == ["AI"]
+    clock.now += NEWS_VERSION_CHECK_SECONDS
+    assert cached_keywords(db) == ["量子", "AI"]
+
+
+def test_cache_refetches_after_the_ttl(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(news.time, "monotonic", clock.monotonic)
+    db = FakeClient()
+    make_news("AIエージェントの新しいフレームワークが公開されました。", "AI").save(db)
+    cached_keywords(db)
+    # バージョンを上げずに書き換えたニュースは、TTL が切れるまで見えない
+    News.get_collection(db).document(News._cache[JA]["news"][0].id).update(
+        {"keyword": "生成AI"}
+    )
+
+    clock.now += NEWS_CACHE_TTL_SECONDS - 1
+    assert cached_keywords(db) == ["AI"]
+    clock.now += 1
+    assert cached_keywords(db) == ["生成AI"]
+
+
+def test_cache_evicts_the_least_recently_used_language():
+    db = FakeClient()
+    languages = [f"lang-{i}" for i in range(NEWS_CACHE_MAX_ENTRIES + 1)]
+    for language in languages[:NEWS_CACHE_MAX_ENTRIES]:
+        News.get_cached_news(db, language)
+    # 最初の言語を使い直すと、2番目の言語が最も古くなる
+    News.get_cached_news(db, languages[0])
+    News.get_cached_news(db, languages[-1])
+
+    assert len(News._cache) == NEWS_CACHE_MAX_ENTRIES
+    assert languages[0] in News._cache
+    assert languages[1] not in News._cache
+
+
+def test_segments_break_only_between_sentences():
+    sentence = "あ" * 149 + "。"
+    content = sentence * 5
+
+    segments = make_news(content, "AI").segments
+
+    assert segments == [sentence * 2, sentence * 2, sentence]
+    assert all(len(s) <= SEGMENT_MAX_CHARS for s in segments)
+    assert "".join(segments) == content
+
+
+def test_segments_keep_a_long_sentence_whole_and_space_english():
+    long_sentence = "あ" * (SEGMENT_MAX_CHARS + 50) + "。"
+    assert split_passages("短い文。" + long_sentence, SEGMENT_MAX_CHARS) == [
+        "短い文。",
+        long_sentence,
+    ]
+    assert split_passages("First. Second!", SEGMENT_MAX_CHARS) == ["First. Second!"]
@@ -0,0 +1,49 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from semantic_cache import SemanticCache
+
+EDITION = "edition-1"
+
+
+class OneHotEmbedder:
+    """
+    質問ごとに別の軸を割り当て、行と回答の対応がずれれば必ず見つかるようにする
+    """
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    def embed(self, text: str) -> np.ndarray:
+        vector = np.zeros(self.dim, dtype=np.float32)
+        vector[int(text.split("-")[1])] = 1.0
+        return vector
+
+
+class SlowList(list):
+    """
+    追加の直前にスレッドを切り替え、行の位置を決めてから追加するまでの競合を起こしやすくする
+    """
+
+    def append(self, item):
+        time.sleep(0.001)
+        super().append(item)
+
+
+def test_concurrent_adds_keep_rows_and_answers_aligned():
+    count = 40
+    cache = SemanticCache(embedder=OneHotEmbedder(count), capacity=count)
+    cache._entries = SlowList()
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(
+            executor.map(
+                lambda i: cache.add(EDITION, f"question-{i}", f"answer-{i}"),
+                range(count),
+            )
+        )
+
+    assert len(cache) == count
+    for i in range(count):
+        assert cache.lookup(EDITION, f"question-{i}") == (f"answer-{i}", 1.0)
@@ -0,0 +1,166 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+
+from alexa_handler import AlexaHandler
+from firestore_fake import FakeClient
+from question import Question, ANSWER_STATUS
+from user import DAILY_QUESTION_LIMIT, SESSION_STATE_KEY, User
+
+USER_ID = "user-1"
+
+
+def load_in_progress(db, answer_text=None):
+    """
+    回答作成中のスナップショットをセッションに残し、その後ワーカーが書き込んだ状態で読み直す
+    """
+    Question(USER_ID, "質問").save(Question.collection(db))
+    session = {}
+    User.get_or_create_with_question(db, USER_ID, "ja").save_session(session)
+    if answer_text:
+        Question.collection(db).document(USER_ID).update(
+            {"answer_status": ANSWER_STATUS["READY"], "answer_text": answer_text}
+        )
+    db.stats.reset()
+    return User.load(db, USER_ID, "ja", session)
+
+
+def test_refresh_reads_question_once_when_changed():
+    db = FakeClient()
+    user = load_in_progress(db, answer_text="回答")
+
+    assert user.get_answer_status(db) == ANSWER_STATUS["READY"]
+    assert user.get_question(db).answer_text == "回答"
+    assert db.stats.snapshot()["round_trips"] == 1
+    assert db.stats.snapshot()["reads"] == 1
+
+
+def test_refresh_keeps_cached_question_when_unchanged():
+    db = FakeClient()
+    user = load_in_progress(db)
+
+    assert user.get_answer_status(db) == ANSWER_STATUS["IN_PROGRESS"]
+    assert db.stats.snapshot()["round_trips"] == 1
+
+
+def test_waiting_answer_reads_question_only_through_the_listener():
+    db = FakeClient()
+    session = {}
+    AlexaHandler.play_news(USER_ID, "ja", db, session=session)
+    AlexaHandler.receive_question(USER_ID, "ja", "質問", db, session=session)
+    timer = threading.Timer(
+        0.2,
+        Question.collection(db).document(USER_ID).update,
+        args=({"answer_status": ANSWER_STATUS["READY"], "answer_text": "回答"},),
+    )
+    timer.start()
+    db.stats.reset()
+
+    speak, _ = AlexaHandler.answer(
+        USER_ID, "ja", db, session=session, wait_until=time.monotonic() + 2.0
+    )
+    timer.join()
+
+    assert "回答" in speak
+    assert session[SESSION_STATE_KEY]["question"]["answer_status"] == (
+        ANSWER_STATUS["ANSWERED"]
+    )
+    # リスナーの最初と変更後のスナップショットだけを読み、遷移は前提条件付きの書き込みで済ませる
+    assert db.stats.snapshot()["reads"] == 2
+
+
+def save_user(db, language_code="ja", **fields):
+    User.collection(db).document(USER_ID).set(
+        {"id": USER_ID, "language_code": language_code, **fields}
+    )
+
+
+def test_submit_rechecks_the_daily_limit_in_the_transaction():
+    db = FakeClient()
+    save_user(db)
+    # 古いスナップショットのまま、別のデバイスで上限まで質問される
+    stale = User.get(User.collection(db), USER_ID)
+    for i in range(DAILY_QUESTION_LIMIT):
+        assert User.get(User.collection(db), USER_ID).submit_question(
+            db, f"質問{i}", answer_status=ANSWER_STATUS["READY"]
+        )
+
+    assert stale.submit_question(db, "もう1問") is None
+    assert stale.daily_usage_count == DAILY_QUESTION_LIMIT
+    assert Question.get(Question.collection(db), USER_ID).question_text == "質問2"
+
+
+def test_concurrent_submits_stop_at_the_daily_limit():
+    db = FakeClient()
+    save_user(db)
+
+    def submit(i):
+        return User(USER_ID, language_code="ja").submit_question(
+            db, f"質問{i}", answer_status=ANSWER_STATUS["READY"]
+        )
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(submit, range(8)))
+
+    assert sum(1 for r in results if r) == DAILY_QUESTION_LIMIT
+    user = User.get(User.collection(db), USER_ID)
+    assert user.daily_usage_count == DAILY_QUESTION_LIMIT
+
+
+def test_submit_rechecks_an_in_progress_question_in_the_transaction():
+    db = FakeClient()
+    save_user(db)
+    stale = User.get(User.collection(db), USER_ID)
+    stale.set_cached_question(None)
+    User.get(User.collection(db), USER_ID).submit_question(db, "先の質問")
+
+    assert stale.submit_question(db, "後の質問") is None
+    # 読み直した回答作成中の質問がキャッシュに入る
+    assert stale.get_question(db).question_text == "先の質問"
+    assert stale.get_answer_status(db) == ANSWER_STATUS["IN_PROGRESS"]
+
+
+def test_usage_key_rolls_over_at_local_midnight():
+    # 2024-05-01 15:30 UTC は日本時間では 5月2日 0:30
+    now = datetime(2024, 5, 1, 15, 30, tzinfo=timezone.utc)
+
+    assert User(USER_ID, language_code="ja").usage_key(now) == "d20240502"
+    assert User(USER_ID, language_code="en").usage_key(now) == "d20240501"
+
+
+def test_submit_starts_a_new_day_and_drops_old_counters():
+    db = FakeClient()
+    user = User(USER_ID, language_code="ja")
+    yesterday = user.usage_key(datetime.now(timezone.utc) - timedelta(days=1))
+    save_user(db, daily_usage={yesterday: DAILY_QUESTION_LIMIT})
+
+    assert User.get(User.collection(db), USER_ID).submit_question(db, "質問")
+
+    data = User.collection(db).document(USER_ID).get().to_dict()
+    assert data["daily_usage"] == {user.usage_key(): 1}
+
+
+def test_legacy_usage_fields_count_for_today_only():
+    now = datetime.now(timezone.utc)
+    db = FakeClient()
+    save_user(db, daily_usage_count=DAILY_QUESTION_LIMIT, last_question_date=now)
+
+    user = User.get(User.collection(db), USER_ID)
+    assert user.daily_usage_count == DAILY_QUESTION_LIMIT
+    assert user.submit_question(db, "質問") is None
+
+    save_user(
+        db,
+        daily_usage_count=DAILY_QUESTION_LIMIT,
+        last_question_date=now - timedelta(days=1),
+    )
+    user = User.get(User.collection(db), USER_ID)
+    assert user.daily_usage_count == 0
+    assert user.submit_question(db, "質問")
+
+    # 加算と同時に旧形式のフィールドを削除する
+    data = User.collection(db).document(USER_ID).get().to_dict()
+    assert data["daily_usage"] == {user.usage_key(): 1}
+    assert "daily_usage_count" not in data
+    assert "last_question_date" not in data